@@ -4,6 +4,8 @@ import os
 import sys
 from core import utility
 from core import settings
+from core import costmodel
+from core import resultcache
 from core.logging import get_logger
 from dotenv import load_dotenv
 
@@ -15,20 +17,6 @@ intents.members = True
 load_dotenv()
 self.logger = get_logger(__name__)
 
-#load extensions
-# check files and global variables
-settings.startup_check()
-settings.files_check()
-
-self.load_extension('core.stablecog')
-self.load_extension('core.drawcog')
-self.load_extension('core.upscalecog')
-self.load_extension('core.identifycog')
-self.load_extension('core.tipscog')
-self.load_extension('core.cancelcog')
-self.load_extension('core.minigamecog')
-self.load_extension('core.fallbackviewcog')
-
 #stats slash command
 @self.slash_command(name='stats', description='How many images have I generated?')
 async def stats(ctx: discord.ApplicationContext):
@@ -68,6 +56,17 @@ async def on_raw_reaction_add(ctx: discord.RawReactionActionEvent):
 
         if author.id == self.user.id and message.content.startswith(f'<@{ctx.user_id}>'):
             await message.delete()
+            utility.image_store.remove_message(message.id)
+
+            # deleting a queue message also cancels the dreams of the command it answers
+            ctx_id = None
+            if message.interaction_metadata:
+                ctx_id = message.interaction_metadata.id
+            elif message.reference:
+                ctx_id = message.reference.message_id
+            cancel_cog = self.get_cog('CancelCog')
+            if ctx_id and cancel_cog:
+                cancel_cog.cancel_dreams(user, ctx_id)
 
     if ctx.emoji.name == '🔁':
         stable_cog = self.get_cog('StableCog')
@@ -104,21 +103,44 @@ async def on_guild_join(guild: discord.Guild):
 async def shutdown(bot: discord.Bot):
     await bot.close()
 
-print('Starting Bot...')
-from core import consoleinput
-console_input = consoleinput.ConsoleInput(self)
-
-try:
-    console_input.run()
-    self.run(settings.get_env_var('TOKEN'))
-except KeyboardInterrupt:
-    self.logger.info('Keyboard interrupt received. Exiting.')
-    asyncio.run(shutdown(self))
-except SystemExit:
-    self.logger.info('System exit received. Exiting.')
-    asyncio.run(shutdown(self))
-except Exception as e:
-    self.logger.error(e)
-    asyncio.run(shutdown(self))
-finally:
-    sys.exit(0)
\ No newline at end of file
+# the bot only starts when aiya.py is run, not when the encoder processes import it
+if __name__ == '__main__':
+    #load extensions
+    # check files and global variables
+    settings.startup_check()
+    settings.files_check()
+
+    # guild settings are in memory before any command can read them
+    settings.load_guilds()
+    settings.start_guilds_watch()
+
+    self.load_extension('core.stablecog')
+    self.load_extension('core.drawcog')
+    self.load_extension('core.upscalecog')
+    self.load_extension('core.identifycog')
+    self.load_extension('core.tipscog')
+    self.load_extension('core.cancelcog')
+    self.load_extension('core.minigamecog')
+    self.load_extension('core.fallbackviewcog')
+
+    print('Starting Bot...')
+    from core import consoleinput
+    console_input = consoleinput.ConsoleInput(self)
+
+    try:
+        console_input.run()
+        self.run(settings.get_env_var('TOKEN'))
+    except KeyboardInterrupt:
+        self.logger.info('Keyboard interrupt received. Exiting.')
+        asyncio.run(shutdown(self))
+    except SystemExit:
+        self.logger.info('System exit received. Exiting.')
+        asyncio.run(shutdown(self))
+    except Exception as e:
+        self.logger.error(e)
+        asyncio.run(shutdown(self))
+    finally:
+        costmodel.save_cost_models(True)
+        resultcache.caption_cache.save(True)
+        settings.file_writer.stop()
+        sys.exit(0)
\ No newline at end of file
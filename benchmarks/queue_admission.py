@@ -0,0 +1,39 @@
+# time the per user queue checks done when a dream is admitted, with the global queue filled to 10, 1k and 10k dreams.
+# run from the repository root: python benchmarks/queue_admission.py
+import os
+import sys
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from core import utility
+from core import queuehandler
+
+users = 100
+calls = 10000
+
+def get_dream(user_id: int):
+    ctx = types.SimpleNamespace(author=types.SimpleNamespace(id=user_id), guild=None)
+    return utility.DreamObject(None, ctx)
+
+def fill_queue(size: int):
+    dream_queue = queuehandler.DreamQueue()
+    for index in range(size):
+        queue_object = get_dream(index % users)
+        dream_queue.track_dream(queue_object)
+        dream_queue.queue.push(queue_object, 4, queue_object.queue_cost, utility.get_guild(queue_object.ctx), queue_object.queue_user_id)
+    return dream_queue
+
+def time_admission(dream_queue: queuehandler.DreamQueue):
+    time_start = time.perf_counter()
+    for index in range(calls):
+        user_id = index % users
+        dream_queue.get_user_queue_cost(user_id)
+        dream_queue.get_user_queue_length(user_id)
+    return (time.perf_counter() - time_start) / calls
+
+if __name__ == '__main__':
+    for size in (10, 1000, 10000):
+        dream_queue = fill_queue(size)
+        print(f'{size:>6} queued: {time_admission(dream_queue) * 1e6:.3f} us per get_user_queue_cost + get_user_queue_length')
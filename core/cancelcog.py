@@ -16,10 +16,10 @@ class CancelCog(commands.Cog, description='Cancels all images in queue.'):
         user = utility.get_user(ctx)
 
         try:
-            total_cleared: int = queuehandler.dream_queue.clear_user_queue(user.id)
+            total_cleared: int = self.cancel_dreams(user)
 
             embed=discord.Embed()
-            embed.add_field(name='Items Cleared', value=f'``{total_cleared}`` dreams cleared from queue', inline=False)
+            embed.add_field(name='Items Cleared', value=f'``{total_cleared}`` dreams cancelled', inline=False)
             loop.create_task(ctx.respond(embed=embed, ephemeral=True))
 
         except Exception as e:
@@ -27,5 +27,11 @@ class CancelCog(commands.Cog, description='Cancels all images in queue.'):
             print(content + f'\n{traceback.print_exc()}')
             loop.create_task(ctx.respond(content=content, ephemeral=True, delete_after=30))
 
+    # cancel the dreams of a user, or only the dreams of one command. dreams already running are interrupted
+    def cancel_dreams(self, user: discord.User, ctx_id: int = None):
+        total_cleared: int = queuehandler.dream_queue.clear_user_queue(user.id, ctx_id)
+        if total_cleared: print(f'Cancelled {total_cleared} dreams -- {user.name}#{user.discriminator}')
+        return total_cleared
+
 def setup(bot: discord.Bot):
     bot.add_cog(CancelCog(bot))
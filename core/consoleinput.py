@@ -4,7 +4,9 @@ import traceback
 import threading
 
 from core import settings
+from core import utility
 from core import queuehandler
+from core import resultcache
 
 class ConsoleInput:
     def __init__(self, bot: discord.Bot):
@@ -38,11 +40,8 @@ class ConsoleInput:
                         # print('> Reloading config')
                         settings.startup_check()
 
-                        # print('> Clearing guilds cache')
-                        settings.global_var.guilds_cache = None
-
-                        # print('> Clearing dream cache')
-                        settings.global_var.dream_cache = None
+                        # print('> Reloading guilds cache')
+                        settings.load_guilds()
 
                         # print('> Reloading files')
                         settings.files_check()
@@ -110,9 +109,20 @@ class ConsoleInput:
                                 else:
                                     message += f',DISABLED'
                             message += f' - Queue:{dream_instance.get_queue_length()}'
+                            if web_ui.model_switch_count:
+                                message += f' - Checkpoint switches:{web_ui.model_switch_count} ({web_ui.model_switch_total / web_ui.model_switch_count:.1f}s avg)'
                             print(message)
 
                         print(f'Total Queue:{queuehandler.dream_queue.get_queue_length()}')
+                        for result_cache in [resultcache.result_cache, resultcache.upscale_cache]:
+                            if result_cache.hits or result_cache.misses:
+                                print(f'{result_cache.name.capitalize()} cache: {result_cache.hits} hits, {result_cache.misses} misses - {result_cache.size // (1024 * 1024)}MB')
+                        caption_cache = resultcache.caption_cache
+                        if caption_cache.get_hit_rate() != None:
+                            print(f'Caption cache: {caption_cache.get_hit_rate():.0%} hit rate ({caption_cache.hits} hits, {caption_cache.misses} misses) - {len(caption_cache.entries)} captions')
+                        image_store = utility.image_store
+                        if image_store.hits:
+                            print(f'Image store: {image_store.hits} hits - {len(image_store.entries)} images ({image_store.size // (1024 * 1024)}MB)')
 
                     case other:
                         print(self.help_output)
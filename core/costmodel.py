@@ -0,0 +1,271 @@
+import json
+import math
+import os
+import threading
+import time
+import traceback
+
+from core import utility
+from core import settings
+
+
+# compute costs are measured in units of a 20 step 512x512 dream, so the compute limits in the guild settings
+# keep their meaning while the model learns what dreams actually cost on the hardware
+path = 'resources/cost-model.json'
+
+# seconds for one unit of compute cost before anything has been measured
+default_seconds_per_cost = 4.0
+
+# the original hard-coded cost formula, as coefficients on the features from get_features
+prior_costs: dict[str, list[float]] = {
+    'draw': [0.0, 1.0, 2.0, 1.0],
+    'upscale': [4.0],
+    'identify': [1.0],
+}
+
+# weight of older dreams in the fit, lets the model follow changes in the webui
+forgetting_factor = 0.995
+
+# how far the fitted coefficients are allowed to move away from the prior per dream
+prior_variance = 100.0
+
+save_interval = 60.0
+
+# draws are also fitted for each sampler and resolution bucket, which learns what the features can't express, such
+# as the throughput of a sampler or how a resolution really scales. the fit of the kind is used until the bucket
+# has seen this many dreams
+bucket_samples = 5
+
+# get the sampler and resolution bucket a draw is fitted in, resolutions are bucketed by powers of two of the area
+def get_fit_key(queue_object: utility.DreamObject):
+    if type(queue_object) is not utility.DrawObject: return None
+    area = float(queue_object.width * queue_object.height) / float(512 * 512)
+    bucket = round(math.log2(max(area, 1.0 / 16.0)))
+    highres_fix = queue_object.highres_fix != None and queue_object.highres_fix != 'None'
+    return f'draw:{queue_object.sampler}:{bucket}' + (':hr' if highres_fix else '')
+
+# get the features and model kind for a dream, the cost is linear in these features
+def get_features(queue_object: utility.DreamObject):
+    if type(queue_object) is utility.DrawObject:
+        # dreams merged into one request cost as much as all of them together
+        if queue_object.merge_objects:
+            features = [0.0, 0.0, 0.0, 0.0]
+            for merge_object in queue_object.merge_objects:
+                features = [a + b for a, b in zip(features, get_draw_features(merge_object))]
+            return 'draw', features
+        return 'draw', get_draw_features(queue_object)
+
+    elif type(queue_object) is utility.UpscaleObject:
+        return 'upscale', [1.0]
+
+    elif type(queue_object) is utility.IdentifyObject:
+        models = 1.0
+        if queue_object.model == 'combined': models = float(len(settings.global_var.identify_models))
+        return 'identify', [models]
+
+    return None, []
+
+def get_draw_features(queue_object: utility.DrawObject):
+    highres_fix = queue_object.highres_fix != None and queue_object.highres_fix != 'None'
+    slow_sampler = queue_object.sampler in settings.global_var.slow_samplers
+
+    step_cost = float(queue_object.steps) / 20.0
+    highres_cost = 0.0
+    if highres_fix: highres_cost = step_cost * (2.0 if slow_sampler else 1.0)
+    step_cost *= pow(max(1.0, float(queue_object.width * queue_object.height) / float(512 * 512)), 1.25)
+    if queue_object.init_url or highres_fix: step_cost *= max(0.2, queue_object.strength)
+
+    # use actual batch size from payload
+    batch = queue_object.batch
+    try:
+        batch = queue_object.payload['n_iter'] * queue_object.payload.get('batch_size', 1)
+    except:
+        pass
+    batch = float(batch)
+
+    if slow_sampler:
+        return [batch, 0.0, batch * step_cost, batch * highres_cost]
+    return [batch, batch * step_cost, 0.0, batch * highres_cost]
+
+def is_finite(values: list[float]):
+    return all(math.isfinite(value) for value in values)
+
+# recursive least squares fit of dream seconds against the features of a dream
+class CostFit:
+    def __init__(self, prior: list[float]):
+        self.theta = [cost * default_seconds_per_cost for cost in prior]
+        self.covariance = [[prior_variance if row == column else 0.0 for column in range(len(prior))] for row in range(len(prior))]
+        self.samples = 0
+
+    def predict(self, features: list[float]):
+        return sum(theta * feature for theta, feature in zip(self.theta, features))
+
+    def update(self, features: list[float], seconds: float):
+        if not is_finite(features) or not math.isfinite(seconds): return
+        size = len(self.theta)
+        covariance_features = [sum(self.covariance[row][column] * features[column] for column in range(size)) for row in range(size)]
+        excitation = sum(features[row] * covariance_features[row] for row in range(size))
+        if excitation <= 0.0: return
+        gain = [value / (1.0 + excitation) for value in covariance_features]
+
+        # forget only along the direction of these features, so coefficients of features that are never used
+        # keep their uncertainty instead of growing it without bound
+        forgetting = forgetting_factor - (1.0 - forgetting_factor) / excitation
+        if forgetting <= 0.0: forgetting = 1.0
+        covariance_scale = 1.0 / (1.0 / forgetting + excitation)
+
+        error = seconds - self.predict(features)
+        # costs cannot be negative, clamp coefficients that the noise pushes below zero
+        theta = [max(0.0, self.theta[row] + gain[row] * error) for row in range(size)]
+        covariance = [[self.covariance[row][column] - covariance_scale * covariance_features[row] * covariance_features[column] for column in range(size)] for row in range(size)]
+
+        # keep the uncertainty within what the prior allows
+        trace = sum(covariance[row][row] for row in range(size))
+        if trace > prior_variance * size:
+            covariance = [[value * prior_variance * size / trace for value in row] for row in covariance]
+
+        if not is_finite(theta) or not all(is_finite(row) for row in covariance): return
+        self.theta = theta
+        self.covariance = covariance
+        self.samples += 1
+
+    def to_dict(self):
+        return {
+            'theta': self.theta,
+            'covariance': self.covariance,
+            'samples': self.samples
+        }
+
+    def from_dict(self, data: dict):
+        size = len(self.theta)
+        if len(data['theta']) != size: return
+        theta = [float(value) for value in data['theta']]
+        covariance = [[float(value) for value in row] for row in data['covariance']]
+        if len(covariance) != size or any(len(row) != size for row in covariance):
+            raise ValueError('covariance does not match the features')
+        if not is_finite(theta) or not all(is_finite(row) for row in covariance):
+            raise ValueError('values are not finite')
+        self.theta = theta
+        self.covariance = covariance
+        self.samples = int(data['samples'])
+
+# cost model for a single webui, fitted from the dreams it has completed
+class CostModel:
+    def __init__(self, name: str):
+        self.name = name
+        self.lock = threading.Lock()
+        self.fits: dict[str, CostFit] = {}
+        for kind, prior in prior_costs.items():
+            self.fits[kind] = CostFit(prior)
+
+        saved = cost_models_saved.get(name)
+        if saved:
+            for kind, data in saved.items():
+                try:
+                    # fits of a sampler and resolution bucket are saved by their key
+                    if kind.startswith('draw:'): self.fits[kind] = CostFit(prior_costs['draw'])
+                    if kind in self.fits: self.fits[kind].from_dict(data)
+                except Exception as e:
+                    if kind.startswith('draw:'): self.fits.pop(kind, None)
+                    print(f'> Ignoring saved cost model for {name} {kind}: {e}')
+
+    # get the fit for a dream, the fit of its bucket once that has seen enough dreams. the lock must be held
+    def get_fit(self, kind: str, key: str = None):
+        fit = self.fits.get(key) if key else None
+        if fit != None and fit.samples >= bucket_samples: return fit
+        return self.fits[kind]
+
+    # predicted seconds for this webui to complete a dream
+    def get_dream_time(self, queue_object: utility.DreamObject):
+        kind, features = get_features(queue_object)
+        if kind == None: return 0.0
+        key = get_fit_key(queue_object)
+        with self.lock:
+            return self.get_fit(kind, key).predict(features)
+
+    # seconds for this webui to complete one unit of compute cost
+    def get_seconds_per_cost(self):
+        with self.lock:
+            seconds = self.fits['draw'].predict([1.0, 1.0, 0.0, 0.0])
+        if seconds <= 0.0: return default_seconds_per_cost
+        return seconds
+
+    # compute cost of a dream on this webui
+    def get_dream_cost(self, queue_object: utility.DreamObject):
+        kind, features = get_features(queue_object)
+        if kind == None: return 0.0
+
+        # costs are relative to a draw, so other dreams keep the prior until a draw has been measured
+        if kind != 'draw' and self.fits['draw'].samples == 0:
+            return sum(cost * feature for cost, feature in zip(prior_costs[kind], features))
+
+        dream_compute_cost = self.get_dream_time(queue_object) / self.get_seconds_per_cost()
+        if kind == 'draw':
+            # no dream costs less than a single unit per image
+            dream_compute_cost = max(features[0], dream_compute_cost)
+        return dream_compute_cost
+
+    # update the fit from a completed dream, using the features of the dream from before it was sent
+    def record_dream_time(self, kind: str, features: list[float], seconds: float, key: str = None):
+        if kind == None: return
+        with self.lock:
+            self.fits[kind].update(features, seconds)
+
+            # a new bucket starts from what has been learned for every dream of the kind
+            if key:
+                fit = self.fits.get(key)
+                if fit == None:
+                    fit = CostFit(prior_costs[kind])
+                    fit.theta = list(self.fits[kind].theta)
+                    self.fits[key] = fit
+                fit.update(features, seconds)
+        save_cost_models()
+
+    def to_dict(self):
+        with self.lock:
+            return {kind: fit.to_dict() for kind, fit in self.fits.items()}
+
+# the prior model, used for dreams when no webui is configured
+prior_model: CostModel = None
+
+cost_models: list[CostModel] = []
+cost_models_saved: dict[str, dict] = {}
+cost_models_lock = threading.Lock()
+cost_models_save_time = 0.0
+
+def load_cost_models():
+    global cost_models_saved
+    if os.path.isfile(path):
+        try:
+            with open(path, 'r') as f:
+                cost_models_saved = json.load(f)
+            print(f'> Loaded cost models for {len(cost_models_saved)} WebUI(s)')
+        except Exception as e:
+            print(f'> Failed to load cost models at {path}\n{e}\n{traceback.print_exc()}')
+            cost_models_saved = {}
+
+# get the cost model of a webui, keeping what has been learned when the webui list is reloaded
+def get_cost_model(name: str):
+    with cost_models_lock:
+        for cost_model in cost_models:
+            if cost_model.name == name: return cost_model
+        cost_model = CostModel(name)
+        cost_models.append(cost_model)
+    return cost_model
+
+# write the fitted models to disk, at most once every save_interval unless forced
+def save_cost_models(force: bool = False):
+    global cost_models_save_time
+    with cost_models_lock:
+        if force == False and time.time() - cost_models_save_time < save_interval: return
+        cost_models_save_time = time.time()
+
+        for cost_model in cost_models:
+            cost_models_saved[cost_model.name] = cost_model.to_dict()
+        contents = json.dumps(cost_models_saved)
+
+    # written by the file writer, dreams are recorded on the event loop
+    settings.file_writer.write_file(path, contents)
+
+load_cost_models()
+prior_model = CostModel('')
@@ -0,0 +1,102 @@
+import concurrent.futures
+import discord
+import io
+import multiprocessing
+import threading
+from PIL import Image
+
+from core import utility
+
+
+# images are uploaded to discord as png unless IMAGE_FORMAT is set to webp or jpeg. images that don't fit the
+# upload limit of the guild are converted to a lossy format, with the best quality that still fits
+formats = {
+    'png': '.png',
+    'webp': '.webp',
+    'jpeg': '.jpeg'
+}
+image_format = 'png'
+
+# upload limit used when the guild doesn't say, such as in direct messages
+default_upload_limit = 8 * 1000 * 1000
+
+# encoding runs in its own processes, so large upscales and batches don't hold the GIL while the bot is working.
+# the processes are started fresh rather than forked, forking copies the locks held by the bot's threads
+max_workers = 2
+process_executor: concurrent.futures.ProcessPoolExecutor = None
+process_executor_lock = threading.Lock()
+
+def get_process_executor():
+    global process_executor
+    with process_executor_lock:
+        if process_executor == None:
+            start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            process_executor = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context(start_method))
+        return process_executor
+
+# the most bytes that can be uploaded in one message
+def get_upload_limit(ctx: discord.ApplicationContext | discord.Interaction | discord.Message):
+    try:
+        return int(ctx.guild.filesize_limit)
+    except:
+        return default_upload_limit
+
+# encode png bytes in the format for discord, within max_size bytes if it can be done. runs in the process executor
+def encode_image(data: bytes, max_size: int, image_format: str):
+    image = Image.open(io.BytesIO(data))
+
+    # png is lossless, the only way to make it smaller is a lossy format
+    if image_format == 'png': image_format = 'jpeg'
+    if image_format == 'jpeg' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+
+    def save(quality: int):
+        with io.BytesIO() as buffer:
+            image.save(buffer, format=image_format.upper(), quality=quality)
+            return buffer.getvalue()
+
+    encoded = save(95)
+    if len(encoded) <= max_size: return encoded, image_format
+
+    # find the best quality that fits, or the smallest image if none of them do
+    low, high = 5, 94
+    encoded = None
+    while low <= high:
+        quality = (low + high) // 2
+        encoded_quality = save(quality)
+        if len(encoded_quality) <= max_size:
+            encoded = encoded_quality
+            low = quality + 1
+        else:
+            high = quality - 1
+    if encoded == None: encoded = save(5)
+    return encoded, image_format
+
+# prepare png images to be uploaded together in a message of at most max_size bytes.
+# returns the images and the file extension of each, images that are fine as they are aren't encoded again
+def encode_images(images: list[utility.ImageDownload], max_size: int):
+    def is_png(image: utility.ImageDownload):
+        return image_format == 'png' and image.data[:8] == b'\x89PNG\r\n\x1a\n'
+
+    if all(is_png(image) for image in images) and sum(len(image.data) for image in images) <= max_size:
+        return [(image, formats['png']) for image in images]
+
+    # split the limit between the images, so they encode in parallel
+    image_max_size = max_size // len(images)
+    futures: list[concurrent.futures.Future] = []
+    for image in images:
+        if is_png(image) and len(image.data) <= image_max_size:
+            futures.append(None)
+        else:
+            futures.append(get_process_executor().submit(encode_image, image.data, image_max_size, image_format))
+
+    encoded_images: list[tuple[utility.ImageDownload, str]] = []
+    for image, future in zip(images, futures):
+        if future == None:
+            encoded_images.append((image, formats['png']))
+            continue
+        encoded, encoded_format = future.result()
+        if len(image.data) > image_max_size:
+            print(f'Image too large: {len(image.data)} bytes - Converted image to {encoded_format.upper()} of {len(encoded)} bytes')
+        encoded_images.append((utility.ImageDownload(encoded, image.width, image.height), formats[encoded_format]))
+    return encoded_images
@@ -1,16 +1,16 @@
-import base64
+import aiohttp
 import discord
+import json
 import traceback
-import requests
 import asyncio
-import time
-import threading
 from discord import option
 from discord.ext import commands
 from typing import Optional
 
 from core import utility
+from core import metrics
 from core import queuehandler
+from core import resultcache
 from core import viewhandler
 from core import settings
 
@@ -56,6 +56,7 @@ class IdentifyCog(commands.Cog, description = 'Describe an image'):
 
             # get input image
             image: str = None
+            image_hash: str = None
             image_validated = False
             if init_url or init_image:
                 if not init_url and init_image:
@@ -68,33 +69,28 @@ class IdentifyCog(commands.Cog, description = 'Describe an image'):
                     image_validated = False
                     raise Exception()
 
+                # defer response before downloading
                 try:
-                    # reject URL downloads larger than 10MB
-                    url_head = await loop.run_in_executor(None, requests.head, init_url)
-                    url_size = int(url_head.headers.get('content-length', -1))
-                    if url_size > 10 * 1024 * 1024:
-                        print(f'Dream rejected: Image too large.')
-                        content = 'URL image is too large! Please make the download size smaller.'
-                        ephemeral = True
-                        image_validated = False
-                        raise Exception()
-
-                    # defer response before downloading
-                    try:
-                        loop.create_task(ctx.defer())
-                    except:
-                        pass
+                    loop.create_task(ctx.defer())
+                except:
+                    pass
 
-                    # download and encode the image
-                    image_data = await loop.run_in_executor(None, requests.get, init_url)
-                    image = 'data:image/png;base64,' + base64.b64encode(image_data.content).decode('utf-8')
+                # download and encode the image, rejecting downloads larger than 10MB
+                try:
+                    image_download = await utility.fetch_image(init_url)
+                    image = await loop.run_in_executor(utility.executor, image_download.get_data_url)
+                    image_hash = await loop.run_in_executor(utility.executor, resultcache.get_image_hash, image_download.data)
                     image_validated = True
 
+                except utility.DownloadTooLarge:
+                    print(f'Dream rejected: Image too large.')
+                    content = 'URL image is too large! Please make the download size smaller.'
+                    ephemeral = True
+                    raise Exception()
+
                 except:
-                    if content == None:
-                        content = 'URL image not found! Please check the image URL.'
-                        ephemeral = True
-                        image_validated = False
+                    content = 'URL image not found! Please check the image URL.'
+                    ephemeral = True
                     raise Exception()
 
             # fail if no image is provided
@@ -124,15 +120,28 @@ class IdentifyCog(commands.Cog, description = 'Describe an image'):
                     payload.update(model_payload)
 
                 queue_object.payload = payload
+                queue_object.image_hash = image_hash
                 return queue_object
 
             identify_object = get_identify_object()
 
+            # answer images that have been identified before right away
+            captions = resultcache.caption_cache.get(image_hash, self.get_models(identify_object))
+            if captions:
+                print(f'Identify served from caption cache -- hit rate: {resultcache.caption_cache.get_hit_rate():.0%}')
+                # reply to the interaction, as it has already been deferred for the download
+                queuehandler.upload_queue.process_upload(utility.UploadObject(queue_object=identify_object,
+                    content=self.get_content(identify_object, captions), view=identify_object.view
+                ))
+                identify_object.view = None
+                return
+
             # calculate total cost of queued items and reject if there is too expensive
             dream_cost = queuehandler.dream_queue.get_dream_cost(identify_object)
             queue_cost = queuehandler.dream_queue.get_user_queue_cost(user.id)
             if dream_cost + queue_cost > settings.read(guild)['max_compute_queue']:
                 content = f'<@{user.id}> Please wait! You have too much queued up.'
+                metrics.admission_rejections.inc(reason='queue_limit')
                 ephemeral = True
                 raise Exception()
 
@@ -150,6 +159,8 @@ class IdentifyCog(commands.Cog, description = 'Describe an image'):
                 ephemeral = True
             else:
                 content = f'<@{user.id}> I\'m identifying the image! Queue: ``{queue_length}``'
+                queue_eta = queuehandler.dream_queue.get_queue_eta(priority)
+                if queue_eta != None: content += f' - ETA: ``{utility.format_duration(queue_eta)}``'
 
         except Exception as e:
             if content == None:
@@ -168,28 +179,26 @@ class IdentifyCog(commands.Cog, description = 'Describe an image'):
             else:
                 loop.create_task(ctx.channel.send(content, delete_after=delete_after))
 
-    def dream(self, queue_object: utility.IdentifyObject, web_ui: utility.WebUI, queue_continue: threading.Event):
+    async def dream(self, queue_object: utility.IdentifyObject, web_ui: utility.WebUI, queue_continue: asyncio.Event):
+        loop = asyncio.get_running_loop()
         user = utility.get_user(queue_object.ctx)
 
         try:
-            # get webui session
-            s = web_ui.get_session()
-            if s == None:
-                # no session, return the object to the queue handler to try again
+            if web_ui.online == False:
+                # webui went offline, return the object to the queue handler to try again
                 queuehandler.dream_queue.process_dream(queue_object, 0, False)
                 return
 
             # safe for global queue to continue
-            def continue_queue():
-                time.sleep(0.1)
-                queue_continue.set()
-            threading.Thread(target=continue_queue, daemon=True).start()
+            loop.call_later(0.1, queue_continue.set)
+
+            # don't send dreams that were cancelled while waiting for the WebUI
+            if queue_object.cancelled:
+                return
 
             if queue_object.model == 'combined':
                 # combined model payload - iterate through all models and put them in the prompt
                 payloads: list[dict] = []
-                threads: list[threading.Thread] = []
-                responses: list[requests.Response | Exception] = []
                 for model in settings.global_var.identify_models:
                     new_payload = {}
                     new_payload.update(queue_object.payload)
@@ -198,47 +207,22 @@ class IdentifyCog(commands.Cog, description = 'Describe an image'):
                     }
                     new_payload.update(model_payload)
                     payloads.append(new_payload)
-                    responses.append(None)
 
-                def interrogate(thread_index, thread_payload):
-                    try:
-                        responses[thread_index] = s.post(url=f'{web_ui.url}/sdapi/v1/interrogate', json=thread_payload, timeout=120)
-                    except Exception as e:
-                        responses[thread_index] = e
-
-                for index, payload in enumerate(payloads):
-                    thread = threading.Thread(target=interrogate, args=[index, payload], daemon=True)
-                    threads.append(thread)
-
-                for thread in threads:
-                    thread.start()
-
-                for thread in threads:
-                    thread.join()
-
-                for response in responses:
-                    if type(response) is not requests.Response:
-                        raise response
+                responses: list[bytes] = await asyncio.gather(*[web_ui.post('/sdapi/v1/interrogate', payload, 120, queue_object) for payload in payloads])
+                queue_object.trace_stage('responded')
+                queue_object.payload = None
 
                 def post_dream():
                     try:
-                        content: str = ''
-                        for index, response in enumerate(responses):
-                            response_data = response.json()
+                        captions: list[str] = []
+                        for model, response in zip(settings.global_var.identify_models, responses):
+                            response_data = json.loads(response)
                             caption = response_data.get('caption')
-                            if caption:
-                                if content: content += ', '
-                                content += caption
-
-                        content = content.encode('utf-8').decode('unicode_escape')
-                        content = content.replace('\\(', '')
-                        content = content.replace('\\)', '')
-                        content = content.replace('_', ' ')
-
-                        content = f'<@{user.id}> ``{queue_object.message}``\nI think this is ``{content}``'
+                            resultcache.caption_cache.put(queue_object.image_hash, model, caption)
+                            captions.append(caption)
 
                         queuehandler.upload_queue.process_upload(utility.UploadObject(queue_object=queue_object,
-                            content=content, view=queue_object.view
+                            content=self.get_content(queue_object, captions), view=queue_object.view
                         ))
                         queue_object.view = None
 
@@ -247,29 +231,31 @@ class IdentifyCog(commands.Cog, description = 'Describe an image'):
                         print(content + f'\n{traceback.print_exc()}')
                         queuehandler.upload_queue.process_upload(utility.UploadObject(queue_object=queue_object, content=content, delete_after=30))
 
-                threading.Thread(target=post_dream, daemon=True).start()
+                loop.run_in_executor(utility.executor, post_dream)
             else:
                 # regular payload - get identify for the model specified
-                response = s.post(url=f'{web_ui.url}/sdapi/v1/interrogate', json=queue_object.payload, timeout=120)
+                response = await web_ui.post('/sdapi/v1/interrogate', queue_object.payload, 120, queue_object)
+                queue_object.trace_stage('responded')
                 queue_object.payload = None
 
                 def post_dream():
                     try:
-                        response_data = response.json()
-                        content = response_data.get('caption')
+                        response_data = json.loads(response)
+                        caption = response_data.get('caption')
+                        resultcache.caption_cache.put(queue_object.image_hash, queue_object.model, caption)
                         queuehandler.upload_queue.process_upload(utility.UploadObject(queue_object=queue_object,
-                            content=f'<@{user.id}> ``{queue_object.message}``\nI think this is ``{content}``', view=queue_object.view
+                            content=self.get_content(queue_object, [caption]), view=queue_object.view
                         ))
                         queue_object.view = None
                     except Exception as e:
                         content = f'<@{user.id}> ``{queue_object.message}``\nSomething went wrong.\n{e}'
                         print(content + f'\n{traceback.print_exc()}')
                         queuehandler.upload_queue.process_upload(utility.UploadObject(queue_object=queue_object, content=content, delete_after=30))
-                threading.Thread(target=post_dream, daemon=True).start()
+                loop.run_in_executor(utility.executor, post_dream)
 
-        except requests.exceptions.RequestException as e:
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             # connection error, return items to queue
-            time.sleep(5.0)
+            await asyncio.sleep(5.0)
             web_ui.reconnect()
             queuehandler.dream_queue.process_dream(queue_object, 0, False)
             return
@@ -279,5 +265,29 @@ class IdentifyCog(commands.Cog, description = 'Describe an image'):
             print(content + f'\n{traceback.print_exc()}')
             queuehandler.upload_queue.process_upload(utility.UploadObject(queue_object=queue_object, content=content, delete_after=30))
 
+    # the interrogation models used for an identify object
+    def get_models(self, queue_object: utility.IdentifyObject):
+        if queue_object.model == 'combined':
+            return settings.global_var.identify_models
+        return [queue_object.model]
+
+    # the message with the captions of the interrogation models
+    def get_content(self, queue_object: utility.IdentifyObject, captions: list[str]):
+        user = utility.get_user(queue_object.ctx)
+        if queue_object.model == 'combined':
+            content: str = ''
+            for caption in captions:
+                if caption:
+                    if content: content += ', '
+                    content += caption
+
+            content = content.encode('utf-8').decode('unicode_escape')
+            content = content.replace('\\(', '')
+            content = content.replace('\\)', '')
+            content = content.replace('_', ' ')
+        else:
+            content = captions[0]
+        return f'<@{user.id}> ``{queue_object.message}``\nI think this is ``{content}``'
+
 def setup(bot: discord.Bot):
     bot.add_cog(IdentifyCog(bot))
@@ -0,0 +1,150 @@
+import bisect
+import http.server
+import threading
+import traceback
+
+
+# metrics in the prometheus text format, served over http when METRICS_PORT is set. counters and histograms are
+# updated where things happen, gauges are read from the queues only when the metrics are asked for
+metrics: list = []
+server: http.server.ThreadingHTTPServer = None
+
+# histogram buckets in seconds
+default_buckets = [0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0]
+
+def format_labels(labels: tuple[tuple[str, str], ...], extra: str = None):
+    parts = []
+    for (key, value) in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{key}="{value}"')
+    if extra: parts.append(extra)
+    if len(parts) == 0: return ''
+    return '{' + ','.join(parts) + '}'
+
+def format_value(value: float):
+    if value == float('inf'): return '+Inf'
+    return repr(float(value))
+
+class Counter:
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self.lock = threading.Lock()
+        self.values: dict[tuple, float] = {}
+        metrics.append(self)
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} counter']
+        with self.lock:
+            values = list(self.values.items())
+        for (key, value) in values:
+            lines.append(f'{self.name}{format_labels(key)} {format_value(value)}')
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, description: str, buckets: list[float] = default_buckets):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.lock = threading.Lock()
+
+        # count in each bucket, with the last one for values above every bucket, and the sum of the values
+        self.counts: dict[tuple, list[int]] = {}
+        self.sums: dict[tuple, float] = {}
+        metrics.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.counts.get(key)
+            if counts == None:
+                counts = [0] * (len(self.buckets) + 1)
+                self.counts[key] = counts
+                self.sums[key] = 0.0
+            counts[index] += 1
+            self.sums[key] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            values = [(key, list(counts), self.sums[key]) for (key, counts) in self.counts.items()]
+        for (key, counts, total) in values:
+            cumulative = 0
+            for (bucket, count) in zip(self.buckets + [float('inf')], counts):
+                cumulative += count
+                bucket_label = 'le="' + format_value(bucket) + '"'
+                lines.append(f'{self.name}_bucket{format_labels(key, bucket_label)} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(key)} {format_value(total)}')
+            lines.append(f'{self.name}_count{format_labels(key)} {cumulative}')
+        return lines
+
+# a value read when the metrics are asked for. collect returns a list of labels and values
+class Gauge:
+    def __init__(self, name: str, description: str, collect):
+        self.name = name
+        self.description = description
+        self.collect = collect
+        metrics.append(self)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} gauge']
+        for (labels, value) in self.collect():
+            lines.append(f'{self.name}{format_labels(tuple(sorted(labels.items())))} {format_value(value)}')
+        return lines
+
+def render():
+    lines: list[str] = []
+    for metric in metrics:
+        try:
+            lines += metric.render()
+        except Exception as e:
+            print(f'> Failed to collect metric {metric.name}\n{e}\n{traceback.print_exc()}')
+    return '\n'.join(lines) + '\n'
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # keep scrapes out of the console
+    def log_message(self, format, *args):
+        pass
+
+def start_server(host: str, port: int):
+    global server
+    if server != None: return
+    try:
+        server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        print(f'> Serving metrics at http://{host}:{port}/metrics')
+    except Exception as e:
+        print(f'> Failed to serve metrics at {host}:{port}\n{e}')
+        server = None
+
+# metrics updated from around the bot
+webui_request_seconds = Histogram('aiya_webui_request_seconds', 'Time for the WebUI to answer a request, by endpoint.')
+webui_request_errors = Counter('aiya_webui_request_errors_total', 'WebUI requests that failed or returned an error, by endpoint.')
+checkpoint_switch_seconds = Histogram('aiya_checkpoint_switch_seconds', 'Time for a WebUI to switch checkpoints.')
+dream_queue_seconds = Histogram('aiya_dream_queue_seconds', 'Time dreams wait in the queue before a WebUI takes them.')
+dream_retries = Counter('aiya_dream_retries_total', 'Dreams queued again after they failed.')
+admission_rejections = Counter('aiya_admission_rejections_total', 'Requests that were not queued, by reason.')
+cache_hits = Counter('aiya_cache_hits_total', 'Lookups answered from the result, upscale or caption cache, by cache.')
+cache_misses = Counter('aiya_cache_misses_total', 'Lookups the result, upscale or caption cache could not answer, by cache.')
+upload_seconds = Histogram('aiya_upload_seconds', 'Time from handing results to the upload queue until they are posted, including waiting on earlier uploads.')
+upload_retries = Counter('aiya_upload_retries_total', 'Uploads tried again after a connection error.')
+write_drops = Counter('aiya_write_drops_total', 'Items dropped because the write-behind thread fell behind, by writer.')
+upload_failures = Counter('aiya_upload_failures_total', 'Uploads that were given up on.')
@@ -1,14 +1,14 @@
+import aiohttp
 import os
 import base64
-import contextlib
 import discord
 import io
+import json
 import random
 import requests
 import time
 import traceback
 import asyncio
-import threading
 from urllib.parse import quote
 from difflib import SequenceMatcher
 from PIL import Image, PngImagePlugin
@@ -18,6 +18,7 @@ from discord.ext import commands
 from typing import Optional
 
 from core import utility
+from core import encoder
 from core import queuehandler
 from core import settings
 from core import viewhandler
@@ -209,6 +210,8 @@ class Minigame:
                 ephemeral = True
             else:
                 content += f' Queue: ``{queue_length}``'
+                queue_eta = queuehandler.dream_queue.get_queue_eta(int(settings.read(self.guild)['priority']) + 1)
+                if queue_eta != None: content += f' - ETA: ``{utility.format_duration(queue_eta)}``'
 
         except Exception as e:
             if content == None:
@@ -415,7 +418,8 @@ class Minigame:
         random_line.replace('\n', '')
         return random_line.strip()
 
-    def dream(self, queue_object: utility.DrawObject, web_ui: utility.WebUI, queue_continue: threading.Event):
+    async def dream(self, queue_object: utility.DrawObject, web_ui: utility.WebUI, queue_continue: asyncio.Event):
+        loop = asyncio.get_running_loop()
         user = utility.get_user(queue_object.ctx)
 
         try:
@@ -427,32 +431,23 @@ class Minigame:
                 ))
                 return
 
-            # get webui session
-            s = web_ui.get_session()
-            if s == None:
-                # no session, return the object to the queue handler to try again
+            if web_ui.online == False:
+                # webui went offline, return the object to the queue handler to try again
                 queuehandler.dream_queue.process_dream(queue_object, 0, False)
                 return
 
-            # construct a payload for data model
+            # switch data model
             if queue_object.data_model:
-                model_payload = {
-                    'sd_model_checkpoint': queue_object.data_model
-                }
-                s.post(url=f'{web_ui.url}/sdapi/v1/options', json=model_payload, timeout=120)
+                queue_object.switch_time = await web_ui.switch_model(queue_object.data_model)
+                queue_object.trace_stage('switched')
 
             # safe for global queue to continue
-            def continue_queue():
-                time.sleep(0.1)
-                queue_continue.set()
-            threading.Thread(target=continue_queue, daemon=True).start()
+            loop.call_later(0.1, queue_continue.set)
 
             if self.adventure and queue_object.init_url:
                 # workaround for batched init_images payload not working correctly on AUTOMATIC1111
                 images: list[str] = queue_object.payload['init_images']
                 payloads: list[dict] = []
-                threads: list[threading.Thread] = []
-                responses: list[requests.Response] = []
 
                 queue_object.payload['init_images'] = []
 
@@ -463,32 +458,13 @@ class Minigame:
                     new_payload['seed'] = int(new_payload['seed']) + index
                     new_payload['n_iter'] = 1
                     payloads.append(new_payload)
-                    responses.append(None)
-
-                def img2img(thread_index, thread_payload):
-                    try:
-                        responses[thread_index] = s.post(url=f'{web_ui.url}/sdapi/v1/img2img', json=thread_payload, timeout=120)
-                    except Exception as e:
-                        responses[thread_index] = e
-
-                for index, payload in enumerate(payloads):
-                    thread = threading.Thread(target=img2img, args=[index, payload], daemon=True)
-                    threads.append(thread)
 
-                for thread in threads:
-                    thread.start()
-
-                for thread in threads:
-                    thread.join()
-
-                for response in responses:
-                    if type(response) is not requests.Response:
-                        raise response
+                responses: list[bytes] = await asyncio.gather(*[web_ui.post('/sdapi/v1/img2img', payload, 120, queue_object) for payload in payloads])
+                queue_object.trace_stage('responded')
 
-                response: requests.Response = None
                 response_data = None
                 for response_fragment in responses:
-                    response_fragment_data = response_fragment.json()
+                    response_fragment_data = await loop.run_in_executor(utility.executor, json.loads, response_fragment)
                     if response_data == None:
                         response_data = response_fragment_data
                     else:
@@ -496,8 +472,12 @@ class Minigame:
                 # end of workaround
             else:
                 # do normal batched payload
-                response = s.post(url=f'{web_ui.url}/sdapi/v1/txt2img', json=queue_object.payload, timeout=120)
-                response_data = response.json()
+                response = await web_ui.post('/sdapi/v1/txt2img', queue_object.payload, 120, queue_object)
+                queue_object.trace_stage('responded')
+                response_data = await loop.run_in_executor(utility.executor, json.loads, response)
+
+            # the WebUI has responded, let go of the init images
+            queue_object.payload = None
 
             if self.running == False:
                 # minigame has ended, avoid posting another window
@@ -507,7 +487,6 @@ class Minigame:
                 ))
                 return
 
-            queue_object.payload = None
             self.game_iteration += 1
 
             def post_dream():
@@ -516,12 +495,14 @@ class Minigame:
                     keep_chars = (' ', '.', '_')
                     file_name = ''.join(c for c in queue_object.prompt if c.isalnum() or c in keep_chars).rstrip()
 
-                    # save local copy of image and prepare PIL images
-                    pil_images: list[Image.Image] = []
+                    # save local copy of image and prepare the files
+                    images: list[utility.ImageDownload] = []
                     self.images_base64 = []
                     for i, image_base64 in enumerate(response_data['images']):
-                        image = Image.open(io.BytesIO(base64.b64decode(image_base64.split(',',1)[0])))
-                        pil_images.append(image)
+                        image_data = base64.b64decode(image_base64.split(',',1)[0])
+                        image_size = utility.get_image_size(image_data)
+                        if image_size == None: image_size = Image.open(io.BytesIO(image_data)).size
+                        images.append(utility.ImageDownload(image_data, image_size[0], image_size[1]))
 
                         image_base64 = 'data:image/png;base64,' + image_base64
                         self.images_base64.append(image_base64)
@@ -532,29 +513,28 @@ class Minigame:
                                 epoch_time = int(time.time())
                                 file_path = f'{settings.global_var.dir}/{epoch_time}-{queue_object.seed}-{file_name[0:120]}-{i}.png'
 
-                                metadata = PngImagePlugin.PngInfo()
-                                metadata.add_text('parameters', response_data['info'])
-                                image.save(file_path, pnginfo=metadata)
+                                png_data = utility.add_png_text(image_data, 'parameters', response_data['info'])
+                                if png_data:
+                                    with open(file_path, 'wb') as f:
+                                        f.write(png_data)
+                                else:
+                                    metadata = PngImagePlugin.PngInfo()
+                                    metadata.add_text('parameters', response_data['info'])
+                                    Image.open(io.BytesIO(image_data)).save(file_path, pnginfo=metadata)
                                 print(f'Saved image: {file_path}')
                             except Exception as e:
                                 print(f'Unable to save image: {file_path}\n{traceback.print_exc()}')
                         else:
                             print(f'Received image: {int(time.time())}-{queue_object.seed}-{file_name[0:120]}-{i}.png')
 
-                    # post to discord
-                    with contextlib.ExitStack() as stack:
-                        buffer_handles = [stack.enter_context(io.BytesIO()) for _ in pil_images]
-
-                        for (pil_image, buffer) in zip(pil_images, buffer_handles):
-                            pil_image.save(buffer, 'PNG')
-                            buffer.seek(0)
-
-                        files = [discord.File(fp=buffer, filename=f'{queue_object.seed}-{i}.png') for (i, buffer) in enumerate(buffer_handles)]
-                        queuehandler.upload_queue.process_upload(utility.UploadObject(queue_object=queue_object,
-                            content=f'<@{user.id}> {queue_object.message}', files=files, view=queue_object.view
-                        ))
-                        queue_object.view = None
-                        self.image_count += queue_object.batch
+                    # post to discord, fitting the images in the upload limit of the guild
+                    encoded_images = encoder.encode_images(images, encoder.get_upload_limit(queue_object.ctx))
+                    files = [discord.File(fp=io.BytesIO(image.data), filename=f'{queue_object.seed}-{i}{extension}') for (i, (image, extension)) in enumerate(encoded_images)]
+                    queuehandler.upload_queue.process_upload(utility.UploadObject(queue_object=queue_object,
+                        content=f'<@{user.id}> {queue_object.message}', files=files, view=queue_object.view
+                    ))
+                    queue_object.view = None
+                    self.image_count += queue_object.batch
 
                 except Exception as e:
                     self.view = self.view_last # allow user to use previous view
@@ -562,11 +542,11 @@ class Minigame:
                     print(content + f'\n{traceback.print_exc()}')
                     queuehandler.upload_queue.process_upload(utility.UploadObject(queue_object=queue_object, content=content, delete_after=30))
 
-            threading.Thread(target=post_dream, daemon=True).start()
+            loop.run_in_executor(utility.executor, post_dream)
 
-        except requests.exceptions.RequestException as e:
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             # connection error, return items to queue
-            time.sleep(5.0)
+            await asyncio.sleep(5.0)
             web_ui.reconnect()
             queuehandler.dream_queue.process_dream(queue_object, 0, False)
             return
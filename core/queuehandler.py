@@ -1,12 +1,20 @@
 import time
 import asyncio
+import aiohttp
+import collections
+import heapq
+import itertools
+import json
 import discord
 import traceback
 import threading
-import requests
 
 from core import utility
 from core import settings
+from core import costmodel
+from core import resultcache
+from core import metrics
+from core import tracing
 
 
 # any command that needs to wait on processing should use the dream thread
@@ -14,12 +22,20 @@ class DreamQueueInstance:
     def __init__(self, web_ui: utility.WebUI):
         self.web_ui = web_ui
 
-        self.dream_thread = threading.Thread()
+        # guards the queues below. the dream task runs on the event loop and is woken by queue_event when they change
+        self.lock = threading.Lock()
+        self.queue_event = asyncio.Event()
+        self.dream_task_running = False
         self.queue_inprogress: list[utility.DreamObject] = []
-        self.queue: list[utility.DreamObject] = []
+        self.queue: collections.deque[utility.DreamObject] = collections.deque()
 
         self.last_data_model: str = None
 
+        # fitted from measured dream times, used to predict when dreams finish
+        self.cost_model = costmodel.get_cost_model(web_ui.url)
+        self.busy_start = 0.0
+        self.last_dream_end = 0.0
+
         self.no_dream = False
         self.no_identify = False
         self.no_upscale = False
@@ -33,91 +49,205 @@ class DreamQueueInstance:
             try: self.wait_for = int(web_ui.flags['--wait-for'])
             except: self.wait_for = web_ui.flags['--wait-for']
 
-    def process_dream(self, queue_object: utility.DreamObject):
-        # append dream to queue
-        self.queue.append(queue_object)
+        # let the global queue know when this instance can take dreams again
+        web_ui.online_callback = self.web_ui_online
 
-        if type(queue_object) is utility.DrawObject:
-            self.last_data_model = queue_object.data_model
+    def web_ui_online(self):
+        dream_queue.wake()
 
-        # start dream queue thread
-        if self.dream_thread.is_alive() == False:
-            self.dream_thread = threading.Thread(target=self.process_queue, daemon=True)
-            self.dream_thread.start()
+    def process_dream(self, queue_object: utility.DreamObject):
+        with self.lock:
+            if len(self.queue) == 0 and len(self.queue_inprogress) == 0:
+                self.busy_start = time.time()
+
+            # append dream to queue
+            self.queue.append(queue_object)
+            metrics.dream_queue_seconds.observe(time.time() - queue_object.queue_time)
+            queue_object.trace_stage('dispatched')
+
+            if type(queue_object) is utility.DrawObject:
+                self.last_data_model = queue_object.data_model
+
+            # start dream queue task, or wake it up if it is already running
+            if self.dream_task_running == False:
+                self.dream_task_running = True
+                asyncio.run_coroutine_threadsafe(self.process_queue(), dream_queue.event_loop)
+            else:
+                dream_queue.event_loop.call_soon_threadsafe(self.queue_event.set)
 
-    def process_queue(self):
-        active_thread = threading.Thread()
-        buffer_thread = threading.Thread()
-
-        while self.queue or self.queue_inprogress:
-            if len(self.queue) == 0:
-                # potential fix for rare case where queue gets stuck
-                if active_thread.is_alive():
-                    active_thread.join()
-                if buffer_thread.is_alive():
-                    buffer_thread.join()
+    async def process_queue(self):
+        loop = asyncio.get_running_loop()
+        dream_tasks: set[asyncio.Task] = set()
+
+        while True:
+            self.queue_event.clear()
+            with self.lock:
+                queue_object: utility.DreamObject = None
+                if len(self.queue) > 0:
+                    queue_object = self.queue.popleft()
+
+                    # append queue object to in progress list
+                    self.queue_inprogress.append(queue_object)
+
+                elif len(self.queue_inprogress) == 0:
+                    self.dream_task_running = False
+                    return
+
+            # sleep until a dream is queued or an in progress dream finishes
+            if queue_object == None:
+                await self.queue_event.wait()
                 continue
 
-            queue_object = self.queue.pop(0)
             try:
-                # start next dream (older non-buffered queue)
-                # queue_object.cog.dream(queue_object)
-
-                # append queue object to in progress list
-                self.queue_inprogress.append(queue_object)
-
-                # queue up dream while the active thread is still running
-                if active_thread.is_alive() and buffer_thread.is_alive():
-                    active_thread.join()
-                    active_thread = buffer_thread
-                    buffer_thread = threading.Thread()
-                if active_thread.is_alive():
-                    buffer_thread = active_thread
-
-                active_thread_event = threading.Event()
-                active_thread = threading.Thread(target=queue_object.cog.dream, args=[queue_object, self.web_ui, active_thread_event], daemon=True)
-                active_thread.start()
-
-                # wait for active thread to complete, or event to activate (indicating it is safe to continue)
-                def wait_for_join():
-                    active_thread.join()
-                    active_thread_event.set()
-                    try:
-                        self.queue_inprogress.pop(0) # remove in progress object after completion
-                    except:
-                        pass
-                wait_thread_join = threading.Thread(target=wait_for_join, daemon=True)
-                wait_thread_join.start()
-                active_thread_event.wait()
+                # queue up dream while the active dream is still running
+                dream_tasks = set(task for task in dream_tasks if not task.done())
+                if len(dream_tasks) >= 2:
+                    await asyncio.wait(dream_tasks, return_when=asyncio.FIRST_COMPLETED)
+
+                # wait for active dream to complete, or event to activate (indicating it is safe to continue)
+                queue_continue = asyncio.Event()
+                dream_tasks.add(loop.create_task(self.run_dream(queue_object, queue_continue)))
+                await queue_continue.wait()
 
             except Exception as e:
                 print(f'Dream failure:\n{queue_object}\n{e}\n{traceback.print_exc()}')
                 # reset inprogress list in case of failure
-                if self.queue_inprogress: self.queue_inprogress = []
-
-    def clear_user_queue(self, user_id: int):
-        total_cleared: int = 0
-        index = len(self.queue)
-        while index > 0:
-            index -= 1
-            user_compare = utility.get_user(self.queue[index].ctx)
-            if user_id == user_compare.id:
-                self.queue.pop()
-                total_cleared += 1
-        return total_cleared
+                with self.lock:
+                    self.queue_inprogress = []
+
+    async def run_dream(self, queue_object: utility.DreamObject, queue_continue: asyncio.Event):
+        time_start = time.time()
+        merge_objects = get_merge_objects(queue_object)
+        kind, features = costmodel.get_features(queue_object)
+        fit_key = costmodel.get_fit_key(queue_object)
+        queue_object.trace_stage('started')
+        try:
+            await queue_object.cog.dream(queue_object, self.web_ui, queue_continue)
+        except Exception as e:
+            print(f'Dream failure:\n{queue_object}\n{e}\n{traceback.print_exc()}')
+        finally:
+            queue_continue.set()
+
+            # cogs clear the payload once the WebUI has responded. interrupted dreams say nothing about dream times
+            time_end = time.time()
+            if queue_object.payload == None and is_cancelled(queue_object) == False:
+                self.record_dream_time(queue_object, kind, features, fit_key, time_start, time_end)
+            self.last_dream_end = time_end
+
+            # remove in progress object after completion
+            next_object: utility.DreamObject = None
+            with self.lock:
+                try:
+                    self.queue_inprogress.remove(queue_object)
+                except ValueError:
+                    pass
+                if self.queue_inprogress: next_object = self.queue_inprogress[0]
+            self.queue_event.set()
+
+            # the WebUI has started on the next dream by the time this one has returned, stop it if it was cancelled
+            if next_object and is_cancelled(next_object):
+                asyncio.get_running_loop().create_task(self.web_ui.interrupt(next_object))
+
+            # this instance may be able to take another dream
+            for merge_object in merge_objects:
+                dream_queue.release_dream(merge_object)
+            dream_queue.wake()
+
+    def clear_user_queue(self, user_id: int, ctx_id: int = None):
+        cleared: list[utility.DreamObject] = []
+        total_cancelled = 0
+        interrupt_objects: list[utility.DreamObject] = []
+        with self.lock:
+            index = len(self.queue)
+            while index > 0:
+                index -= 1
+                if is_user_dream(self.queue[index], user_id, ctx_id):
+                    cancel_dream(self.queue[index])
+                    cleared.append(self.queue[index])
+                    del self.queue[index]
+
+            # dreams already sent to the WebUI, or merged into the dream of another user, are cancelled in place. the WebUI
+            # is only interrupted when no other user is waiting on the dream, and only while it is still working on it
+            for queue_object in self.queue_inprogress + list(self.queue):
+                for merge_object in get_merge_objects(queue_object):
+                    if merge_object.cancelled == False and is_user_dream(merge_object, user_id, ctx_id):
+                        cancel_dream(merge_object)
+                        total_cancelled += 1
+                        if queue_object in self.queue_inprogress and is_cancelled(queue_object): interrupt_objects.append(queue_object)
+
+        for queue_object in interrupt_objects:
+            asyncio.run_coroutine_threadsafe(self.web_ui.interrupt(queue_object), dream_queue.event_loop)
+
+        for queue_object in cleared:
+            # dreams of other users merged into this one go back to the queue
+            merge_objects = get_merge_objects(queue_object)
+            for merge_object in merge_objects:
+                if merge_object.queue_user_id != user_id:
+                    dream_queue.process_dream(merge_object, 0, False)
+            for merge_object in merge_objects:
+                dream_queue.release_dream(merge_object)
+        return len(cleared) + total_cancelled
 
     def get_user_queue_length(self, user_id):
         queue_length = 0
-        queue = self.queue + self.queue_inprogress
+        with self.lock:
+            queue = list(self.queue) + self.queue_inprogress
         for dream_object in queue:
-            user_compare = utility.get_user(dream_object.ctx)
-            if user_id == user_compare.id:
+            if user_id == dream_object.queue_user_id:
                 queue_length += 1
         return queue_length
 
     def get_queue_length(self):
         return len(self.queue_inprogress) + len(self.queue)
 
+    # the checkpoint this instance will have loaded once its queued dreams are done
+    def get_data_model(self):
+        if self.last_data_model and self.get_queue_length() > 0:
+            return self.last_data_model
+        return self.web_ui.model_loaded
+
+    # update the cost model of this instance from a completed dream
+    def record_dream_time(self, queue_object: utility.DreamObject, kind: str, features: list[float], fit_key: str, time_start: float, time_end: float):
+        # the webui runs one dream at a time, so a buffered dream only starts once the previous dream is done
+        dream_time = time_end - max(time_start + queue_object.switch_time, self.last_dream_end)
+        if dream_time <= 0.0: return
+        self.cost_model.record_dream_time(kind, features, dream_time, fit_key)
+
+    # measured seconds per unit of compute cost
+    def get_seconds_per_cost(self):
+        return self.cost_model.get_seconds_per_cost()
+
+    # predicted seconds for this instance to complete a dream
+    def get_dream_time(self, queue_object: utility.DreamObject):
+        return self.cost_model.get_dream_time(queue_object)
+
+    # predicted seconds until this instance has finished everything it has been given
+    def get_backlog_time(self):
+        with self.lock:
+            queue = self.queue_inprogress + list(self.queue)
+
+        backlog_time = 0.0
+        for index, queue_object in enumerate(queue):
+            dream_time = self.get_dream_time(queue_object)
+            if index == 0:
+                # the first dream has already been running for a while
+                dream_time = max(0.0, dream_time - (time.time() - max(self.busy_start, self.last_dream_end)))
+            backlog_time += dream_time
+        return backlog_time
+
+    # predicted seconds until a new dream would be finished on this instance
+    def get_finish_time(self, queue_object: utility.DreamObject):
+        finish_time = self.get_backlog_time() + self.get_dream_time(queue_object)
+        if type(queue_object) is utility.DrawObject and queue_object.data_model != self.get_data_model():
+            finish_time += self.get_switch_time()
+        return finish_time
+
+    # measured time for this instance to switch checkpoints, or a guess until one has been measured
+    def get_switch_time(self):
+        if self.web_ui.model_switch_time == None:
+            return 10.0
+        return self.web_ui.model_switch_time
+
     def is_valid(self, queue_object: utility.DreamObject):
         # check if webui is online
         if self.web_ui.online == False:
@@ -156,13 +286,13 @@ class DreamQueueInstance:
         # check if we need to wait for any webui instances to finish
         if type(self.wait_for) is DreamQueueInstance:
             dream_instance = self.wait_for
-            if dream_instance.dream_thread.is_alive() or dream_instance.get_queue_length() > 0:
+            if dream_instance.dream_task_running or dream_instance.get_queue_length() > 0:
                 return False
 
         # convert URL_ID to dream queue instance using index
         elif type(self.wait_for) is int and self.wait_for >= 0 and self.wait_for <= len(dream_queue.dream_instances) - 1:
             self.wait_for = dream_queue.dream_instances[self.wait_for] # convert wait_for to a direct reference of a dream queue instance
-            if self.wait_for.dream_thread.is_alive() or self.wait_for.get_queue_length() > 0:
+            if self.wait_for.dream_task_running or self.wait_for.get_queue_length() > 0:
                 return False
 
         # convert URL_ID to dream queue instance using URL string
@@ -170,156 +300,511 @@ class DreamQueueInstance:
             for dream_instance in dream_queue.dream_instances:
                 if dream_instance.web_ui.url == self.wait_for:
                     self.wait_for = dream_instance # convert wait_for to a direct reference of a dream queue instance
-                    if self.wait_for.dream_thread.is_alive() or self.wait_for.get_queue_length() > 0:
+                    if self.wait_for.dream_task_running or self.wait_for.get_queue_length() > 0:
                         return False
                     break
 
         return True
 
+# a dream waiting in the fair queue
+class FairQueueEntry:
+    def __init__(self, queue_object: utility.DreamObject, priority: int, cost: float, sequence: int, user_flow):
+        self.queue_object = queue_object
+        self.priority = priority
+        self.cost = cost
+        self.sequence = sequence
+        self.user_flow: FairQueueFlow = user_flow
+        self.removed = False
+
+# a guild or a user in the fair queue. guild flows hold user flows, user flows hold dreams
+class FairQueueFlow:
+    def __init__(self, name: str | int, parent = None, weight: float = 1.0):
+        self.name = name
+        self.parent: FairQueueFlow = parent
+        self.weight = weight
+
+        self.start_tag = 0.0 # virtual time this flow is next served at
+        self.finish_tag = 0.0 # virtual time after the last dream served from this flow
+        self.virtual_time = 0.0 # virtual time of the user flows inside a guild flow
+
+        self.heap: list = []
+        self.flows: dict[str | int, FairQueueFlow] = {}
+        self.length = 0
+
+        # key of this flow in the parent heap. heap items with an older version are stale
+        self.key: float = None
+        self.version = 0
+
+# hierarchical weighted fair queue (guild -> user -> dream) using start-time fair queueing
+# each guild is served in turn by the compute cost of its dreams, then each user inside that guild.
+# the dream priority is added to the flow key as a handicap of priority_step compute per level,
+# so lower priority dreams are only passed over for a bounded amount of service and will age to the front.
+# expensive dreams do not wait longer than cheap ones, their cost only delays the next dream of that user.
+class FairQueue:
+    def __init__(self, priorities: int = 10, priority_step: float = 2.0):
+        self.priority_step = priority_step
+        self.virtual_time = 0.0
+        self.heap: list = []
+        self.guilds: dict[str, FairQueueFlow] = {}
+        self.sequence = itertools.count()
+        self.length = 0
+        self.priority_lengths: list[int] = [0] * priorities
+        self.priority_costs: list[float] = [0.0] * priorities
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for guild_flow in list(self.guilds.values()):
+            for user_flow in list(guild_flow.flows.values()):
+                for (priority, sequence, entry) in list(user_flow.heap):
+                    if not entry.removed:
+                        yield entry
+
+    # add a dream to the queue - O(log n)
+    def push(self, queue_object: utility.DreamObject, priority: int, cost: float, guild: str, user: int):
+        guild_flow = self.guilds.get(guild)
+        if guild_flow == None:
+            guild_flow = FairQueueFlow(guild)
+            self.guilds[guild] = guild_flow
+
+        user_flow = guild_flow.flows.get(user)
+        if user_flow == None:
+            user_flow = FairQueueFlow(user, guild_flow)
+            guild_flow.flows[user] = user_flow
+
+        # idle flows restart at the current virtual time, so they cannot save up service while idle
+        if guild_flow.length == 0:
+            guild_flow.start_tag = max(self.virtual_time, guild_flow.finish_tag)
+        if user_flow.length == 0:
+            user_flow.start_tag = max(guild_flow.virtual_time, user_flow.finish_tag)
+
+        entry = FairQueueEntry(queue_object, priority, cost, next(self.sequence), user_flow)
+        heapq.heappush(user_flow.heap, (priority, entry.sequence, entry))
+        user_flow.length += 1
+        guild_flow.length += 1
+        self.length += 1
+        self.priority_lengths[priority] += 1
+        self.priority_costs[priority] += cost
+
+        self.update_flow(user_flow)
+        self.update_flow(guild_flow)
+        return entry
+
+    # remove a dream from the queue. served dreams are charged to their user and guild - O(log n)
+    def remove(self, entry: FairQueueEntry, served: bool = False):
+        if entry.removed: return
+        entry.removed = True
+
+        user_flow = entry.user_flow
+        guild_flow = user_flow.parent
+        user_flow.length -= 1
+        guild_flow.length -= 1
+        self.length -= 1
+        self.priority_lengths[entry.priority] -= 1
+        self.priority_costs[entry.priority] = max(0.0, self.priority_costs[entry.priority] - entry.cost)
+
+        if served:
+            # virtual time follows the start tag of the flow being served
+            guild_flow.virtual_time = max(guild_flow.virtual_time, user_flow.start_tag)
+            user_flow.finish_tag = user_flow.start_tag + entry.cost / user_flow.weight
+            user_flow.start_tag = user_flow.finish_tag
+
+            self.virtual_time = max(self.virtual_time, guild_flow.start_tag)
+            guild_flow.finish_tag = guild_flow.start_tag + entry.cost / guild_flow.weight
+            guild_flow.start_tag = guild_flow.finish_tag
+
+        self.update_flow(user_flow)
+        self.update_flow(guild_flow)
+
+        # forget flows once they have drained, their history no longer matters
+        if guild_flow.length == 0:
+            for flow in guild_flow.flows.values():
+                guild_flow.virtual_time = max(guild_flow.virtual_time, flow.finish_tag)
+            guild_flow.flows = {}
+            guild_flow.heap = []
+        if self.length == 0:
+            self.priority_costs = [0.0] * len(self.priority_costs)
+            for flow in self.guilds.values():
+                self.virtual_time = max(self.virtual_time, flow.finish_tag)
+            self.guilds = {}
+            self.heap = []
+
+    # remove all dreams from a user, returns the removed entries
+    def remove_user(self, user: int, accept = None):
+        removed: list[FairQueueEntry] = []
+        for guild_flow in list(self.guilds.values()):
+            user_flow = guild_flow.flows.get(user)
+            if user_flow == None: continue
+            for (priority, sequence, entry) in list(user_flow.heap):
+                if not entry.removed and (accept == None or accept(entry.queue_object)):
+                    removed.append(entry)
+                    self.remove(entry)
+        return removed
+
+    # find dreams in fair order, at most one per user. accept is called on each dream to check if it can start
+    def find(self, accept, limit: int = 1):
+        found: list[FairQueueEntry] = []
+
+        # walk the heaps by popping them, then push everything back so the queue is left unchanged
+        guild_items = []
+        while self.heap and len(found) < limit:
+            guild_item = heapq.heappop(self.heap)
+            guild_flow: FairQueueFlow = guild_item[3]
+            if guild_item[2] != guild_flow.version: continue # drop stale item
+            guild_items.append(guild_item)
+
+            user_items = []
+            while guild_flow.heap and len(found) < limit:
+                user_item = heapq.heappop(guild_flow.heap)
+                user_flow: FairQueueFlow = user_item[3]
+                if user_item[2] != user_flow.version: continue # drop stale item
+                user_items.append(user_item)
+
+                entry_items = []
+                while user_flow.heap:
+                    entry_item = heapq.heappop(user_flow.heap)
+                    entry: FairQueueEntry = entry_item[2]
+                    if entry.removed: continue # drop stale item
+                    entry_items.append(entry_item)
+                    if accept(entry):
+                        found.append(entry)
+                        break
+
+                for entry_item in entry_items: heapq.heappush(user_flow.heap, entry_item)
+            for user_item in user_items: heapq.heappush(guild_flow.heap, user_item)
+        for guild_item in guild_items: heapq.heappush(self.heap, guild_item)
+
+        return found
+
+    # get the number of dreams waiting at this priority or better
+    def get_length(self, priority: int = None):
+        if priority == None: return self.length
+        return sum(self.priority_lengths[:priority + 1])
+
+    # get the compute cost of dreams waiting at this priority or better
+    def get_cost(self, priority: int = None):
+        if priority == None: return sum(self.priority_costs)
+        return sum(self.priority_costs[:priority + 1])
+
+    # re-key a flow in its parent heap after its start tag or head dream changed
+    def update_flow(self, flow: FairQueueFlow):
+        if flow.parent:
+            parent_heap = flow.parent.heap
+
+            # drop removed dreams from the top of the heap
+            while flow.heap and flow.heap[0][2].removed:
+                heapq.heappop(flow.heap)
+            head_priority = flow.heap[0][0] if flow.heap else None
+        else:
+            parent_heap = self.heap
+
+            # drop stale user flows from the top of the heap
+            while flow.heap and flow.heap[0][2] != flow.heap[0][3].version:
+                heapq.heappop(flow.heap)
+            head_priority = flow.heap[0][4] if flow.heap else None
+
+        if head_priority == None:
+            # flow is idle, invalidate it in the parent heap
+            flow.key = None
+            flow.version += 1
+            return
+
+        key = flow.start_tag + head_priority * self.priority_step
+        if key != flow.key:
+            flow.key = key
+            flow.version += 1
+            heapq.heappush(parent_heap, (key, next(self.sequence), flow.version, flow, head_priority))
+
+
 # queue handler for dreams
 class DreamQueue:
     def __init__(self):
         self.dream_instances: list[DreamQueueInstance] = []
+
+        # dreams run on the event loop of the bot
+        self.event_loop = asyncio.get_event_loop()
+
+        # guards the queues below, and wakes the dream thread when there may be work to dispatch
+        self.condition = threading.Condition()
         self.dream_thread = threading.Thread()
+        self.dream_thread_running = False
+
+        # fair queue for dreams, with priorities ranging from 0 to 9
+        self.priorities = 10
+        self.queue = FairQueue(self.priorities)
 
-        # a separate list of queues sorted by their priority, ranging from 0 to 9
-        self.queues: list[list[utility.DreamObject]] = []
-        for i in range(10):
-            self.queues.append([])
+        # checkpoint affinity - how many users ahead to look for dreams that can use an already loaded checkpoint,
+        # and how long a dream can be passed over for them (limited to a multiple of the checkpoint switch time)
+        self.affinity_lookahead = 8
+        self.affinity_switch_factor = 2.0
+        self.affinity_max_wait = 60.0
+
+        # number and compute cost of queued or in progress dreams for each user
+        self.user_lengths: dict[int, int] = {}
+        self.user_costs: dict[int, float] = {}
+
+        # how long the dream thread may sleep before it has to look at the queue again, used when holding dreams to merge
+        self.dispatch_timeout: float = None
 
     def setup(self):
-        self.dream_instances = []
-        for web_ui in settings.global_var.web_ui:
-            self.dream_instances.append(DreamQueueInstance(web_ui))
+        with self.condition:
+            self.dream_instances = []
+            for web_ui in settings.global_var.web_ui:
+                self.dream_instances.append(DreamQueueInstance(web_ui))
+            self.condition.notify_all()
+
+    # wake the dream thread, used when a dream is queued or when an instance finishes or comes online
+    def wake(self):
+        with self.condition:
+            self.condition.notify_all()
 
     def process_dream(self, queue_object: utility.DreamObject, priority: int = 4, extended = True):
-        priority = max(0, min(len(self.queues) - 1, priority))
+        priority = max(0, min(self.priorities - 1, priority))
+
+        # dreams that were merged together are queued separately again
+        if type(queue_object) is utility.DrawObject and queue_object.merge_objects:
+            merge_objects = queue_object.merge_objects
+            queue_object.merge_objects = None
+            for merge_object in merge_objects[1:]:
+                self.process_dream(merge_object, priority, False)
 
         # reject dream if it has been through the dream process too many times
         queue_object.dream_attempts += 1
+        if queue_object.dream_attempts > 1: metrics.dream_retries.inc()
         if queue_object.dream_attempts > 3:
             user = utility.get_user(queue_object.ctx)
             content = f'<@{user.id}> Something went wrong.'
             upload_queue.process_upload(utility.UploadObject(queue_object=queue_object, content=content, delete_after=30))
 
-        if extended:
-            valid_instances = self.get_valid_instances(queue_object)
-            if len(valid_instances) == 0:
-                print(f'Dream Rejected: No valid instances.')
-                return None
+        with self.condition:
+            if extended:
+                valid_instances = self.get_valid_instances(queue_object)
+                if len(valid_instances) == 0:
+                    print(f'Dream Rejected: No valid instances.')
+                    metrics.admission_rejections.inc(reason='no_instance')
+                    self.reject_flight(queue_object)
+                    return None
 
-            # get queue length
-            queue_length = self.get_queue_length(priority)
+                # get queue length
+                queue_length = self.get_queue_length(priority)
 
-            print(f'Dream Priority: {priority} - Queue: {queue_length}')
+                print(f'Dream Priority: {priority} - Queue: {queue_length}')
 
-        # append dream to queue
-        if type(priority) is int:
-            self.queues[priority].append(queue_object)
+            # append dream to queue
+            queue_object.queue_time = time.time()
+            queue_object.trace_stage('queued' if extended else 'requeued')
+            self.track_dream(queue_object)
+            self.queue.push(queue_object, priority, queue_object.queue_cost, utility.get_guild(queue_object.ctx), queue_object.queue_user_id)
 
-        # start dream queue thread
-        if self.dream_thread.is_alive() == False:
-            self.dream_thread = threading.Thread(target=self.process_queue, daemon=True)
-            self.dream_thread.start()
+            self.condition.notify_all()
+
+            # start dream queue thread
+            if self.dream_thread_running == False:
+                self.dream_thread_running = True
+                self.dream_thread = threading.Thread(target=self.process_queue, daemon=True)
+                self.dream_thread.start()
 
         if extended:
             return queue_length
 
     def process_queue(self):
-        priority_index = 0
-        queue_index = 0
-        items_skipped = 0
+        with self.condition:
+            while True:
+                self.dispatch_timeout = None
+                if self.dispatch_dream():
+                    continue
 
-        while True:
-            if priority_index >= len(self.queues):
-                if items_skipped:
-                    priority_index = 0
-                    items_skipped = 0
-                else:
-                    break
+                # stop once the queue is empty
+                if len(self.queue) == 0:
+                    self.dream_thread_running = False
+                    return
 
-            queue = self.queues[priority_index]
-            if queue:
-                if queue_index >= len(queue):
-                    time.sleep(0.1)
-                    queue_index = 0
-                queue_object = queue[queue_index]
-                try:
-                    # Pick appropiate dream instance
-                    target_dream_instance: DreamQueueInstance = None
-
-                    # check if any instance is valid for queue
-                    valid_instances: list[DreamQueueInstance] = self.get_valid_instances(queue_object)
-                    if len(valid_instances) == 0:
-                        # no available instance - remove the object from queue
-                        queue.pop(queue_index)
-                        queue_index = 0
-                        user = utility.get_user(queue_object.ctx)
-                        content = f'<@{user.id}> ``{queue_object.message}``\nSorry, I cannot handle this request right now.'
-                        upload_queue.process_upload(utility.UploadObject(queue_object=queue_object, content=content, ephemeral=True, delete_after=30))
-
-                    else:
-                        # start dream on any available optimal webui instance
-                        if type(queue_object) is utility.DrawObject:
-                            for dream_instance in valid_instances:
-                                if dream_instance.is_ready(1) and queue_object.data_model == dream_instance.last_data_model:
-                                    target_dream_instance = dream_instance
-                                    break
-
-                        # all optimal instances busy, buffer dream on current optimal instances
-                        if type(queue_object) is utility.DrawObject and target_dream_instance == None:
-                            for dream_instance in valid_instances:
-                                if dream_instance.is_ready(2) and queue_object.data_model == dream_instance.last_data_model:
-                                    target_dream_instance = dream_instance
-                                    break
-
-                        # start dream on any available webui instance
-                        if target_dream_instance == None:
-                            for dream_instance in valid_instances:
-                                if dream_instance.is_ready(1):
-                                    target_dream_instance = dream_instance
-                                    break
-
-                        # all instances busy, buffer dream on current instances
-                        if target_dream_instance == None:
-                            for dream_instance in valid_instances:
-                                if dream_instance.is_ready(2):
-                                    target_dream_instance = dream_instance
-                                    break
-
-                        if target_dream_instance == None:
-                            # no instance is suitable, try next item in line
-                            queue_index += 1
-                            items_skipped += 1
-                        else:
-                            # start the dream in the instance
-                            queue.pop(queue_index)
-                            queue_index = 0
-                            target_dream_instance.process_dream(queue_object)
-
-                except Exception as e:
-                    print(f'Dream failure:\n{queue_object}\n{e}\n{traceback.print_exc()}')
-
-                priority_index = 0
-            else:
-                priority_index += 1
+                # nothing can be dispatched right now, sleep until something changes
+                self.condition.wait(self.dispatch_timeout)
+
+    # start the first queued dream in fair order that has a ready instance. returns True if the queue changed
+    def dispatch_dream(self):
+        # skip looking through the queue when every instance is busy
+        if not any(dream_instance.is_ready(2) for dream_instance in self.dream_instances):
+            return False
+
+        rejected: list[FairQueueEntry] = []
+        failed: list[FairQueueEntry] = []
+        targets: dict[FairQueueEntry, DreamQueueInstance] = {}
+
+        # dreams held back to wait for more dreams to merge with them
+        held: set[FairQueueEntry] = set()
+
+        def accept(entry: FairQueueEntry):
+            if entry in held or entry in rejected or entry in failed: return False
+            queue_object = entry.queue_object
+            try:
+                # check if any instance is valid for queue
+                valid_instances: list[DreamQueueInstance] = self.get_valid_instances(queue_object)
+                if len(valid_instances) == 0:
+                    rejected.append(entry)
+                    return False
+
+                # pick appropiate dream instance
+                target_dream_instance = self.get_target_instance(queue_object, valid_instances)
+                if target_dream_instance == None:
+                    # no instance is suitable, try next item in line
+                    return False
+
+                targets[entry] = target_dream_instance
+                return True
+
+            except Exception as e:
+                print(f'Dream failure:\n{queue_object}\n{e}\n{traceback.print_exc()}')
+                failed.append(entry)
+                return False
 
-    def clear_user_queue(self, user_id: int):
+        while True:
+            found = self.queue.find(accept, self.affinity_lookahead)
+            if found: found = [self.get_affinity_entry(found, targets)]
+
+            # merge compatible dreams into the one being started
+            merged: list[FairQueueEntry] = []
+            if found:
+                merged = self.get_merge_entries(found[0], targets[found[0]])
+                if merged == None:
+                    # hold the dream back for a moment, more dreams to merge may show up. the dreams behind it
+                    # can still start in the meantime
+                    held.add(found[0])
+                    continue
+            break
+
+        # no available instance - remove the object from queue
+        for entry in rejected:
+            self.queue.remove(entry)
+            queue_object = entry.queue_object
+            self.release_dream(queue_object)
+            user = utility.get_user(queue_object.ctx)
+            content = f'<@{user.id}> ``{queue_object.message}``\nSorry, I cannot handle this request right now.'
+            upload_queue.process_upload(utility.UploadObject(queue_object=queue_object, content=content, ephemeral=True, delete_after=30))
+
+        for entry in failed:
+            self.queue.remove(entry)
+            self.release_dream(entry.queue_object)
+
+        # start the dream in the instance
+        for entry in found:
+            self.queue.remove(entry, True)
+            if merged:
+                entry.queue_object.merge_objects = [entry.queue_object]
+                for merge_entry in merged:
+                    self.queue.remove(merge_entry, True)
+                    entry.queue_object.merge_objects.append(merge_entry.queue_object)
+                print(f'Dream Merged: {len(entry.queue_object.merge_objects)} dreams')
+            targets[entry].process_dream(entry.queue_object)
+
+        return bool(found or rejected or failed)
+
+    # group dreams by checkpoint - when the next dream in line needs its instance to switch checkpoints,
+    # start a dream further ahead that uses the checkpoint that is already loaded. the dream in line is passed over
+    # for at most a few checkpoint switches worth of time, after which it starts regardless.
+    def get_affinity_entry(self, entries: list[FairQueueEntry], targets: dict[FairQueueEntry, DreamQueueInstance]):
+        entry = entries[0]
+        queue_object = entry.queue_object
+        if type(queue_object) is not utility.DrawObject: return entry
+
+        target_dream_instance = targets[entry]
+        data_model = target_dream_instance.get_data_model()
+        if data_model == None or data_model == queue_object.data_model: return entry
+
+        for other_entry in entries[1:]:
+            other_object = other_entry.queue_object
+            if type(other_object) is not utility.DrawObject: continue
+            if other_object.data_model != data_model or not target_dream_instance.is_valid(other_object): continue
+
+            max_wait = min(self.affinity_max_wait, target_dream_instance.get_switch_time() * self.affinity_switch_factor)
+            if queue_object.affinity_passed == None:
+                queue_object.affinity_passed = time.time()
+            elif time.time() - queue_object.affinity_passed > max_wait:
+                return entry
+
+            targets[other_entry] = target_dream_instance
+            return other_entry
+
+        return entry
+
+    # merge txt2img dreams that only differ in prompt and seed into one request, which the instance runs with the
+    # prompts from file script. the dream waits up to merge_window seconds for more dreams to merge.
+    # returns the entries to merge, or None if the dream should be held back
+    def get_merge_entries(self, entry: FairQueueEntry, target_dream_instance: DreamQueueInstance):
+        merge_window = settings.global_var.merge_window
+        merge_size = settings.global_var.merge_size
+        if merge_window <= 0.0 or merge_size <= 1: return []
+        if target_dream_instance.web_ui.prompts_script_args == None: return []
+
+        merge_key = self.get_merge_key(entry.queue_object)
+        if merge_key == None: return []
+
+        def accept(other_entry: FairQueueEntry):
+            if other_entry is entry: return False
+            if self.get_merge_key(other_entry.queue_object) != merge_key: return False
+            return target_dream_instance.is_valid(other_entry.queue_object)
+
+        merged = self.queue.find(accept, merge_size - 1)
+        wait = entry.queue_object.queue_time + merge_window - time.time()
+        if len(merged) < merge_size - 1 and wait > 0.0:
+            if self.dispatch_timeout == None or wait < self.dispatch_timeout:
+                self.dispatch_timeout = wait
+            return None
+        return merged
+
+    # dreams with the same merge key can be made in the same request. only cogs that split the images of a merged
+    # request between its dreams can have their dreams merged
+    def get_merge_key(self, queue_object: utility.DreamObject):
+        if type(queue_object) is not utility.DrawObject: return None
+        if getattr(queue_object.cog, 'merge_dreams', False) == False: return None
+        if queue_object.init_url or queue_object.batch_objects or queue_object.merge_objects: return None
+
+        payload: dict = queue_object.payload
+        if payload == None or 'script_name' in payload or 'hr_prompt' in payload or 'hr_negative_prompt' in payload: return None
+
+        payload = dict(payload)
+        del payload['prompt']
+        del payload['negative_prompt']
+        del payload['seed']
+        return (queue_object.data_model, json.dumps(payload, sort_keys=True))
+
+    # route the dream to the instance predicted to finish it first. if that instance cannot take more dreams yet,
+    # the dream waits for it rather than going to a slower instance
+    def get_target_instance(self, queue_object: utility.DreamObject, valid_instances: list[DreamQueueInstance]):
+        target_dream_instance: DreamQueueInstance = None
+        target_finish_time = 0.0
+        for dream_instance in valid_instances:
+            finish_time = dream_instance.get_finish_time(queue_object)
+            if target_dream_instance == None or finish_time < target_finish_time:
+                target_dream_instance = dream_instance
+                target_finish_time = finish_time
+
+        if target_dream_instance != None and target_dream_instance.is_ready(2):
+            return target_dream_instance
+        return None
+
+    # cancel the dreams of a user, or only the dreams of the command with ctx_id if one is given
+    def clear_user_queue(self, user_id: int, ctx_id: int = None):
         total_cleared: int = 0
 
-        # clear from global dream queue
-        for queue in self.queues:
-            index = len(queue)
-            while index > 0:
-                index -= 1
-                user_compare = utility.get_user(queue[index].ctx)
-                if user_id == user_compare.id:
-                    queue.pop()
-                    total_cleared += 1
+        with self.condition:
+            # clear dreams waiting on an identical dream
+            for queue_object in resultcache.result_cache.remove_followers(lambda queue_object: is_user_dream(queue_object, user_id, ctx_id)):
+                cancel_dream(queue_object)
+                self.release_dream(queue_object)
+                total_cleared += 1
 
-        # clear from all dream queue instances
+            # clear from global dream queue
+            for entry in self.queue.remove_user(user_id, lambda queue_object: is_user_dream(queue_object, user_id, ctx_id)):
+                cancel_dream(entry.queue_object)
+                self.release_dream(entry.queue_object)
+                total_cleared += 1
+
+        # clear from all dream queue instances, including dreams in progress
         for dream_instance in self.dream_instances:
-            total_cleared += dream_instance.clear_user_queue(user_id)
+            total_cleared += dream_instance.clear_user_queue(user_id, ctx_id)
 
         return total_cleared
 
@@ -341,18 +826,12 @@ class DreamQueue:
         return valid_instances
 
     def get_queue_length(self, priority: int = None):
-        queue_index = 0
-        queue_length = 0
-
-        if priority == None:
-            priority = len(self.queues) - 1
-        else:
-            priority = max(0, min(len(self.queues) - 1, priority))
+        if priority != None:
+            priority = max(0, min(self.priorities - 1, priority))
 
         # get length of global dream queue
-        while queue_index <= priority:
-            queue_length += len(self.queues[queue_index])
-            queue_index += 1
+        with self.condition:
+            queue_length = self.queue.get_length(priority)
 
         # get length of all dream isntances
         for dream_instance in self.dream_instances:
@@ -360,122 +839,212 @@ class DreamQueue:
 
         return queue_length
 
-    def get_user_queue_cost(self, user_id: int):
-        queue_cost = 0.0
-
-        # collect queues of global dream queue
-        for index, queue in enumerate(self.queues):
-            for queue_object in queue:
-                user = utility.get_user(queue_object.ctx)
-                if user and user.id == user_id and queue_object.payload:
-                    queue_cost += self.get_dream_cost(queue_object)
+    # add a dream to the per user index. a dream returned to the queue while still in progress is only counted once
+    def track_dream(self, queue_object: utility.DreamObject):
+        with self.condition:
+            queue_object.queue_holds += 1
+            if queue_object.queue_holds > 1: return
 
-        # collect queues of all dream isntances
+            user = utility.get_user(queue_object.ctx)
+            user_id = user.id if user else None
+            queue_object.queue_user_id = user_id
+            queue_object.queue_cost = self.get_dream_cost(queue_object)
+
+            self.user_lengths[user_id] = self.user_lengths.get(user_id, 0) + 1
+            self.user_costs[user_id] = self.user_costs.get(user_id, 0.0) + queue_object.queue_cost
+
+    # remove a dream from the per user index once it is completed or cancelled
+    def release_dream(self, queue_object: utility.DreamObject):
+        with self.condition:
+            if queue_object.queue_holds <= 0: return
+            queue_object.queue_holds -= 1
+            if queue_object.queue_holds > 0: return
+
+            user_id = queue_object.queue_user_id
+            queue_length = self.user_lengths.get(user_id, 0) - 1
+            if queue_length > 0:
+                self.user_lengths[user_id] = queue_length
+                self.user_costs[user_id] = max(0.0, self.user_costs.get(user_id, 0.0) - queue_object.queue_cost)
+            else:
+                self.user_lengths.pop(user_id, None)
+                self.user_costs.pop(user_id, None)
+
+            # identical dreams waiting on this one did not get its images, so they are queued on their own
+            for follower, priority in resultcache.result_cache.land_flight(queue_object):
+                self.release_dream(follower)
+                self.process_dream(follower, priority, False)
+
+    # hold a dream back while an identical dream is queued, it gets the images of that dream once they are made
+    def join_flight(self, queue_object: utility.DrawObject, priority: int):
+        with self.condition:
+            if resultcache.result_cache.join_flight(queue_object, priority) == False:
+                return False
+            self.track_dream(queue_object)
+            return True
+
+    # end the flight of a dream that was not queued, identical dreams waiting on it are rejected as well
+    def reject_flight(self, queue_object: utility.DreamObject):
+        if type(queue_object) is not utility.DrawObject: return
+        for follower, priority in resultcache.result_cache.land_flight(queue_object):
+            self.release_dream(follower)
+            user = utility.get_user(follower.ctx)
+            content = f'<@{user.id}> ``{follower.message}``\nSorry, I cannot handle this request right now.'
+            upload_queue.process_upload(utility.UploadObject(queue_object=follower, content=content, ephemeral=True, delete_after=30))
+
+    # get the number of images of this payload that every instance can make in a single batch
+    def get_max_batch_size(self, payload: dict):
+        hr_scale = float(payload.get('hr_scale', 1.0)) if payload.get('enable_hr') else 1.0
+        img2img = 'init_images' in payload
+        max_batch_size = None
         for dream_instance in self.dream_instances:
-            queue = dream_instance.queue + dream_instance.queue_inprogress
-            for queue_object in queue:
-                user = utility.get_user(queue_object.ctx)
-                if user and user.id == user_id and queue_object.payload:
-                    queue_cost += self.get_dream_cost(queue_object)
-
-        return queue_cost
-
-    # get estimate of the compute cost of a dream
-    def get_dream_cost(self, queue_object: utility.DreamObject):
-        if type(queue_object) is utility.DrawObject:
-            dream_compute_cost_add = 0.0
-            dream_compute_cost = float(queue_object.steps) / 20.0
-            if queue_object.sampler in settings.global_var.slow_samplers: dream_compute_cost *= 2.0
-            if queue_object.highres_fix != None and queue_object.highres_fix != 'None': dream_compute_cost_add = dream_compute_cost
-            dream_compute_cost *= pow(max(1.0, float(queue_object.width * queue_object.height) / float(512 * 512)), 1.25)
-            if queue_object.init_url or (queue_object.highres_fix != None and queue_object.highres_fix != 'None'): dream_compute_cost *= max(0.2, queue_object.strength)
-            dream_compute_cost += dream_compute_cost_add
-            dream_compute_cost = max(1.0, dream_compute_cost)
-
-            # use actual batch size from payload
-            batch = queue_object.batch
-            try:
-                batch = queue_object.payload['n_iter']
-            except:
-                pass
+            if dream_instance.web_ui.online == False or dream_instance.no_dream: continue
+            batch_size = dream_instance.web_ui.get_max_batch_size(payload['width'], payload['height'], hr_scale, img2img)
+            if max_batch_size == None or batch_size < max_batch_size:
+                max_batch_size = batch_size
+        if max_batch_size == None: return 1
+        return max_batch_size
+
+    # estimate seconds until everything queued at this priority or better is done, from measured instance throughput
+    def get_queue_eta(self, priority: int = None):
+        if priority != None:
+            priority = max(0, min(self.priorities - 1, priority))
+
+        cost_rate = 0.0
+        work = 0.0
+        for dream_instance in self.dream_instances:
+            if dream_instance.web_ui.online == False: continue
+            seconds_per_cost = dream_instance.get_seconds_per_cost()
+            cost_rate += 1.0 / seconds_per_cost
+            work += dream_instance.get_backlog_time() / seconds_per_cost
+        if cost_rate == 0.0: return None
 
-            dream_compute_cost *= float(batch)
+        with self.condition:
+            work += self.queue.get_cost(priority)
+        return work / cost_rate
 
-        elif type(queue_object) is utility.UpscaleObject:
-            dream_compute_cost = 4.0
+    def get_user_queue_length(self, user_id: int):
+        return self.user_lengths.get(user_id, 0)
 
-        elif type(queue_object) is utility.IdentifyObject:
-            dream_compute_cost = 1.0
-            if queue_object.model == 'combined': dream_compute_cost *= len(settings.global_var.identify_models)
-
-        return dream_compute_cost
+    def get_user_queue_cost(self, user_id: int):
+        return self.user_costs.get(user_id, 0.0)
 
-# queue handler for uploads
+    # get estimate of the compute cost of a dream, averaged over the cost models of the online instances
+    def get_dream_cost(self, queue_object: utility.DreamObject):
+        dream_compute_cost = 0.0
+        count = 0
+        for dream_instance in self.dream_instances:
+            if dream_instance.web_ui.online == False: continue
+            dream_compute_cost += dream_instance.cost_model.get_dream_cost(queue_object)
+            count += 1
+
+        if count == 0:
+            return costmodel.prior_model.get_dream_cost(queue_object)
+        return dream_compute_cost / float(count)
+
+# get the dreams that are made together with this dream, including itself
+def get_merge_objects(queue_object: utility.DreamObject) -> list[utility.DreamObject]:
+    if type(queue_object) is utility.DrawObject and queue_object.merge_objects:
+        return queue_object.merge_objects
+    return [queue_object]
+
+# check if a dream was queued by the user, and by the command with ctx_id if one is given
+def is_user_dream(queue_object: utility.DreamObject, user_id: int, ctx_id: int = None):
+    if queue_object.queue_user_id != user_id: return False
+    return ctx_id == None or utility.get_ctx_id(queue_object.ctx) == ctx_id
+
+# mark a dream and the rest of its batch as cancelled. uploads waiting on them can go ahead, as nothing more is uploaded for them
+def cancel_dream(queue_object: utility.DreamObject):
+    cancel_objects = [queue_object]
+    if type(queue_object) is utility.DrawObject and queue_object.batch_objects:
+        cancel_objects = queue_object.batch_objects
+    for cancel_object in cancel_objects:
+        cancel_object.trace_stage('cancelled', False)
+        tracing.finish(cancel_object, 'cancelled')
+        cancel_object.cancelled = True
+        cancel_object.uploaded = True
+
+# check if nobody is waiting on the results of a dream anymore
+def is_cancelled(queue_object: utility.DreamObject):
+    for merge_object in get_merge_objects(queue_object):
+        if merge_object.cancelled == False: return False
+    return True
+
+# queue handler for uploads. uploads wait for the dream they depend on, such as the previous dream of a batch, and
+# then go to a queue for their channel. channels upload at the same time, each channel uploads in order
 class UploadQueue:
     def __init__(self):
-        self.is_uploading = False
         self.event_loop = asyncio.get_event_loop()
-        self.queue: list[utility.UploadObject] = []
 
-    # upload the image
-    def process_upload(self, queue_object: utility.UploadObject):
-        # append upload to queue
-        self.queue.append(queue_object)
-
-        # start upload queue thread
-        if self.is_uploading == False:
-            self.is_uploading = True
-            asyncio.run_coroutine_threadsafe(self.process_upload_queue(), self.event_loop)
-
-    async def process_upload_queue(self):
-        index = 0
-        while self.queue:
-            if index >= len(self.queue):
-                await asyncio.sleep(0.1)
-                index = 0
-
-            if self.queue:
-                upload_object = self.queue[index]
-            else:
-                break
-
-            try:
-                dream_wait: utility.DreamObject = upload_object.queue_object.wait_for_dream
-                if dream_wait and dream_wait.uploaded == False:
-                    # skip this object for now
-                    index += 1
-                    continue
+        # uploads waiting for a dream to be uploaded, by the id of that dream
+        self.waiting: dict[int, list[utility.UploadObject]] = {}
 
-                if upload_object.is_uploading:
-                    # skip object if it is already uploading
-                    index += 1
-                    continue
+        # uploads ready to go, by the id of their channel
+        self.channel_queues: dict[int, asyncio.Queue[utility.UploadObject]] = {}
 
-                # reject upload if it has been through the upload process too many times
-                upload_object.upload_attempts += 1
-                if upload_object.upload_attempts > 3:
-                    upload_object.queue_object.uploaded = True
-                    self.queue.remove(upload_object)
-                    continue
+        # seconds a channel queue is kept without uploads
+        self.channel_timeout = 60.0
 
-                upload_object.is_uploading = True
-                asyncio.run_coroutine_threadsafe(self.send_message(upload_object), self.event_loop)
+        utility.DreamObject.upload_listener = self.dream_uploaded
 
-            except (requests.exceptions.RequestException, asyncio.exceptions.TimeoutError) as e:
-                # connection error, return items to queue
-                print(f'Upload connection error, retrying:\n{e}\n{traceback.print_exc()}')
-                await asyncio.sleep(5.0)
+    # upload the image
+    def process_upload(self, queue_object: utility.UploadObject):
+        # drop results of cancelled dreams
+        if queue_object.queue_object.cancelled:
+            queue_object.queue_object.uploaded = True
+            tracing.finish(queue_object.queue_object, 'cancelled')
+            return
+
+        queue_object.queue_time = time.time()
+        queue_object.queue_object.trace_stage('upload_queued')
+        self.event_loop.call_soon_threadsafe(self.add_upload, queue_object)
+
+    # wait for the dream this upload depends on, or queue it right away. only runs on the event loop
+    def add_upload(self, upload_object: utility.UploadObject):
+        dream_wait: utility.DreamObject = upload_object.queue_object.wait_for_dream
+        if dream_wait and dream_wait.uploaded == False:
+            self.waiting.setdefault(id(dream_wait), []).append(upload_object)
+            return
+        self.queue_upload(upload_object)
+
+    # called from any thread when a dream is uploaded, or will not be
+    def dream_uploaded(self, queue_object: utility.DreamObject):
+        self.event_loop.call_soon_threadsafe(self.release_waiting, queue_object)
+
+    def release_waiting(self, queue_object: utility.DreamObject):
+        for upload_object in self.waiting.pop(id(queue_object), []):
+            self.queue_upload(upload_object)
+
+    def queue_upload(self, upload_object: utility.UploadObject):
+        upload_object.queue_object.trace_stage('upload_ready')
+        try:
+            channel_id = upload_object.queue_object.ctx.channel.id
+        except:
+            channel_id = None
+
+        channel_queue = self.channel_queues.get(channel_id)
+        if channel_queue == None:
+            channel_queue = asyncio.Queue()
+            self.channel_queues[channel_id] = channel_queue
+            self.event_loop.create_task(self.process_channel_queue(channel_id, channel_queue))
+        channel_queue.put_nowait(upload_object)
+
+    async def process_channel_queue(self, channel_id: int, channel_queue: asyncio.Queue):
+        while True:
+            try:
+                upload_object: utility.UploadObject = await asyncio.wait_for(channel_queue.get(), self.channel_timeout)
+            except asyncio.TimeoutError:
+                if channel_queue.empty():
+                    del self.channel_queues[channel_id]
+                    return
+                continue
 
-            except Exception as e:
-                print(f'Upload failure:\n{e}\n{traceback.print_exc()}')
+            # the dream may have been cancelled while its upload was waiting
+            if upload_object.queue_object.cancelled:
                 upload_object.queue_object.uploaded = True
-                try:
-                    self.queue.remove(upload_object)
-                except:
-                    pass
+                tracing.finish(upload_object.queue_object, 'cancelled')
+                continue
 
-            index = 0
-        self.is_uploading = False
+            await self.send_message(upload_object)
 
     # send message
     async def send_message(self, upload_object: utility.UploadObject):
@@ -512,30 +1081,63 @@ class UploadQueue:
 
             # mark as uploaded
             upload_object.queue_object.uploaded = True
+            metrics.upload_seconds.observe(time.time() - upload_object.queue_time)
+            upload_object.queue_object.trace_stage('sent')
+            tracing.finish(upload_object.queue_object, 'sent' if upload_object.files else 'replied')
+
+            # keep the uploaded images for the buttons on the message
+            if upload_object.images and message:
+                for attachment, image in zip(message.attachments, upload_object.images):
+                    utility.image_store.put(message.id, attachment.id, image)
 
             # cache command
             if type(upload_object.queue_object) is utility.DrawObject and upload_object.queue_object.write_to_cache:
                 settings.append_dream_command(message.id, upload_object.queue_object.get_command())
 
-            # remove from queue
-            self.queue.remove(upload_object)
-
-        except (requests.exceptions.RequestException, asyncio.exceptions.TimeoutError) as e:
-            # connection error, return items to queue
-            print(f'Upload connection error, retrying:\n{e}\n{traceback.print_exc()}')
-            await asyncio.sleep(5.0)
+        except (aiohttp.ClientError, asyncio.TimeoutError, discord.DiscordServerError) as e:
+            # connection error, try again later without holding up the channel
+            upload_object.upload_attempts += 1
+            if upload_object.upload_attempts < 3:
+                print(f'Upload connection error, retrying:\n{e}\n{traceback.print_exc()}')
+                metrics.upload_retries.inc()
+                self.event_loop.call_later(5.0, self.queue_upload, upload_object)
+            else:
+                print(f'Upload connection error, giving up:\n{e}\n{traceback.print_exc()}')
+                metrics.upload_failures.inc()
+                upload_object.queue_object.uploaded = True
+                tracing.finish(upload_object.queue_object, 'upload_failed')
 
         except Exception as e:
             print(f'Upload failure:\n{e}\n{traceback.print_exc()}')
+            metrics.upload_failures.inc()
             upload_object.queue_object.uploaded = True
-            try:
-                self.queue.remove(upload_object)
-            except:
-                pass
+            tracing.finish(upload_object.queue_object, 'upload_failed')
 
-        upload_object.is_uploading = False
+    # number of uploads waiting on other uploads or for their turn in their channel
+    def get_queue_length(self):
+        return sum(len(upload_objects) for upload_objects in list(self.waiting.values())) + sum(channel_queue.qsize() for channel_queue in list(self.channel_queues.values()))
 
 dream_queue = DreamQueue()
 upload_queue = UploadQueue()
 
+# gauges for the metrics endpoint, read from the queues when they are asked for
+def collect_queue_lengths():
+    with dream_queue.condition:
+        return [({'priority': str(priority)}, dream_queue.queue.priority_lengths[priority]) for priority in range(dream_queue.priorities)]
+
+def collect_instances(get_value):
+    def collect():
+        values = []
+        for dream_instance in list(dream_queue.dream_instances):
+            with dream_instance.lock:
+                values.append(({'webui': dream_instance.web_ui.url}, get_value(dream_instance)))
+        return values
+    return collect
+
+metrics.Gauge('aiya_queue_length', 'Dreams waiting in the global queue, by priority.', collect_queue_lengths)
+metrics.Gauge('aiya_webui_online', 'Whether a WebUI is online.', collect_instances(lambda dream_instance: 1.0 if dream_instance.web_ui.online else 0.0))
+metrics.Gauge('aiya_webui_queue_length', 'Dreams handed to a WebUI that it has not started yet.', collect_instances(lambda dream_instance: len(dream_instance.queue)))
+metrics.Gauge('aiya_webui_in_progress', 'Dreams a WebUI is working on.', collect_instances(lambda dream_instance: len(dream_instance.queue_inprogress)))
+metrics.Gauge('aiya_upload_queue_length', 'Uploads waiting to be posted.', lambda: [({}, upload_queue.get_queue_length())])
+
 dream_queue.setup()
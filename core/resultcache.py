@@ -0,0 +1,305 @@
+import collections
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+import traceback
+from PIL import Image
+
+from core import utility
+from core import metrics
+
+
+# results of dreams, stored on disk by a hash of everything that decides their images. dreams always have a
+# fixed seed, so sending the same dream to the same checkpoint on the same WebUI version gives the same images
+path = 'resources/result-cache'
+
+# upscaled images, by a hash of the source image and the upscale settings
+upscale_path = 'resources/upscale-cache'
+
+# captions of identified images, by a hash of the image and the interrogation model
+caption_path = 'resources/caption-cache.json'
+
+save_interval = 60.0
+
+# the parts of a dream that decide its images, dreams with the same flight key are made at the same time only once
+def get_flight_key(queue_object: utility.DrawObject):
+    if queue_object.payload == None or queue_object.merge_objects: return None
+    data = {
+        'data_model': queue_object.data_model,
+        'payload': queue_object.payload
+    }
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+# the key a dream is stored by for a webui
+def get_key(queue_object: utility.DrawObject, web_ui: utility.WebUI):
+    flight_key = get_flight_key(queue_object)
+    if flight_key == None or web_ui.version == None: return None
+
+    # dreams without a checkpoint use whatever the webui has loaded
+    data_model = queue_object.data_model or web_ui.model_loaded
+    model_hash = web_ui.model_hashes.get(data_model)
+    if data_model == None or model_hash == None: return None
+
+    data = [flight_key, data_model, model_hash, web_ui.version]
+    return hashlib.sha256(json.dumps(data).encode('utf-8')).hexdigest()
+
+# the keys of a dream for each webui that could make it
+def get_keys(queue_object: utility.DrawObject, web_uis: list[utility.WebUI]):
+    keys: list[str] = []
+    for web_ui in web_uis:
+        if web_ui.online == False: continue
+        if queue_object.data_model and queue_object.data_model not in web_ui.data_models: continue
+        key = get_key(queue_object, web_ui)
+        if key and key not in keys: keys.append(key)
+    return keys
+
+# the key an upscale is stored by, from the source image and everything that changes how it is upscaled
+def get_upscale_key(queue_object: utility.UpscaleObject, image_bytes: bytes):
+    data = [
+        hashlib.sha256(image_bytes).hexdigest(),
+        queue_object.resize,
+        queue_object.upscaler_1,
+        queue_object.upscaler_2,
+        queue_object.upscaler_2_strength,
+        queue_object.gfpgan,
+        queue_object.codeformer,
+        queue_object.upscale_first
+    ]
+    return hashlib.sha256(json.dumps(data).encode('utf-8')).hexdigest()
+
+# webui responses stored on disk, evicting the least recently used once they take more than max_size bytes
+class ResultCache:
+    def __init__(self, name: str, path: str):
+        self.name = name
+        self.path = path
+        self.lock = threading.Lock()
+        self.max_size = 0
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+        # stored results from least to most recently used, with their size on disk
+        self.entries: collections.OrderedDict[str, int] = collections.OrderedDict()
+
+        # dreams waiting on an identical dream that is already queued, with their priority
+        self.flights: dict[str, list[tuple[utility.DrawObject, int]]] = {}
+
+    # read what is already stored, least recently used first
+    def load(self, max_size: int):
+        with self.lock:
+            self.max_size = max_size
+            self.entries.clear()
+            self.size = 0
+            if self.max_size <= 0: return
+
+            try:
+                os.makedirs(self.path, exist_ok=True)
+                files: list[tuple[float, str, int]] = []
+                for file_name in os.listdir(self.path):
+                    if not file_name.endswith('.json'): continue
+                    stat = os.stat(os.path.join(self.path, file_name))
+                    files.append((stat.st_mtime, file_name[:-5], stat.st_size))
+                files.sort()
+                for (mtime, key, size) in files:
+                    self.entries[key] = size
+                    self.size += size
+                self.evict()
+                print(f'> Loaded {self.name} cache with {len(self.entries)} results ({self.size // (1024 * 1024)}MB)')
+            except Exception as e:
+                print(f'> Failed to load {self.name} cache at {self.path}\n{e}\n{traceback.print_exc()}')
+
+    def get_file_path(self, key: str):
+        return os.path.join(self.path, key + '.json')
+
+    # remove the least recently used results until the cache fits, the lock must be held
+    def evict(self):
+        while self.size > self.max_size and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(self.get_file_path(key))
+            except FileNotFoundError:
+                pass
+
+    # get the stored webui response for the first of the keys that has one
+    def get(self, keys: list[str]):
+        if self.max_size <= 0 or len(keys) == 0: return None
+
+        for key in keys:
+            with self.lock:
+                if key not in self.entries: continue
+                self.entries.move_to_end(key)
+            try:
+                file_path = self.get_file_path(key)
+                with open(file_path, 'rb') as f:
+                    response_body = f.read()
+                os.utime(file_path) # keep the order of use when the cache is loaded again
+                with self.lock:
+                    self.hits += 1
+                metrics.cache_hits.inc(cache=self.name)
+                return response_body
+            except Exception as e:
+                print(f'> Failed to read {self.name} cache entry {key}\n{e}')
+                with self.lock:
+                    self.size -= self.entries.pop(key, 0)
+
+        with self.lock:
+            self.misses += 1
+        metrics.cache_misses.inc(cache=self.name)
+        return None
+
+    # store a webui response
+    def put(self, key: str, response_body: bytes):
+        if self.max_size <= 0 or key == None or len(response_body) > self.max_size: return
+        file_path = self.get_file_path(key)
+        try:
+            with open(file_path + '.tmp', 'wb') as f:
+                f.write(response_body)
+            os.replace(file_path + '.tmp', file_path)
+        except Exception as e:
+            print(f'> Failed to write {self.name} cache entry {key}\n{e}')
+            return
+
+        with self.lock:
+            self.size -= self.entries.pop(key, 0)
+            self.entries[key] = len(response_body)
+            self.size += len(response_body)
+            self.evict()
+
+    # wait for an identical dream that is already queued. returns False if there is none, making this dream the one others wait for
+    def join_flight(self, queue_object: utility.DrawObject, priority: int):
+        flight_key = get_flight_key(queue_object)
+        if flight_key == None: return False
+        with self.lock:
+            followers = self.flights.get(flight_key)
+            if followers == None:
+                self.flights[flight_key] = []
+                queue_object.flight_key = flight_key
+                return False
+            followers.append((queue_object, priority))
+            return True
+
+    # get the dreams waiting on a dream once it has finished
+    def land_flight(self, queue_object: utility.DrawObject):
+        if queue_object.flight_key == None: return []
+        with self.lock:
+            followers = self.flights.pop(queue_object.flight_key, [])
+        queue_object.flight_key = None
+        return followers
+
+    # remove waiting dreams that are no longer wanted
+    def remove_followers(self, accept):
+        removed: list[utility.DrawObject] = []
+        with self.lock:
+            for followers in self.flights.values():
+                for follower in list(followers):
+                    if accept(follower[0]):
+                        followers.remove(follower)
+                        removed.append(follower[0])
+        return removed
+
+# hash of the pixels of an image, so the same picture is found again when it has been saved in another way
+def get_image_hash(image_bytes: bytes):
+    try:
+        image = Image.open(io.BytesIO(image_bytes)).convert('RGBA')
+        return hashlib.sha256(f'{image.width}x{image.height}'.encode('utf-8') + image.tobytes()).hexdigest()
+    except:
+        return None
+
+class CaptionCache:
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.max_size = 0
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.save_time = 0.0
+        self.changed = False
+
+        # captions from least to most recently used
+        self.entries: collections.OrderedDict[str, str] = collections.OrderedDict()
+
+    def load(self, max_size: int):
+        with self.lock:
+            self.max_size = max_size
+            self.entries.clear()
+            self.size = 0
+            if self.max_size <= 0 or os.path.isfile(self.path) == False: return
+
+            try:
+                with open(self.path, 'r') as f:
+                    for (key, caption) in json.load(f):
+                        self.entries[key] = caption
+                        self.size += len(key) + len(caption)
+                self.evict()
+                print(f'> Loaded caption cache with {len(self.entries)} captions')
+            except Exception as e:
+                print(f'> Failed to load caption cache at {self.path}\n{e}\n{traceback.print_exc()}')
+                self.entries.clear()
+                self.size = 0
+
+    # remove the least recently used captions until the cache fits, the lock must be held
+    def evict(self):
+        while self.size > self.max_size and self.entries:
+            key, caption = self.entries.popitem(last=False)
+            self.size -= len(key) + len(caption)
+
+    # get the captions of an image for each model, only if all of them are known
+    def get(self, image_hash: str, models: list[str]):
+        if self.max_size <= 0 or image_hash == None: return None
+        with self.lock:
+            captions: list[str] = []
+            for model in models:
+                caption = self.entries.get(f'{image_hash}:{model}')
+                if caption == None:
+                    self.misses += 1
+                    metrics.cache_misses.inc(cache='caption')
+                    return None
+                captions.append(caption)
+
+            for model in models:
+                self.entries.move_to_end(f'{image_hash}:{model}')
+            self.hits += 1
+            metrics.cache_hits.inc(cache='caption')
+            return captions
+
+    def put(self, image_hash: str, model: str, caption: str):
+        if self.max_size <= 0 or image_hash == None or caption == None: return
+        key = f'{image_hash}:{model}'
+        with self.lock:
+            caption_old = self.entries.pop(key, None)
+            if caption_old != None: self.size -= len(key) + len(caption_old)
+            self.entries[key] = caption
+            self.size += len(key) + len(caption)
+            self.evict()
+            self.changed = True
+        self.save()
+
+    # write the captions to disk, at most once every save_interval unless forced
+    def save(self, force: bool = False):
+        with self.lock:
+            if self.changed == False: return
+            if force == False and time.time() - self.save_time < save_interval: return
+            self.save_time = time.time()
+            self.changed = False
+            entries = list(self.entries.items())
+
+        try:
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(entries, f)
+            os.replace(self.path + '.tmp', self.path)
+        except Exception as e:
+            print(f'> Failed to save caption cache at {self.path}\n{e}')
+
+    def get_hit_rate(self):
+        with self.lock:
+            if self.hits + self.misses == 0: return None
+            return self.hits / (self.hits + self.misses)
+
+result_cache = ResultCache('result', path)
+upscale_cache = ResultCache('upscale', upscale_path)
+caption_cache = CaptionCache(caption_path)
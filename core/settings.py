@@ -2,10 +2,16 @@ import csv
 import discord
 import json
 import os
+import sqlite3
+import time
 import traceback
 import threading
 
 from core import utility
+from core import resultcache
+from core import encoder
+from core import metrics
+from core import tracing
 
 self = discord.Bot()
 dir_path = os.path.dirname(os.path.realpath(__file__))
@@ -34,6 +40,8 @@ template = {
 class GlobalVar:
     web_ui: list[utility.WebUI] = []
     dir = ''
+    merge_window = 0.0
+    merge_size = 4
     embed_color = discord.Colour.from_rgb(222, 89, 28)
 
     sampler_names: list[str] = []
@@ -53,51 +61,112 @@ class GlobalVar:
 
     images_generated: int
     config_cache: dict = None
-    dream_cache: dict = None
-    guilds_cache: dict = None
+    dream_commands: sqlite3.Connection = None
+    dream_commands_pending: dict[int, str] = {}
+    guilds_cache: dict[str, dict] = {}
+    guilds_mtime: dict[str, float] = {}
 
-    dream_write_thread = threading.Thread()
-    guilds_write_thread = threading.Thread()
-    stats_write_thread = threading.Thread()
+    dream_commands_lock = threading.Lock()
+    stats_lock = threading.Lock()
+    guilds_lock = threading.RLock()
+    guilds_watch_thread: threading.Thread = None
 
     slow_samplers = [
         'Heun', 'DPM2', 'DPM2 a', 'DPM++ 2S a', 'DPM++ SDE']
 
 global_var = GlobalVar()
 
-# read/write guild settings
+# writes settings, stats and dream commands in the background
+file_writer = utility.WriteBehind()
+tracing.file_writer = file_writer
+
+# read/write guild settings. all guild settings are kept in memory, reads don't lock or touch the disk. changes are
+# written by the file writer, and files edited outside the bot are read again when their modification time changes
+guilds_reload_interval = 5.0
+
+def get_guild_path(guild_id: str):
+    return path + guild_id + '.json'
+
 def build(guild_id: str):
-    def run():
-        settings = json.dumps(template)
-        with open(path + guild_id + '.json', 'w') as configfile:
-            configfile.write(settings)
-    if global_var.guilds_write_thread.is_alive(): global_var.guilds_write_thread.join()
-    global_var.guilds_write_thread = threading.Thread(target=run)
-    global_var.guilds_write_thread.start()
+    with global_var.guilds_lock:
+        settings = dict(template)
+        global_var.guilds_cache[guild_id] = settings
+        # watched from now on, the file is read back once the write lands as it has no modification time yet
+        global_var.guilds_mtime[guild_id] = 0.0
+        file_writer.write_file(get_guild_path(guild_id), json.dumps(settings))
 
 def read(guild_id: str):
-    if global_var.guilds_cache:
-        try:
-            return global_var.guilds_cache[guild_id]
-        except:
-            pass
+    settings = global_var.guilds_cache.get(guild_id)
+    if settings != None: return settings
 
-    global_var.guilds_cache = {}
-    with open(path + guild_id + '.json', 'r') as configfile:
+    # a guild that wasn't there when the settings were loaded
+    return load_guild(guild_id)
+
+def update(guild_id: str, sett: str, value):
+    with global_var.guilds_lock:
+        settings = dict(read(guild_id))
+        if sett: settings[sett] = value
+        global_var.guilds_cache[guild_id] = settings
+        file_writer.write_file(get_guild_path(guild_id), json.dumps(settings))
+
+# read the settings file of a guild and its modification time, raises FileNotFoundError if the guild has no settings yet
+def read_guild_file(guild_id: str):
+    file_path = get_guild_path(guild_id)
+    mtime = os.stat(file_path).st_mtime
+    with open(file_path, 'r') as configfile:
         settings = dict(template)
         settings.update(json.load(configfile))
-    global_var.guilds_cache.update({guild_id: settings})
+    return settings, mtime
+
+# read the settings file of a guild into memory
+def load_guild(guild_id: str):
+    with global_var.guilds_lock:
+        settings, mtime = read_guild_file(guild_id)
+        global_var.guilds_cache[guild_id] = settings
+        global_var.guilds_mtime[guild_id] = mtime
     return settings
 
-def update(guild_id: str, sett: str, value):
-    def run():
-        settings = read(guild_id)
-        if sett: settings[sett] = value
-        with open(path + guild_id + '.json', 'w') as configfile:
-            json.dump(settings, configfile)
-    if global_var.guilds_write_thread.is_alive(): global_var.guilds_write_thread.join()
-    global_var.guilds_write_thread = threading.Thread(target=run)
-    global_var.guilds_write_thread.start()
+# read the settings of every guild, from the files named after guild ids. the settings are swapped in all at once,
+# so reads never see them half loaded
+def load_guilds():
+    file_writer.flush() # finish writing the files before reading them again
+    guilds_cache = {}
+    guilds_mtime = {}
+    for file_name in os.listdir(path):
+        guild_id = file_name[:-len('.json')]
+        if file_name.endswith('.json') == False or (guild_id.isdigit() == False and guild_id != 'private'): continue
+        try:
+            guilds_cache[guild_id], guilds_mtime[guild_id] = read_guild_file(guild_id)
+        except Exception as e:
+            print(f'Failed to load settings for {guild_id}\n{e}')
+    with global_var.guilds_lock:
+        global_var.guilds_cache = guilds_cache
+        global_var.guilds_mtime = guilds_mtime
+    print(f'- Loaded settings for {len(guilds_cache)} guild(s)')
+
+def start_guilds_watch():
+    if global_var.guilds_watch_thread == None:
+        global_var.guilds_watch_thread = threading.Thread(target=watch_guilds, name='guilds-watch', daemon=True)
+        global_var.guilds_watch_thread.start()
+
+# read guild files again when they are changed outside of the bot
+def watch_guilds():
+    while True:
+        time.sleep(guilds_reload_interval)
+        for guild_id, mtime in list(global_var.guilds_mtime.items()):
+            file_path = get_guild_path(guild_id)
+            try:
+                with global_var.guilds_lock:
+                    # changes from the bot that haven't been written yet are newer than the file
+                    if file_writer.is_pending(file_path): continue
+                    if os.stat(file_path).st_mtime == mtime: continue
+                    settings_old = global_var.guilds_cache.get(guild_id)
+                    settings = load_guild(guild_id)
+                if settings != settings_old: print(f'> Reloaded settings for {guild_id}')
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print(f'> Failed to reload settings for {guild_id}\n{e}')
 
 def get_env_var(var: str, default: str = None):
     try:
@@ -148,6 +217,45 @@ def startup_check():
                     '# If you do not want to save images, you can set this as --no-output\n'
                     '# DIR = --no-output\n'
                     '\n'
+                    '# Merge txt2img dreams from different users that only differ in prompt and seed into a single request.\n'
+                    '# Dreams wait up to MERGE_WINDOW seconds for others to merge with. Default is 0, which disables merging.\n'
+                    '# MERGE_WINDOW = 2\n'
+                    '# MERGE_SIZE = 4\n'
+                    '\n'
+                    '# Megabytes of disk space for keeping the images of dreams, so the same dream is only made once. Default is 512.\n'
+                    '# Set to 0 to disable.\n'
+                    '# RESULT_CACHE_SIZE = 512\n'
+                    '\n'
+                    '# Megabytes of disk space for keeping upscaled images. Default is 1024. Set to 0 to disable.\n'
+                    '# UPSCALE_CACHE_SIZE = 1024\n'
+                    '\n'
+                    '# Megabytes of memory for keeping the captions of identified images. Default is 16. Set to 0 to disable.\n'
+                    '# CAPTION_CACHE_SIZE = 16\n'
+                    '\n'
+                    '# Megabytes of memory for keeping images Aiya has uploaded, so buttons on them don\'t download them again.\n'
+                    '# Default is 128. Set to 0 to disable.\n'
+                    '# IMAGE_STORE_SIZE = 128\n'
+                    '\n'
+                    '# Format of the images uploaded to Discord, png, webp or jpeg. Default is png. Images that are larger than the upload\n'
+                    '# limit of the server are sent as the lossy format with the best quality that fits, jpeg if the format is png.\n'
+                    '# IMAGE_FORMAT = png\n'
+                    '# Number of processes for encoding images. Default is 2.\n'
+                    '# ENCODE_WORKERS = 2\n'
+                    '\n'
+                    '# Settings, stats and dream commands are written together every WRITE_INTERVAL seconds, or sooner once\n'
+                    '# WRITE_BATCH_SIZE writes are waiting. Once 16 times WRITE_BATCH_SIZE items are waiting on a slow disk,\n'
+                    '# more dream commands and traces are dropped until the writes catch up. Defaults are 1 and 256.\n'
+                    '# WRITE_INTERVAL = 1\n'
+                    '# WRITE_BATCH_SIZE = 256\n'
+                    '\n'
+                    '# Serve Prometheus metrics at http://METRICS_HOST:METRICS_PORT/metrics. Default is 0, which disables the endpoint.\n'
+                    '# METRICS_PORT = 9100\n'
+                    '# METRICS_HOST = 127.0.0.1\n'
+                    '\n'
+                    '# Write the time each dream reaches every stage, from the queue to the upload, as JSON lines to TRACE_PATH.\n'
+                    '# Default is empty, which disables tracing.\n'
+                    '# TRACE_PATH = resources/traces.jsonl\n'
+                    '\n'
                     '# Optional URL arguments\n'
                     '# --gradio-auth username:password - If gradio authentication is required. Provide a username and password.\n'
                     '#    Example: URL = https://abcdef.gradio.app --gradio-auth username:password\n'
@@ -213,7 +321,82 @@ def startup_check():
     global_var.dir = get_env_var('DIR', 'outputs')
     print(f'Using outputs directory: {global_var.dir}')
 
+    try:
+        global_var.merge_window = float(get_env_var('MERGE_WINDOW', '0'))
+        global_var.merge_size = int(get_env_var('MERGE_SIZE', '4'))
+    except:
+        print('Warning: Invalid MERGE_WINDOW or MERGE_SIZE. Dreams will not be merged.')
+        global_var.merge_window = 0.0
+    if global_var.merge_window > 0.0:
+        print(f'Merging up to {global_var.merge_size} dreams from different users, waiting up to {global_var.merge_window}s')
+
+    try:
+        result_cache_size = int(get_env_var('RESULT_CACHE_SIZE', '512'))
+    except:
+        print('Warning: Invalid RESULT_CACHE_SIZE. Dream results will not be kept.')
+        result_cache_size = 0
+    resultcache.result_cache.load(result_cache_size * 1024 * 1024)
+
+    try:
+        upscale_cache_size = int(get_env_var('UPSCALE_CACHE_SIZE', '1024'))
+    except:
+        print('Warning: Invalid UPSCALE_CACHE_SIZE. Upscaled images will not be kept.')
+        upscale_cache_size = 0
+    resultcache.upscale_cache.load(upscale_cache_size * 1024 * 1024)
+
+    try:
+        caption_cache_size = int(get_env_var('CAPTION_CACHE_SIZE', '16'))
+    except:
+        print('Warning: Invalid CAPTION_CACHE_SIZE. Captions will not be kept.')
+        caption_cache_size = 0
+    resultcache.caption_cache.load(caption_cache_size * 1024 * 1024)
+
+    try:
+        image_store_size = int(get_env_var('IMAGE_STORE_SIZE', '128'))
+    except:
+        print('Warning: Invalid IMAGE_STORE_SIZE. Uploaded images will not be kept.')
+        image_store_size = 0
+    utility.image_store.max_size = image_store_size * 1024 * 1024
+
+    image_format = get_env_var('IMAGE_FORMAT', 'png').lower().strip()
+    if image_format not in encoder.formats:
+        print(f'Warning: Unknown IMAGE_FORMAT {image_format}. Images will be uploaded as png.')
+        image_format = 'png'
+    encoder.image_format = image_format
+
+    try:
+        encoder.max_workers = max(1, int(get_env_var('ENCODE_WORKERS', '2')))
+    except:
+        print('Warning: Invalid ENCODE_WORKERS. Using 2 processes for encoding images.')
+        encoder.max_workers = 2
+
+    try:
+        file_writer.flush_interval = max(0.1, float(get_env_var('WRITE_INTERVAL', '1')))
+    except:
+        print('Warning: Invalid WRITE_INTERVAL. Writing files every second.')
+        file_writer.flush_interval = 1.0
+
+    try:
+        file_writer.max_pending = max(1, int(get_env_var('WRITE_BATCH_SIZE', '256')))
+    except:
+        print('Warning: Invalid WRITE_BATCH_SIZE. Writing files once 256 writes are waiting.')
+        file_writer.max_pending = 256
+    file_writer.max_queued = file_writer.max_pending * 16
+
+    try:
+        metrics_port = int(get_env_var('METRICS_PORT', '0'))
+    except:
+        print('Warning: Invalid METRICS_PORT. Metrics will not be served.')
+        metrics_port = 0
+    if metrics_port > 0: metrics.start_server(get_env_var('METRICS_HOST', '127.0.0.1'), metrics_port)
+
+    trace_path = get_env_var('TRACE_PATH', '').strip()
+    tracing.path = trace_path or None
+
 def files_check():
+    # finish writing the files before reading them again
+    file_writer.flush()
+
     # create stats file if it doesn't exist
     if os.path.isfile('resources/stats.txt'):
         pass
@@ -334,8 +517,8 @@ def files_check():
     global_var.lora_names = web_ui.lora_names
     global_var.embedding_names = web_ui.embedding_names
 
-    # load dream cache
-    get_dream_command(-1)
+    # open dream command store
+    load_dream_commands()
 
     # get interrogate models - no API endpoint for this, so it's hard coded
     global_var.identify_models = ['clip', 'deepdanbooru']
@@ -350,7 +533,7 @@ def guilds_check(self: discord.Bot):
     guild_private: simple_guild = simple_guild()
     guild_private.id = 'private'
 
-    # guild settings files. has to be done after on_ready
+    # guild settings files of guilds that are new. the settings are loaded at startup, see load_guilds
     guilds = self.guilds + [guild_private]
     for guild in guilds:
         guild_string = str(guild.id)
@@ -363,90 +546,81 @@ def guilds_check(self: discord.Bot):
             print(f'Creating new settings file for {guild.id} a.k.a {guild}.')
 
 
-# get dream command from cache
-def get_dream_command(message_id: int):
-    if global_var.dream_cache:
-        try:
-            return global_var.dream_cache[message_id]
-        except:
-            return None
+# dream commands of uploaded images by message id, indexed on disk so lookups stay fast however long the history is
+dream_commands_path = 'resources/dream-commands.db'
 
-    # retrieve cache from file
-    print('Retrieving dream message cache...')
-    global_var.dream_cache = {}
+# the old text files of dream commands, imported into the store once
+dream_cache_paths = ['resources/dream-cache-old.txt', 'resources/dream-cache.txt']
 
-    def read_cache(file_path: str):
-        try:
-            with open(file_path) as f:
-                for line in f:
-                    if line.startswith('#'):
-                        continue
-                    key, val = line.split('=', 1)
-                    global_var.dream_cache.update({int(key.strip()): val.strip()})
-            print(f'- Loaded dream cache: {file_path}')
-        except FileNotFoundError:
-            pass
+def load_dream_commands():
+    with global_var.dream_commands_lock:
+        if global_var.dream_commands: return
 
-    read_cache('resources/dream-cache.txt')
-    read_cache('resources/dream-cache-old.txt')
-    print(f'- Dream message cache entries: {len(global_var.dream_cache)}')
+        print('Opening dream command store...')
+        connection = sqlite3.connect(dream_commands_path, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS dream_commands (message_id INTEGER PRIMARY KEY, command TEXT NOT NULL)')
 
+        for file_path in dream_cache_paths:
+            if os.path.isfile(file_path) == False: continue
+            try:
+                rows: list[tuple[int, str]] = []
+                with open(file_path) as f:
+                    for line in f:
+                        if line.startswith('#') or '=' not in line:
+                            continue
+                        key, val = line.split('=', 1)
+                        rows.append((int(key.strip()), val.strip()))
+                with connection:
+                    connection.executemany('INSERT OR REPLACE INTO dream_commands VALUES (?, ?)', rows)
+                os.replace(file_path, file_path + '.imported')
+                print(f'- Imported dream cache: {file_path} ({len(rows)} entries)')
+            except Exception as e:
+                print(f'- Failed to import dream cache: {file_path}\n{e}')
+
+        global_var.dream_commands = connection
+
+
+# get dream command from the store
+def get_dream_command(message_id: int):
+    # the command may still be waiting to be written, it is only forgotten here once it is stored
+    command = global_var.dream_commands_pending.get(message_id)
+    if command != None: return command
+
+    load_dream_commands()
     try:
-        return global_var.dream_cache[message_id]
+        with global_var.dream_commands_lock:
+            row = global_var.dream_commands.execute('SELECT command FROM dream_commands WHERE message_id = ?', (message_id,)).fetchone()
+        if row: return row[0]
     except Exception as e:
-        return None
+        print(f'Failed to read dream command {message_id}\n{e}')
+    return None
 
 
-# append command to dream command cache
+# append command to dream command store, the commands are written in batches by the file writer
 def append_dream_command(message_id: int, command: str):
-    # cache into disk
-    def run():
-        if get_dream_command(message_id) == None:
-            dream_cache_line = str(message_id) + '=' + command.replace('\n', ' ').strip() + '\n'
-
-            # cache into memory
-            global_var.dream_cache[message_id] = dream_cache_line
-
-            # archive file if it's too big (over 5MB)
-            try:
-                file_stats = os.stat('resources/dream-cache.txt')
-                if file_stats.st_size > 5 * 1024 * 1024:
-                    # remove old archived file
-                    try:
-                        os.remove('resources/dream-cache-old.txt')
-                    except:
-                        pass
-
-                    # archive current file
-                    try:
-                        os.rename('resources/dream-cache.txt', 'resources/dream-cache-old.txt')
-                    except:
-                        pass
-            except:
-                pass
+    command = command.replace('\n', ' ').strip()
+    global_var.dream_commands_pending[message_id] = command
+    if file_writer.append(write_dream_commands, (message_id, command)) == False:
+        global_var.dream_commands_pending.pop(message_id, None)
 
-            try:
-                with open('resources/dream-cache.txt', 'a') as f:
-                    f.write(dream_cache_line)
-            except FileNotFoundError:
-                with open('resources/dream-cache.txt', 'w') as f:
-                    f.write(dream_cache_line)
-
-    if global_var.dream_write_thread.is_alive(): global_var.dream_write_thread.join()
-    global_var.dream_write_thread = threading.Thread(target=run)
-    global_var.dream_write_thread.start()
+def write_dream_commands(rows: list[tuple[int, str]]):
+    try:
+        load_dream_commands()
+        with global_var.dream_commands_lock:
+            with global_var.dream_commands:
+                global_var.dream_commands.executemany('INSERT OR IGNORE INTO dream_commands VALUES (?, ?)', rows)
+    finally:
+        for (message_id, command) in rows:
+            global_var.dream_commands_pending.pop(message_id, None)
 
 
 # increment number of images generated
 def increment_stats(count: int = 1):
-    def run():
+    with global_var.stats_lock:
         global_var.images_generated += count
-        with open('resources/stats.txt', 'w') as f:
-            f.write(str(global_var.images_generated))
-
-    if global_var.stats_write_thread.is_alive(): global_var.stats_write_thread.join()
-    global_var.stats_write_thread = threading.Thread(target=run)
-    global_var.stats_write_thread.start()
+        file_writer.write_file('resources/stats.txt', str(global_var.images_generated))
 
 
 def custom_autocomplete(context: discord.AutocompleteContext, values: list[str]):
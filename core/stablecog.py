@@ -1,13 +1,14 @@
+import aiohttp
 import base64
-import contextlib
 import discord
 import io
+import json
 import random
+import shlex
 import requests
 import time
 import traceback
 import asyncio
-import threading
 from urllib.parse import quote
 from PIL import Image, ImageFilter, ImageEnhance, PngImagePlugin
 from discord import option
@@ -15,7 +16,10 @@ from discord.ext import commands
 from typing import Optional
 
 from core import utility
+from core import metrics
+from core import encoder
 from core import queuehandler
+from core import resultcache
 from core import viewhandler
 from core import settings
 
@@ -71,6 +75,10 @@ scripts = [
 
 class StableCog(commands.Cog, description='Create images from natural language.'):
     ctx_parse = discord.ApplicationContext
+
+    # dream handles dreams merged into one request, see DreamQueue.get_merge_key
+    merge_dreams = True
+
     def __init__(self, bot):
         self.wait_message: list[str] = []
         self.bot: discord.Bot = bot
@@ -544,6 +552,7 @@ class StableCog(commands.Cog, description='Create images from natural language.'
             if dream_cost + queue_cost > settings.read(guild)['max_compute_queue']:
                 print(f'Dream rejected: Too much in queue already')
                 content = f'<@{user.id}> Please wait! You have too much queued up.'
+                metrics.admission_rejections.inc(reason='queue_limit')
                 ephemeral = True
                 raise Exception()
 
@@ -561,33 +570,22 @@ class StableCog(commands.Cog, description='Create images from natural language.'
                     ephemeral = True
                     raise Exception()
 
-                try:
-                    # reject URL downloads larger than 10MB
-                    url_head = await loop.run_in_executor(None, requests.head, init_url)
-                    url_size = int(url_head.headers.get('content-length', -1))
-                except:
-                    content = 'Image not found! Please check the image URL.'
-                    ephemeral = True
-                    raise Exception()
-
-                # check image download size
-                if url_size > 10 * 1024 * 1024:
-                    print(f'Dream rejected: Image download too large.')
-                    content = 'Image download is too large! Please make the download size smaller.'
-                    ephemeral = True
-                    raise Exception()
-
                 # defer response before downloading
                 try:
                     loop.create_task(ctx.defer())
                 except:
                     pass
 
-                # download and encode the image
+                # download and encode the image, rejecting downloads larger than 10MB
                 try:
-                    image_response = await loop.run_in_executor(None, requests.get, init_url)
-                    image_data = image_response.content
-                    image_string = base64.b64encode(image_data).decode('utf-8')
+                    image_download = await utility.fetch_image(init_url)
+                    image_data = image_download.data
+                    image_string = await loop.run_in_executor(utility.executor, image_download.get_data_url)
+                except utility.DownloadTooLarge:
+                    print(f'Dream rejected: Image download too large.')
+                    content = 'Image download is too large! Please make the download size smaller.'
+                    ephemeral = True
+                    raise Exception()
                 except:
                     print(f'Dream rejected: Image download failed.')
                     content = 'Image download failed! Please check the image URL.'
@@ -624,7 +622,7 @@ class StableCog(commands.Cog, description='Create images from natural language.'
                     print(f'{is_resolution_set} {target_aspect_ratio} {image_pil_width}x{image_pil_height} {width}x{height}')
 
                 # setup image variable
-                image = 'data:image/png;base64,' + image_string
+                image = image_string
                 image_validated = True
 
                 # setup inpainting mask
@@ -867,38 +865,51 @@ class StableCog(commands.Cog, description='Create images from natural language.'
                 priority += 1
 
             if batch == 1:
-                queue_length = queuehandler.dream_queue.process_dream(get_draw_object(), priority)
+                queue_length = await self.queue_dream(get_draw_object(), priority)
             else:
-                last_draw_object = get_draw_object()
-                queue_length = queuehandler.dream_queue.process_dream(last_draw_object, priority)
-
-                if queue_length != None:
-                    batch_count = 1
-                    while batch_count < batch:
-                        batch_count += 1
-                        message = f'#{batch_count}`` ``'
-
-                        if increment_seed:
-                            seed += increment_seed
-                            message += f'seed:{seed}'
-
-                        if increment_steps:
-                            steps += increment_steps
-                            message += f'steps:{steps}'
-
-                        if increment_guidance_scale:
-                            guidance_scale += increment_guidance_scale
-                            guidance_scale = round(guidance_scale, 4)
-                            message += f'guidance_scale:{guidance_scale}'
-
-                        if increment_clip_skip:
-                            clip_skip += increment_clip_skip
-                            message += f'clip_skip:{clip_skip}'
-
-                        draw_object = get_draw_object(message)
-                        draw_object.wait_for_dream = last_draw_object
-                        last_draw_object = draw_object
-                        queuehandler.dream_queue.process_dream(draw_object, priority, False)
+                draw_objects = [get_draw_object()]
+                batch_count = 1
+                while batch_count < batch:
+                    batch_count += 1
+                    message = f'#{batch_count}`` ``'
+
+                    if increment_seed:
+                        seed += increment_seed
+                        message += f'seed:{seed}'
+
+                    if increment_steps:
+                        steps += increment_steps
+                        message += f'steps:{steps}'
+
+                    if increment_guidance_scale:
+                        guidance_scale += increment_guidance_scale
+                        guidance_scale = round(guidance_scale, 4)
+                        message += f'guidance_scale:{guidance_scale}'
+
+                    if increment_clip_skip:
+                        clip_skip += increment_clip_skip
+                        message += f'clip_skip:{clip_skip}'
+
+                    draw_object = get_draw_object(message)
+                    draw_object.wait_for_dream = draw_objects[-1]
+                    draw_objects.append(draw_object)
+
+                # the webui makes consecutive seeds in a single request, send as many as will fit in memory together
+                batch_size = 1
+                if increment_seed == 1 and not increment_steps and not increment_guidance_scale and not increment_clip_skip:
+                    batch_size = queuehandler.dream_queue.get_max_batch_size(draw_objects[0].payload)
+
+                for index in range(0, len(draw_objects), batch_size):
+                    draw_object = draw_objects[index]
+                    if batch_size > 1:
+                        draw_object.batch_objects = draw_objects[index:index + batch_size]
+                        draw_object.payload['batch_size'] = len(draw_object.batch_objects)
+
+                    if index == 0:
+                        queue_length = await self.queue_dream(draw_object, priority)
+                        if queue_length == None: break
+                    else:
+                        await self.queue_dream(draw_object, priority, False)
 
             if queue_length == None:
                 content = f'<@{user.id}> Sorry, I cannot handle this request right now.'
@@ -906,6 +917,8 @@ class StableCog(commands.Cog, description='Create images from natural language.'
             else:
                 content = f'<@{user.id}> {settings.global_var.messages[random.randrange(0, len(settings.global_var.messages))]} Queue: ``{queue_length}``'
                 if batch > 1: content = content + f' - Batch: ``{batch}``'
+                queue_eta = queuehandler.dream_queue.get_queue_eta(priority)
+                if queue_eta != None: content = content + f' - ETA: ``{utility.format_duration(queue_eta)}``'
                 content = content + append_options
 
         except Exception as e:
@@ -929,98 +942,237 @@ class StableCog(commands.Cog, description='Create images from natural language.'
             else:
                 loop.create_task(ctx.channel.send(content, delete_after=delete_after))
 
+    # queue a dream, unless the same dream has been made before or is already queued
+    async def queue_dream(self, draw_object: utility.DrawObject, priority: int, extended = True):
+        loop = asyncio.get_running_loop()
+        draw_object.trace_stage('admitted')
+
+        cache_keys = resultcache.get_keys(draw_object, settings.global_var.web_ui)
+        response_body = await loop.run_in_executor(utility.executor, resultcache.result_cache.get, cache_keys)
+        if response_body:
+            print(f'Dream served from result cache: {draw_object.message}')
+            draw_object.trace_stage('cache_hit')
+            loop.run_in_executor(utility.executor, self.post_dream, draw_object, response_body)
+        elif queuehandler.dream_queue.join_flight(draw_object, priority) == False:
+            return queuehandler.dream_queue.process_dream(draw_object, priority, extended)
+
+        if extended:
+            return queuehandler.dream_queue.get_queue_length(priority)
+
     # generate the image
-    def dream(self, queue_object: utility.DrawObject, web_ui: utility.WebUI, queue_continue: threading.Event):
-        user = utility.get_user(queue_object.ctx)
+    async def dream(self, queue_object: utility.DrawObject, web_ui: utility.WebUI, queue_continue: asyncio.Event):
+        loop = asyncio.get_running_loop()
+
+        # a dream may carry the rest of a seed batch, or the dreams of other users merged into it
+        merge_objects: list[utility.DrawObject] = queue_object.merge_objects
+        batch_objects: list[utility.DrawObject] = merge_objects or queue_object.batch_objects or [queue_object]
 
         try:
-            # get webui session
-            s = web_ui.get_session()
-            if s == None:
-                # no session, return the object to the queue handler to try again
+            if web_ui.online == False:
+                # webui went offline, return the object to the queue handler to try again
                 queuehandler.dream_queue.process_dream(queue_object, 0, False)
                 return
 
             # only send model payload if one is defined
             if queue_object.data_model:
-                model_payload = {
-                    'sd_model_checkpoint': queue_object.data_model,
-                }
-                s.post(url=f'{web_ui.url}/sdapi/v1/options', json=model_payload, timeout=120)
+                queue_object.switch_time = await web_ui.switch_model(queue_object.data_model)
+                queue_object.trace_stage('switched')
 
             # safe for global queue to continue
-            def continue_queue():
-                time.sleep(0.1)
-                queue_continue.set()
-            threading.Thread(target=continue_queue, daemon=True).start()
+            loop.call_later(0.1, queue_continue.set)
+
+            # don't send dreams that were cancelled while waiting for the WebUI
+            if queuehandler.is_cancelled(queue_object):
+                return
 
             if queue_object.init_url:
-                url = f'{web_ui.url}/sdapi/v1/img2img'
+                path = '/sdapi/v1/img2img'
             else:
-                url = f'{web_ui.url}/sdapi/v1/txt2img'
-            response = s.post(url=url, json=queue_object.payload, timeout=120)
-            queue_object.payload = None
-
-            def post_dream():
-                try:
-                    response_data = response.json()
-                    # create safe/sanitized filename
-                    keep_chars = (' ', '.', '_')
-                    file_name = ''.join(c for c in queue_object.prompt if c.isalnum() or c in keep_chars).rstrip()
-
-                    # save local copy of image and prepare PIL images
-                    pil_images = []
-                    for i, image_base64 in enumerate(response_data['images']):
-                        image = Image.open(io.BytesIO(base64.b64decode(image_base64.split(',',1)[0])))
-                        pil_images.append(image)
-
-                        # save png with metadata
-                        if settings.global_var.dir != '--no-output':
-                            try:
-                                epoch_time = int(time.time())
-                                file_path = f'{settings.global_var.dir}/{epoch_time}-{queue_object.seed}-{file_name[0:120]}-{i}.png'
-
-                                metadata = PngImagePlugin.PngInfo()
-                                metadata.add_text('parameters', response_data['info'])
-                                image.save(file_path, pnginfo=metadata)
-                                print(f'Saved image: {file_path}')
-                            except Exception as e:
-                                print(f'Unable to save image: {file_path}\n{traceback.print_exc()}')
-                        else:
-                            print(f'Received image: {int(time.time())}-{queue_object.seed}-{file_name[0:120]}-{i}.png')
+                path = '/sdapi/v1/txt2img'
+
+            payload = queue_object.payload
+            if merge_objects: payload = self.get_merge_payload(queue_object, web_ui)
+            cache_key = resultcache.get_key(queue_object, web_ui)
+            response_body = await web_ui.post(path, payload, 120 * len(batch_objects), queue_object)
+            queue_object.trace_stage('responded')
+
+            # the batch did not fit in the memory of the WebUI, try again with half of it in each dream
+            if merge_objects == None and queue_object.batch_objects and utility.is_out_of_memory(response_body):
+                print(f'Dream out of memory with a batch of {len(batch_objects)}, splitting it: {queue_object.message}')
+                self.split_batch(queue_object)
+                return
 
-                    # post to discord
-                    with contextlib.ExitStack() as stack:
-                        buffer_handles = [stack.enter_context(io.BytesIO()) for _ in pil_images]
+            for draw_object in batch_objects:
+                draw_object.payload = None
 
-                        for (pil_image, buffer) in zip(pil_images, buffer_handles):
-                            pil_image.save(buffer, 'PNG')
-                            buffer.seek(0)
+            # the WebUI was interrupted, drop what it made so far
+            if queuehandler.is_cancelled(queue_object):
+                print(f'Dream cancelled: {queue_object.message}')
+                return
 
-                        files = [discord.File(fp=buffer, filename=f'{queue_object.seed}-{i}.png') for (i, buffer) in enumerate(buffer_handles)]
-                        queuehandler.upload_queue.process_upload(utility.UploadObject(queue_object=queue_object,
-                           content=f'<@{user.id}> ``{queue_object.message}``', files=files, view=queue_object.view
-                        ))
-                        queue_object.view = None
+            # identical dreams that were waiting on this one get the same images. the images of merged dreams
+            # are split between users, so dreams waiting on those are queued on their own once they are released
+            followers = []
+            if merge_objects == None: followers = resultcache.result_cache.land_flight(queue_object)
 
-                except Exception as e:
-                    content = f'<@{user.id}> ``{queue_object.message}``\nSomething went wrong.\n{e}'
-                    print(content + f'\n{traceback.print_exc()}')
-                    queuehandler.upload_queue.process_upload(utility.UploadObject(queue_object=queue_object, content=content, delete_after=30))
+            # decode and upload images in the image executor while the next dream starts, and keep the result
+            # for the next time this dream is made
+            def post_dream():
+                if self.post_dream(queue_object, response_body) and merge_objects == None:
+                    resultcache.result_cache.put(cache_key, response_body)
+                for follower, priority in followers:
+                    self.post_dream(follower, response_body)
+                    queuehandler.dream_queue.release_dream(follower)
 
-            threading.Thread(target=post_dream, daemon=True).start()
+            loop.run_in_executor(utility.executor, post_dream)
 
-        except requests.exceptions.RequestException as e:
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             # connection error, return items to queue
-            time.sleep(5.0)
+            await asyncio.sleep(5.0)
             web_ui.reconnect()
             queuehandler.dream_queue.process_dream(queue_object, 0, False)
             return
 
         except Exception as e:
-            content = f'<@{user.id}> ``{queue_object.message}``\nSomething went wrong.\n{e}'
+            self.upload_error(queue_object, e)
+
+    # split the batch of a dream in two and queue both halves again
+    def split_batch(self, queue_object: utility.DrawObject):
+        batch_objects = queue_object.batch_objects
+        half = len(batch_objects) // 2
+        for draw_objects in (batch_objects[:half], batch_objects[half:]):
+            draw_object = draw_objects[0]
+            draw_object.batch_objects = draw_objects if len(draw_objects) > 1 else None
+            draw_object.payload['batch_size'] = len(draw_objects)
+
+            # smaller batches are a different dream, they get their own attempts
+            draw_object.dream_attempts = 0
+            queuehandler.dream_queue.process_dream(draw_object, 0, False)
+
+    # save and upload the images of a dream from the webui response, returns False if they could not be uploaded
+    def post_dream(self, queue_object: utility.DrawObject, response_body: bytes):
+        merge_objects: list[utility.DrawObject] = queue_object.merge_objects
+        batch_objects: list[utility.DrawObject] = merge_objects or queue_object.batch_objects or [queue_object]
+
+        try:
+            response_data = json.loads(response_body)
+
+            # each image of a batch or merge gets its own generation info, with its own seed and prompt
+            info_texts: list[str] = None
+            if len(response_data['images']) > 1:
+                try:
+                    info_texts = json.loads(response_data['info'])['infotexts']
+                except Exception as e:
+                    print(f'Unable to read the generation info of each image\n{e}')
+
+            # save local copy of image and prepare the files, split between the draw objects of a batch
+            batch_images: list[list[utility.ImageDownload]] = [[] for _ in batch_objects]
+            for i, image_base64 in enumerate(response_data['images']):
+                batch_index = min(i, len(batch_objects) - 1)
+                draw_object = batch_objects[batch_index]
+                image_data = base64.b64decode(image_base64.split(',',1)[0])
+
+                # add the metadata to the png from the webui as it is, instead of compressing the image again
+                info_text = info_texts[i] if info_texts and i < len(info_texts) else response_data['info']
+                png_data = utility.add_png_text(image_data, 'parameters', info_text)
+                if png_data == None:
+                    # the webui sent another format, convert it to png
+                    image = Image.open(io.BytesIO(image_data))
+                    metadata = PngImagePlugin.PngInfo()
+                    metadata.add_text('parameters', info_text)
+                    with io.BytesIO() as buffer:
+                        image.save(buffer, 'PNG', pnginfo=metadata)
+                        png_data = buffer.getvalue()
+
+                image_size = utility.get_image_size(png_data)
+                batch_images[batch_index].append(utility.ImageDownload(png_data, image_size[0], image_size[1]))
+                draw_object.trace_stage('decoded', False)
+
+                # create safe/sanitized filename
+                keep_chars = (' ', '.', '_')
+                file_name = ''.join(c for c in draw_object.prompt if c.isalnum() or c in keep_chars).rstrip()
+
+                # save png with metadata
+                if settings.global_var.dir != '--no-output':
+                    try:
+                        epoch_time = int(time.time())
+                        file_path = f'{settings.global_var.dir}/{epoch_time}-{draw_object.seed}-{file_name[0:120]}-{i}.png'
+                        with open(file_path, 'wb') as f:
+                            f.write(png_data)
+                        print(f'Saved image: {file_path}')
+                        draw_object.trace_stage('saved', False)
+                    except Exception as e:
+                        print(f'Unable to save image: {file_path}\n{traceback.print_exc()}')
+                else:
+                    print(f'Received image: {int(time.time())}-{draw_object.seed}-{file_name[0:120]}-{i}.png')
+
+            # post to discord
+            for draw_object, images in zip(batch_objects, batch_images):
+                if len(images) == 0:
+                    raise Exception(f'Received {len(response_data["images"])} images for a batch of {len(batch_objects)}.')
+
+                # fit the images in the upload limit of the guild
+                encoded_images = encoder.encode_images(images, encoder.get_upload_limit(draw_object.ctx))
+                images = [image for (image, extension) in encoded_images]
+                draw_object.trace_stage('encoded', False)
+
+                user = utility.get_user(draw_object.ctx)
+                files = [discord.File(fp=io.BytesIO(image.data), filename=f'{draw_object.seed}-{i}{extension}') for (i, (image, extension)) in enumerate(encoded_images)]
+                queuehandler.upload_queue.process_upload(utility.UploadObject(queue_object=draw_object,
+                   content=f'<@{user.id}> ``{draw_object.message}``', files=files, view=draw_object.view, images=images
+                ))
+                draw_object.view = None
+
+            return True
+
+        except Exception as e:
+            self.upload_error(queue_object, e)
+            return False
+
+    # let later uploads go ahead if the rest of the batch will not be uploaded
+    def release_batch(self, queue_object: utility.DrawObject):
+        for draw_object in queue_object.batch_objects or []:
+            if draw_object.uploaded == False and draw_object != queue_object:
+                draw_object.uploaded = True
+
+    # tell everyone waiting on this dream that it failed
+    def upload_error(self, queue_object: utility.DrawObject, e: Exception):
+        queue_object.trace_stage('failed')
+        for draw_object in queue_object.merge_objects or [queue_object]:
+            user = utility.get_user(draw_object.ctx)
+            content = f'<@{user.id}> ``{draw_object.message}``\nSomething went wrong.\n{e}'
             print(content + f'\n{traceback.print_exc()}')
-            queuehandler.upload_queue.process_upload(utility.UploadObject(queue_object=queue_object, content=content, delete_after=30))
+            queuehandler.upload_queue.process_upload(utility.UploadObject(queue_object=draw_object, content=content, delete_after=30))
+        if queue_object.merge_objects == None: self.release_batch(queue_object)
+
+    # construct a payload that makes the dreams of several users in one request, using the prompts from file script
+    def get_merge_payload(self, queue_object: utility.DrawObject, web_ui: utility.WebUI):
+        lines: list[str] = []
+        for draw_object in queue_object.merge_objects:
+            line = '--prompt ' + shlex.quote(draw_object.payload['prompt'].replace('\n', ' '))
+            if draw_object.payload['negative_prompt']:
+                line += ' --negative_prompt ' + shlex.quote(draw_object.payload['negative_prompt'].replace('\n', ' '))
+            line += f' --seed {draw_object.payload["seed"]}'
+            lines.append(line)
+
+        script_args = []
+        for script_arg in web_ui.prompts_script_args:
+            match script_arg['label']:
+                case 'List of prompt inputs':
+                    script_args.append('\n'.join(lines))
+                case 'Iterate seed every line' | 'Use same random seed for all lines':
+                    script_args.append(False)
+                case other:
+                    script_args.append(script_arg['value'])
+
+        payload = dict(queue_object.payload)
+        payload.update({
+            'prompt': '',
+            'negative_prompt': '',
+            'script_name': 'prompts from file or textbox',
+            'script_args': script_args
+        })
+        return payload
 
     async def dream_object(self, draw_object: utility.DrawObject):
         loop = asyncio.get_running_loop()
@@ -0,0 +1,53 @@
+import itertools
+import json
+import os
+
+from core import utility
+
+
+# dreams record when they reach each stage of their life with DreamObject.trace_stage. once a dream is uploaded,
+# its stages are written as a json line to the file at TRACE_PATH, to find out where the time of slow dreams went
+path: str = None
+file_writer: utility.WriteBehind = None
+
+# the trace file is moved to .old once it is larger than this
+max_size = 64 * 1024 * 1024
+
+trace_ids = itertools.count(1)
+
+def get_kind(queue_object: utility.DreamObject):
+    if type(queue_object) is utility.DrawObject: return 'draw'
+    if type(queue_object) is utility.UpscaleObject: return 'upscale'
+    if type(queue_object) is utility.IdentifyObject: return 'identify'
+    return type(queue_object).__name__
+
+# write the trace of a dream, and start a new one for whatever happens to it next
+def finish(queue_object: utility.DreamObject, outcome: str):
+    trace = queue_object.trace
+    trace_time = queue_object.trace_time
+    queue_object.trace = None
+    if path == None or file_writer == None or not trace: return
+
+    time_start = trace[0][1]
+    user = utility.get_user(queue_object.ctx)
+    record = {
+        'trace': next(trace_ids),
+        'kind': get_kind(queue_object),
+        'user': user.id if user else None,
+        'guild': utility.get_guild(queue_object.ctx),
+        'command': queue_object.message,
+        'time': trace_time,
+        'outcome': outcome,
+        'seconds': round(trace[-1][1] - time_start, 4),
+        'stages': [[stage, round(stage_time - time_start, 4)] for (stage, stage_time) in trace]
+    }
+    file_writer.append(write_traces, json.dumps(record))
+
+def write_traces(lines: list[str]):
+    try:
+        if os.path.getsize(path) > max_size:
+            os.replace(path, path + '.old')
+    except FileNotFoundError:
+        pass
+    with open(path, 'a') as f:
+        f.write('\n'.join(lines) + '\n')
@@ -1,12 +1,12 @@
+import aiohttp
 import base64
 import discord
 import io
+import json
 import random
-import requests
 import time
 import traceback
 import asyncio
-import threading
 from discord import option
 from discord.ext import commands
 from os.path import splitext, basename
@@ -15,7 +15,10 @@ from typing import Optional
 from urllib.parse import urlparse
 
 from core import utility
+from core import metrics
+from core import encoder
 from core import queuehandler
+from core import resultcache
 from core import viewhandler
 from core import settings
 
@@ -132,44 +135,34 @@ class UpscaleCog(commands.Cog):
                     ephemeral = True
                     raise Exception()
 
-                try:
-                    # reject URL downloads larger than 10MB
-                    url_head = await loop.run_in_executor(None, requests.head, init_url)
-                    url_size = int(url_head.headers.get('content-length', -1))
-                except:
-                    content = 'Image not found! Please check the image URL.'
-                    ephemeral = True
-                    raise Exception()
-
-                # check image download size
-                if url_size > 10 * 1024 * 1024:
-                    print(f'Upscale rejected: Image download too large.')
-                    content = 'Image download is too large! Please make the download size smaller.'
-                    ephemeral = True
-                    raise Exception()
-
                 # defer response before downloading
                 try:
                     loop.create_task(ctx.defer())
                 except:
                     pass
 
-                # download and encode the image
+                # download and encode the image, rejecting downloads larger than 10MB
                 try:
-                    image_response = await loop.run_in_executor(None, requests.get, init_url)
-                    image_data = image_response.content
-                    image_string = base64.b64encode(image_data).decode('utf-8')
+                    image_download = await utility.fetch_image(init_url)
+                    image_data = image_download.data
+                    image_string = await loop.run_in_executor(utility.executor, image_download.get_data_url)
+                except utility.DownloadTooLarge:
+                    print(f'Upscale rejected: Image download too large.')
+                    content = 'Image download is too large! Please make the download size smaller.'
+                    ephemeral = True
+                    raise Exception()
                 except:
                     print(f'Upscale rejected: Image download failed.')
                     content = 'Image download failed! Please check the image URL.'
                     ephemeral = True
                     raise Exception()
 
-                # check if image can open
+                # check if image can open, the size is usually known from the header of the download
                 try:
-                    image_bytes = io.BytesIO(image_data)
-                    image_pil = Image.open(image_bytes)
-                    image_pil_width, image_pil_height = image_pil.size
+                    image_pil_width, image_pil_height = image_download.width, image_download.height
+                    if image_pil_width == None:
+                        image_pil = Image.open(io.BytesIO(image_data))
+                        image_pil_width, image_pil_height = image_pil.size
                 except Exception as e:
                     print(f'Upscale rejected: Image is corrupted.')
                     print(f'\n{traceback.print_exc()}')
@@ -185,7 +178,7 @@ class UpscaleCog(commands.Cog):
                     raise Exception()
 
                 # setup image variable
-                image = 'data:image/png;base64,' + image_string
+                image = image_string
                 image_validated = True
 
             #fail if no image is provided
@@ -233,12 +226,24 @@ class UpscaleCog(commands.Cog):
                 return queue_object
 
             upscale_object = get_upscale_object()
+            upscale_object.cache_key = resultcache.get_upscale_key(upscale_object, image_data)
+
+            # images that have been upscaled the same way before are uploaded without the webui
+            response_body = await loop.run_in_executor(utility.executor, resultcache.upscale_cache.get, [upscale_object.cache_key])
+            if response_body:
+                print(f'Upscale served from upscale cache: {upscale_object.message}')
+                loop.run_in_executor(utility.executor, self.post_dream, upscale_object, response_body)
+                content = f'<@{user.id}> I\'ve upscaled this image before, here it is again!'
+                ephemeral = True
+                raise Exception()
+
             dream_cost = queuehandler.dream_queue.get_dream_cost(upscale_object)
             queue_cost = queuehandler.dream_queue.get_user_queue_cost(user.id)
 
             # check if the user has too much things in queue
             if dream_cost + queue_cost > settings.read(guild)['max_compute_queue']:
                 content = f'<@{user.id}> Please wait! You have too much queued up.'
+                metrics.admission_rejections.inc(reason='queue_limit')
                 ephemeral = True
                 raise Exception()
 
@@ -255,6 +260,8 @@ class UpscaleCog(commands.Cog):
                 ephemeral = True
             else:
                 content = f'<@{user.id}> {settings.global_var.messages[random.randrange(0, len(settings.global_var.messages))]} Queue: ``{queue_length}``'
+                queue_eta = queuehandler.dream_queue.get_queue_eta(priority)
+                if queue_eta != None: content += f' - ETA: ``{utility.format_duration(queue_eta)}``'
 
         except Exception as e:
             if content == None:
@@ -276,77 +283,33 @@ class UpscaleCog(commands.Cog):
                 loop.create_task(ctx.channel.send(content, delete_after=delete_after))
 
     # generate the image
-    def dream(self, queue_object: utility.UpscaleObject, web_ui: utility.WebUI, queue_continue: threading.Event):
+    async def dream(self, queue_object: utility.UpscaleObject, web_ui: utility.WebUI, queue_continue: asyncio.Event):
+        loop = asyncio.get_running_loop()
         user = utility.get_user(queue_object.ctx)
 
         try:
-            # get webui session
-            s = web_ui.get_session()
-            if s == None:
-                # no session, return the object to the queue handler to try again
+            if web_ui.online == False:
+                # webui went offline, return the object to the queue handler to try again
                 queuehandler.dream_queue.process_dream(queue_object, 0, False)
                 return
 
             # safe for global queue to continue
-            def continue_queue():
-                time.sleep(0.1)
-                queue_continue.set()
-            threading.Thread(target=continue_queue, daemon=True).start()
-
-            response = s.post(url=f'{web_ui.url}/sdapi/v1/extra-single-image', json=queue_object.payload, timeout=120)
-            queue_object.payload = None
+            loop.call_later(0.1, queue_continue.set)
 
-            def post_dream():
-                try:
-                    response_data = response.json()
-                    image_data = response_data['image']
-
-                    #create safe/sanitized filename
-                    epoch_time = int(time.time())
-
-                    # save local copy of image
-                    if settings.global_var.dir != '--no-output':
-                        file_path = f'{settings.global_var.dir}/{epoch_time}-x{queue_object.resize}-{self.file_name[0:120]}.png'
-                        try:
-                            with open(file_path, 'wb') as fh:
-                                fh.write(base64.b64decode(image_data))
-                            print(f'Saved image: {file_path}')
-                        except Exception as e:
-                            print(f'Unable to save image: {file_path}\n{traceback.print_exc()}')
-                    else:
-                        file_path = f'{epoch_time}-x{queue_object.resize}-{self.file_name[0:120]}.png'
-                        print(f'Received image: {file_path}')
-
-                    # post to discord
-                    with io.BytesIO() as buffer:
-                        image = Image.open(io.BytesIO(base64.b64decode(image_data)))
-                        image.save(buffer, 'PNG')
-                        size = buffer.getbuffer().nbytes
-                        if buffer.getbuffer().nbytes > 8 * 1000 * 1000:
-                            print(f'Image too large: {size} bytes - Converting image to JPEG')
-                            buffer.truncate(0)
-                            buffer.seek(0)
-                            quality = int(max(5, min(95, ((8 * 1000 * 1000) / size) * 350.0)))
-                            image.save(buffer, format='JPEG', optimize=True, quality=quality)
-                            file_path = file_path.rstrip('.png') + '.jpeg'
-                            print(f'New image size: {buffer.getbuffer().nbytes} bytes - Quality: {quality}')
-                        buffer.seek(0)
-
-                        queuehandler.upload_queue.process_upload(utility.UploadObject(queue_object=queue_object,
-                            content=f'<@{user.id}> ``{queue_object.message}``', files=[discord.File(fp=buffer, filename=file_path)], view=queue_object.view
-                        ))
-                        queue_object.view = None
+            # don't send dreams that were cancelled while waiting for the WebUI
+            if queue_object.cancelled:
+                return
 
-                except Exception as e:
-                    content = f'<@{user.id}> ``{queue_object.message}``\nSomething went wrong.\n{e}'
-                    print(content + f'\n{traceback.print_exc()}')
-                    queuehandler.upload_queue.process_upload(utility.UploadObject(queue_object=queue_object, content=content, delete_after=30))
+            response_body = await web_ui.post('/sdapi/v1/extra-single-image', queue_object.payload, 120, queue_object)
+            queue_object.trace_stage('responded')
+            queue_object.payload = None
 
-            threading.Thread(target=post_dream, daemon=True).start()
+            # decode and upload the image in the image executor while the next dream starts
+            loop.run_in_executor(utility.executor, self.post_dream, queue_object, response_body, True)
 
-        except requests.exceptions.RequestException as e:
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             # connection error, return items to queue
-            time.sleep(5.0)
+            await asyncio.sleep(5.0)
             web_ui.reconnect()
             queuehandler.dream_queue.process_dream(queue_object, 0, False)
             return
@@ -356,5 +319,54 @@ class UpscaleCog(commands.Cog):
             print(content + f'\n{traceback.print_exc()}')
             queuehandler.upload_queue.process_upload(utility.UploadObject(queue_object=queue_object, content=content, delete_after=30))
 
+    # save and upload the upscaled image. store_result keeps a response from the webui in the upscale cache,
+    # responses that came from the cache are not stored again
+    def post_dream(self, queue_object: utility.UpscaleObject, response_body: bytes, store_result = False):
+        user = utility.get_user(queue_object.ctx)
+
+        try:
+            response_data = json.loads(response_body)
+            image_bytes = base64.b64decode(response_data['image'])
+            queue_object.trace_stage('decoded')
+
+            #create safe/sanitized filename
+            epoch_time = int(time.time())
+
+            # save local copy of image
+            if settings.global_var.dir != '--no-output':
+                file_path = f'{settings.global_var.dir}/{epoch_time}-x{queue_object.resize}-{self.file_name[0:120]}.png'
+                try:
+                    with open(file_path, 'wb') as fh:
+                        fh.write(image_bytes)
+                    print(f'Saved image: {file_path}')
+                    queue_object.trace_stage('saved')
+                except Exception as e:
+                    print(f'Unable to save image: {file_path}\n{traceback.print_exc()}')
+            else:
+                file_path = f'{epoch_time}-x{queue_object.resize}-{self.file_name[0:120]}.png'
+                print(f'Received image: {file_path}')
+
+            # post to discord, fitting the image in the upload limit of the guild
+            image_size = utility.get_image_size(image_bytes)
+            if image_size == None: image_size = Image.open(io.BytesIO(image_bytes)).size
+            upload_image = utility.ImageDownload(image_bytes, image_size[0], image_size[1])
+            upload_image, extension = encoder.encode_images([upload_image], encoder.get_upload_limit(queue_object.ctx))[0]
+            queue_object.trace_stage('encoded')
+            file_path = file_path[:-len('.png')] + extension
+
+            queuehandler.upload_queue.process_upload(utility.UploadObject(queue_object=queue_object,
+                content=f'<@{user.id}> ``{queue_object.message}``', files=[discord.File(fp=io.BytesIO(upload_image.data), filename=file_path)], view=queue_object.view,
+                images=[upload_image]
+            ))
+            queue_object.view = None
+
+            # keep the upscaled image for the next time it is asked for
+            if store_result: resultcache.upscale_cache.put(queue_object.cache_key, response_body)
+
+        except Exception as e:
+            content = f'<@{user.id}> ``{queue_object.message}``\nSomething went wrong.\n{e}'
+            print(content + f'\n{traceback.print_exc()}')
+            queuehandler.upload_queue.process_upload(utility.UploadObject(queue_object=queue_object, content=content, delete_after=30))
+
 def setup(bot: discord.Bot):
     bot.add_cog(UpscaleCog(bot))
@@ -1,8 +1,35 @@
 import time
+import aiohttp
+import base64
+import collections
+import json
+import os
+import asyncio
+import concurrent.futures
 import requests
+import struct
 import threading
 import discord
 import traceback
+import typing
+import zlib
+
+from core import metrics
+
+# bounded pool for cpu heavy image work, so decoding and encoding images stays off the event loop
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix='image')
+
+# pooled async session for downloading images from discord, created on the event loop when first needed
+image_client: aiohttp.ClientSession = None
+
+# largest image download accepted from discord
+max_download_size = 10 * 1024 * 1024
+
+# check if the WebUI failed a request because it ran out of GPU memory. errors are small and have no images,
+# which keeps prompts that mention memory from matching
+def is_out_of_memory(response_body: bytes):
+    if len(response_body) > 64 * 1024 or b'"images"' in response_body: return False
+    return b'OutOfMemoryError' in response_body or b'out of memory' in response_body
 
 # WebUI access point
 class WebUI:
@@ -15,6 +42,21 @@ class WebUI:
         '--api-auth'
     ]
 
+    # WebUI command line flags that change the images it makes
+    output_flags = [
+        'xformers',
+        'force_enable_xformers',
+        'opt_sdp_attention',
+        'opt_sdp_no_mem_attention',
+        'opt_split_attention',
+        'opt_sub_quad_attention',
+        'no_half',
+        'no_half_vae',
+        'upcast_sampling',
+        'precision',
+        'use_cpu'
+    ]
+
     def __init__(self, url: str, username: str = None, password: str = None, api_user: str = None, api_pass: str = None):
         self.online = False
         self.stopped = False
@@ -76,6 +118,42 @@ class WebUI:
 
         self.reconnect_thread: threading.Thread = threading.Thread()
 
+        # arguments of the prompts from file script, used to make dreams of different users in one request
+        self.prompts_script_args: list[dict] = None
+
+        # total GPU memory reported by the WebUI, used to decide how many images to make at once
+        self.memory_total: int = None
+
+        # pooled session used for connection and health checks, authenticated once and kept alive
+        self.session: requests.Session = None
+        self.session_lock = threading.Lock()
+        self.health_thread: threading.Thread = threading.Thread()
+
+        # pooled async session shared by every dream sent to this WebUI, created on the event loop when first needed
+        self.client: aiohttp.ClientSession = None
+        self.client_loop: asyncio.AbstractEventLoop = None
+        self.client_lock = asyncio.Lock()
+        self.client_login = False
+
+        # called whenever this WebUI comes online, so queued dreams can be dispatched to it
+        self.online_callback = None
+
+        # checkpoint currently loaded on the WebUI, and the measured time it takes to switch checkpoints
+        self.model_loaded: str = None
+        self.model_switch_time: float = None
+        self.model_switch_count = 0
+        self.model_switch_total = 0.0
+        self.model_switch_lock = asyncio.Lock()
+
+        # dreams with a request sent to the WebUI that it has not started to answer, in the order they were sent.
+        # the WebUI works on one request at a time, so the first one is the dream it is running. only used on the event loop
+        self.jobs: list = []
+
+        # hashes of the checkpoints, and the version of the WebUI and flags that change its images.
+        # the same dream gives the same images on WebUIs where these match
+        self.model_hashes: dict[str, str] = {}
+        self.version: str = None
+
         self.data_models: list[str] = []
         self.sampler_names: list[str] = []
         self.model_tokens = {}
@@ -110,6 +188,7 @@ class WebUI:
     # check connection to WebUI and authentication
     def check_status(self):
         if self.stopped: return False
+        self.model_loaded = None
         try:
             response = requests.get(self.url + '/sdapi/v1/cmd-flags', timeout=30)
             # lazy method to see if --api-auth commandline argument is set
@@ -138,24 +217,16 @@ class WebUI:
         # check gradio authentication
         if self.stopped: return False
         try:
-            s = requests.Session()
-            if self.api_auth:
-                s.auth = (self.api_user, self.api_pass)
+            s = self.create_session()
 
             response_data = s.get(self.url + '/sdapi/v1/cmd-flags', timeout=30).json()
+            cmd_flags: dict = response_data
             if response_data['gradio_auth']:
                 self.gradio_auth = True
             else:
                 self.gradio_auth = False
 
-            if self.gradio_auth:
-                login_payload = {
-                    'username': self.username,
-                    'password': self.password
-                }
-                s.post(self.url + '/login', data=login_payload, timeout=30)
-            else:
-                s.post(self.url + '/login', timeout=30)
+            self.login(s, 30)
         except Exception as e:
             print(f'> Gradio Authentication failed for WebUI at {self.url}')
             self.online = False
@@ -168,8 +239,10 @@ class WebUI:
             # print('Retrieving stable diffusion models...')
             response_data = s.get(self.url + '/sdapi/v1/sd-models', timeout=30).json()
             self.data_models = []
+            self.model_hashes = {}
             for sd_model in response_data:
                 self.data_models.append(remove_hash(sd_model['title']))
+                self.model_hashes[remove_hash(sd_model['title'])] = sd_model.get('sha256') or sd_model.get('hash')
             # print(f'- Stable diffusion models: {len(self.data_models)}')
 
             # get samplers
@@ -204,6 +277,10 @@ class WebUI:
             # get settings from config workaround - if AUTOMATIC1111 provides a better way, this should be updated
             # print('Retrieving config models...')
             config = s.get(self.url + '/config', timeout=30).json()
+            self.version = json.dumps({
+                'version': config.get('version'),
+                'flags': {flag: cmd_flags.get(flag) for flag in WebUI.output_flags}
+            }, sort_keys=True)
             self.lora_names = []
             self.highres_upscaler_names = []
             try:
@@ -249,6 +326,28 @@ class WebUI:
                     self.embedding_names.append(embedding_model)
             # print(f'- Embedding models count: {len(self.embedding_names)}')
 
+            # get prompts from file script arguments, only available on newer versions of the webui
+            self.prompts_script_args = None
+            try:
+                response_data = s.get(self.url + '/sdapi/v1/script-info', timeout=30).json()
+                for script in response_data:
+                    if script['name'] == 'prompts from file or textbox' and script['is_img2img'] == False:
+                        self.prompts_script_args = script['args']
+            except:
+                pass
+
+            # get the checkpoint that is currently loaded
+            response_data = s.get(self.url + '/sdapi/v1/options', timeout=30).json()
+            self.model_loaded = remove_hash(response_data['sd_model_checkpoint'])
+
+            # get gpu memory, this may not be available when the webui is not using cuda
+            self.memory_total = None
+            try:
+                response_data = s.get(self.url + '/sdapi/v1/memory', timeout=30).json()
+                self.memory_total = int(response_data['cuda']['system']['total'])
+            except:
+                pass
+
             print(f'> Loaded data for WebUI at {self.url}')
             print(f'> - Models:{len(self.data_models)} Samplers:{len(self.sampler_names)} Styles:{len(self.style_names)} FaceFix:{len(self.facefix_models)} Upscalers:{len(self.upscaler_names)} HyperNets:{len(self.hypernet_names)} Embeddings:{len(self.embedding_names)}')
             if len(self.flags):
@@ -265,44 +364,208 @@ class WebUI:
             self.online = False
             return False
 
-        if self.stopped: return False
+        # keep the authenticated session for dreams
+        if self.stopped:
+            s.close()
+            return False
+        with self.session_lock:
+            session_old = self.session
+            self.session = s
+        if session_old: session_old.close()
+        self.client_login = False
+
         self.online_last = time.time()
         self.auth_rejected = 0
         self.online = True
+        self.check_health()
+        if self.online_callback: self.online_callback()
         return True
 
-    # return a request session
-    def get_session(self):
-        if self.stopped: return None
-        try:
-            s = requests.Session()
-            if self.api_auth:
-                s.auth = (self.api_user, self.api_pass)
-
-                # send login payload to webui
-                if self.gradio_auth:
-                    login_payload = {
-                        'username': self.username,
-                        'password': self.password
-                    }
-                    s.post(self.url + '/login', data=login_payload, timeout=5)
-                else:
-                    s.post(self.url + '/login', timeout=5)
+    # create a session that keeps connections to the WebUI alive, and is safe to share between threads
+    def create_session(self):
+        s = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=8)
+        s.mount('http://', adapter)
+        s.mount('https://', adapter)
+        if self.api_auth:
+            s.auth = (self.api_user, self.api_pass)
+        s.hooks['response'].append(self.session_response)
+        return s
+
+    # send login payload to webui
+    def login(self, s: requests.Session, timeout: int = 5):
+        if self.gradio_auth:
+            login_payload = {
+                'username': self.username,
+                'password': self.password
+            }
+            s.post(self.url + '/login', data=login_payload, timeout=timeout)
+        else:
+            s.post(self.url + '/login', timeout=timeout)
 
-            # if it's been a while since the last check for being online, do one now
-            elif time.time() > self.online_last + 60:
-                s.get(self.url + '/sdapi/v1/cmd-flags', timeout=5)
+    # log in again and retry once if the WebUI forgot about the session, otherwise keep track of the WebUI being online
+    def session_response(self, response: requests.Response, *args, **kwargs):
+        if response.status_code == 401 and response.request.url != self.url + '/login' and not hasattr(response.request, 'login_retry'):
+            s = self.session
+            if s == None: return response
+            print(f'> Session expired for WebUI at {self.url}, logging in again')
+            self.login(s)
+
+            request = response.request.copy()
+            request.login_retry = True
+            request.headers.pop('Cookie', None)
+            request.prepare_cookies(s.cookies)
+            return s.send(request, **kwargs)
+
+        if response.status_code < 400:
             self.online_last = time.time()
-            self.auth_rejected = 0
-            self.online = True
-            return s
+        return response
+
+    # get the async session for dreams, logging in the first time and after reconnecting
+    async def get_client(self):
+        async with self.client_lock:
+            if self.client == None or self.client.closed:
+                auth = None
+                if self.api_auth: auth = aiohttp.BasicAuth(self.api_user, self.api_pass)
+                connector = aiohttp.TCPConnector(limit=8, keepalive_timeout=60)
+                self.client = aiohttp.ClientSession(connector=connector, auth=auth)
+                self.client_loop = asyncio.get_running_loop()
+                self.client_login = False
+
+            if self.client_login == False:
+                await self.login_async(self.client)
+                self.client_login = True
+            return self.client
+
+    # send login payload to webui from the async session
+    async def login_async(self, client: aiohttp.ClientSession):
+        data = None
+        if self.gradio_auth:
+            data = {
+                'username': self.username,
+                'password': self.password
+            }
+        async with client.post(self.url + '/login', data=data, timeout=aiohttp.ClientTimeout(total=30)) as response:
+            await response.read()
+
+    # send a request from a dream, returns the raw response body so it can be decoded off the event loop.
+    # requests that make the dream pass the dream as job, so it can be interrupted while the WebUI works on it
+    async def post(self, path: str, payload: dict, timeout: float = 120, job = None):
+        client = await self.get_client()
+        time_start = time.time()
+        job_waiting = False
+        try:
+            for attempt in range(2):
+                if job != None:
+                    self.jobs.append(job)
+                    job_waiting = True
+                async with client.post(self.url + path, json=payload, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                    # the WebUI is done with the job once it starts to answer
+                    if job_waiting:
+                        self.finish_job(job)
+                        job_waiting = False
+
+                    if response.status == 401 and attempt == 0:
+                        # log in again if the WebUI forgot about the session
+                        print(f'> Session expired for WebUI at {self.url}, logging in again')
+                        await self.login_async(client)
+                        continue
 
+                    body = await response.read()
+                    if response.status < 400:
+                        self.online_last = time.time()
+                    else:
+                        metrics.webui_request_errors.inc(endpoint=path, webui=self.url)
+                    metrics.webui_request_seconds.observe(time.time() - time_start, endpoint=path, webui=self.url)
+                    return body
+        except:
+            metrics.webui_request_errors.inc(endpoint=path, webui=self.url)
+            raise
+        finally:
+            if job_waiting: self.finish_job(job)
+
+    def finish_job(self, job):
+        try:
+            self.jobs.remove(job)
+        except ValueError:
+            pass
+
+    # stop the job the WebUI is working on, it returns early with whatever it has made so far. the WebUI can't be
+    # told which job to stop, so it is only interrupted while the job given is the one it is working on
+    async def interrupt(self, job = None):
+        if job != None and (len(self.jobs) == 0 or self.jobs[0] is not job): return
+        try:
+            await self.post('/sdapi/v1/interrupt', {}, 10)
+            print(f'> Interrupted dream on WebUI at {self.url}')
         except Exception as e:
-            if self.online == True:
-                print(f'> Connection failed to WebUI at {self.url}')
-            self.online = False
-            self.connect() # attempt to reconnect
-            return None
+            print(f'> Failed to interrupt dream on WebUI at {self.url}\n{e}')
+
+    # check that the WebUI is still there whenever no dream has talked to it for a while
+    def check_health(self):
+        def run():
+            while self.stopped == False and self.online == True:
+                time.sleep(5)
+                if time.time() < self.online_last + 30: continue
+
+                with self.session_lock:
+                    s = self.session
+                if s == None: break
+                try:
+                    # also catch checkpoints being changed outside of the bot
+                    response = s.get(self.url + '/sdapi/v1/options', timeout=10)
+                    response.raise_for_status()
+                    data_model = remove_hash(response.json()['sd_model_checkpoint'])
+                    if self.model_switch_lock.locked() == False:
+                        self.model_loaded = data_model
+                except Exception as e:
+                    if self.stopped: break
+                    if self.online == True:
+                        print(f'> Connection failed to WebUI at {self.url}')
+                    self.online = False
+                    self.connect() # attempt to reconnect
+                    break
+
+        if self.health_thread.is_alive() == False:
+            self.health_thread = threading.Thread(target=run, daemon=True)
+            self.health_thread.start()
+
+    # number of images the WebUI can make in a single batch, allowing about 1GB per 512x512 image on top of 4GB for
+    # the checkpoint. width and height are the size of the first pass, highres fix makes it hr_scale times larger,
+    # and img2img also keeps the init images in memory
+    def get_max_batch_size(self, width: int, height: int, hr_scale: float = 1.0, img2img = False):
+        if self.memory_total == None:
+            images = 4.0
+        else:
+            images = float(self.memory_total) / float(1024 * 1024 * 1024) - 4.0
+        image_size = float(width * height) * max(1.0, hr_scale) * max(1.0, hr_scale)
+        if img2img: image_size *= 1.25
+        return max(1, int(images * float(512 * 512) / image_size))
+
+    # switch the checkpoint loaded on the WebUI, returns the time spent switching
+    async def switch_model(self, data_model: str):
+        # dreams on the same WebUI may switch at the same time, only let one of them do it
+        async with self.model_switch_lock:
+            if self.model_loaded == data_model: return 0.0
+
+            model_payload = {
+                'sd_model_checkpoint': data_model,
+            }
+            time_start = time.time()
+            await self.post('/sdapi/v1/options', model_payload, 120)
+            switch_time = time.time() - time_start
+
+            # measure checkpoint switches, skipping the first one since the previous checkpoint is not known
+            if self.model_loaded != None:
+                self.model_switch_count += 1
+                self.model_switch_total += switch_time
+                if self.model_switch_time == None:
+                    self.model_switch_time = switch_time
+                else:
+                    self.model_switch_time = self.model_switch_time * 0.7 + switch_time * 0.3
+                print(f'> Switched checkpoint to {data_model} on WebUI at {self.url} in {switch_time:.2f}s')
+                metrics.checkpoint_switch_seconds.observe(switch_time, webui=self.url)
+            self.model_loaded = data_model
+            return switch_time
 
     # continually retry a connection to the webui
     def connect(self):
@@ -341,10 +604,22 @@ class WebUI:
     def stop(self):
         self.online = False
         self.stopped = True
+        with self.session_lock:
+            s = self.session
+            self.session = None
+        if s: s.close()
+
+        client = self.client
+        self.client = None
+        if client and self.client_loop and self.client_loop.is_closed() == False:
+            asyncio.run_coroutine_threadsafe(client.close(), self.client_loop)
 
 
 # base queue object from dreams
 class DreamObject:
+    # called with a dream once it is uploaded or will not be, set by the upload queue
+    upload_listener = None
+
     def __init__(self, cog, ctx, view = None, message = None, write_to_cache = False, wait_for_dream = None, payload = None):
         self.cog = cog
         self.ctx: discord.ApplicationContext | discord.Interaction | discord.Message = ctx
@@ -355,6 +630,43 @@ class DreamObject:
         self.payload = payload
         self.uploaded = False
         self.dream_attempts = 0
+        self.affinity_passed: float = None # time this dream was first passed over for one using a loaded checkpoint
+        self.switch_time = 0.0 # seconds spent switching checkpoints for this dream
+        self.cancelled = False # set when the user cancels the dream, nothing more is uploaded for it
+        self.flight_key: str = None # set when identical dreams wait on this one, see resultcache
+
+        # per user queue accounting, managed by the dream queue
+        self.queue_holds = 0
+        self.queue_user_id: int = None
+        self.queue_cost = 0.0
+        self.queue_time = 0.0
+
+        # stages the dream has reached with their monotonic time, and the time of the first stage, see tracing
+        self.trace: list[tuple[str, float]] = None
+        self.trace_time: float = None
+
+    # record that the dream reached a stage, along with the dreams of the same batch or merge that it carries
+    def trace_stage(self, stage: str, carried = True):
+        stage_time = time.monotonic()
+        queue_objects = [self]
+        if carried: queue_objects = getattr(self, 'merge_objects', None) or getattr(self, 'batch_objects', None) or queue_objects
+        for queue_object in queue_objects:
+            # the trace of a cancelled dream has been written already
+            if queue_object.cancelled: continue
+            if queue_object.trace == None:
+                queue_object.trace = []
+                queue_object.trace_time = time.time()
+            queue_object.trace.append((stage, stage_time))
+
+    # set once the results of the dream have been uploaded, or nothing more will be uploaded for it
+    @property
+    def uploaded(self):
+        return self._uploaded
+
+    @uploaded.setter
+    def uploaded(self, uploaded: bool):
+        self._uploaded = uploaded
+        if uploaded and DreamObject.upload_listener: DreamObject.upload_listener(self)
 
 # the queue object for txt2image and img2img
 class DrawObject(DreamObject):
@@ -383,6 +695,8 @@ class DrawObject(DreamObject):
         self.highres_fix_negative: str = highres_fix_negative
         self.clip_skip: int = clip_skip
         self.script: str = script
+        self.batch_objects: list[DrawObject] = None # draw objects made in the same request as this one, including itself
+        self.merge_objects: list[DrawObject] = None # draw objects of other users merged into this request, including itself
 
     def get_command(self):
         command = f'/dream prompt:{self.prompt}'
@@ -429,6 +743,7 @@ class UpscaleObject(DreamObject):
         self.gfpgan: float = gfpgan
         self.codeformer: float = codeformer
         self.upscale_first: bool = upscale_first
+        self.cache_key: str = None
 
     def get_command(self):
         command = f'/upscale init_url:{self.init_url} resize:{self.resize} upscaler_1:{self.upscaler_1}'
@@ -449,6 +764,7 @@ class IdentifyObject(DreamObject):
         super().__init__(cog, ctx, view, message, write_to_cache, wait_for_dream, payload)
         self.init_url: str = init_url
         self.model: str = model
+        self.image_hash: str = None
 
     def get_command(self):
         command = f'/identify init_url:{self.init_url} model:{self.model}'
@@ -456,16 +772,17 @@ class IdentifyObject(DreamObject):
 
 # the queue object for discord uploads
 class UploadObject:
-    def __init__(self, queue_object, content, embed = None, ephemeral = None, files = None, view = None, delete_after = None):
+    def __init__(self, queue_object, content, embed = None, ephemeral = None, files = None, view = None, delete_after = None, images = None):
         self.queue_object: DreamObject = queue_object
         self.content: str = content
         self.embed: discord.Embed = embed
         self.ephemeral: bool = ephemeral
         self.files: list[discord.File] = files
+        self.images: list[ImageDownload] = images # the contents of the files, kept in the image store once uploaded
         self.view: discord.ui.View = view
         self.delete_after: float = delete_after
-        self.is_uploading = False
         self.upload_attempts = 0
+        self.queue_time = 0.0
 
 def get_guild(ctx: discord.ApplicationContext | discord.Interaction | discord.Message):
     try:
@@ -496,6 +813,23 @@ def get_user(ctx: discord.ApplicationContext | discord.Interaction | discord.Mes
     except:
         return None
 
+# get the id of the interaction or message that queued a dream, the queue message in reply to it refers to this id
+def get_ctx_id(ctx: discord.ApplicationContext | discord.Interaction | discord.Message):
+    try:
+        if type(ctx) is discord.ApplicationContext:
+            return ctx.interaction.id
+        else:
+            return ctx.id
+    except:
+        return None
+
+# format a number of seconds for display, such as 45s or 3m 20s
+def format_duration(seconds: float):
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return f'{seconds}s'
+    return f'{seconds // 60}m {seconds % 60}s'
+
 def find_between(s: str, first: str, last: str):
     try:
         start = s.index(first) + len(first)
@@ -513,4 +847,293 @@ def remove_hash(s: str):
                 s = s[:-12].strip()
     except:
         pass
-    return s
\ No newline at end of file
+    return s
+
+# raised when an image download is larger than it is allowed to be
+class DownloadTooLarge(Exception):
+    pass
+
+# an image downloaded by fetch_image. width and height are read from the header of the image, and are None if the format is unknown
+class ImageDownload:
+    def __init__(self, data: bytes, width: int = None, height: int = None):
+        self.data = data
+        self.width = width
+        self.height = height
+
+    # the image as a data url for the webui, encode it in the image executor as this takes a while for large images
+    def get_data_url(self):
+        return 'data:image/png;base64,' + base64.b64encode(self.data).decode('utf-8')
+
+# images uploaded by the bot by the id of their attachment, so buttons on its own messages don't download them again.
+# the least recently used images are removed once they take more than max_size bytes or are older than max_age seconds
+class ImageStore:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.max_size = 0
+        self.max_age = 6 * 60 * 60
+        self.size = 0
+        self.hits = 0
+
+        # attachment id to the message id, upload time and image, from least to most recently used
+        self.entries: collections.OrderedDict[int, tuple[int, float, ImageDownload]] = collections.OrderedDict()
+
+        # attachment ids of each message
+        self.messages: dict[int, set[int]] = {}
+
+    # remove the least recently used images until the store fits, along with old images that have become the least
+    # recently used. old images further back are dropped when they are asked for. the lock must be held
+    def evict(self):
+        expire_time = time.time() - self.max_age
+        while self.entries:
+            attachment_id, (message_id, upload_time, image) = next(iter(self.entries.items()))
+            if self.size <= self.max_size and upload_time >= expire_time: break
+            self.remove(attachment_id)
+
+    # the lock must be held
+    def remove(self, attachment_id: int):
+        message_id, upload_time, image = self.entries.pop(attachment_id)
+        self.size -= len(image.data)
+        attachment_ids = self.messages.get(message_id)
+        if attachment_ids:
+            attachment_ids.discard(attachment_id)
+            if len(attachment_ids) == 0: del self.messages[message_id]
+
+    def put(self, message_id: int, attachment_id: int, image: ImageDownload):
+        if self.max_size <= 0 or image == None or len(image.data) > self.max_size: return
+        with self.lock:
+            if attachment_id in self.entries: self.remove(attachment_id)
+            self.entries[attachment_id] = (message_id, time.time(), image)
+            self.messages.setdefault(message_id, set()).add(attachment_id)
+            self.size += len(image.data)
+            self.evict()
+
+    # get the image of a discord attachment url if the bot uploaded it
+    def get(self, url: str):
+        attachment_id = get_attachment_id(url)
+        if self.max_size <= 0 or attachment_id == None: return None
+        with self.lock:
+            entry = self.entries.get(attachment_id)
+            if entry == None: return None
+            if entry[1] < time.time() - self.max_age:
+                self.remove(attachment_id)
+                return None
+            self.entries.move_to_end(attachment_id)
+            self.hits += 1
+            return entry[2]
+
+    # forget the images of a deleted message
+    def remove_message(self, message_id: int):
+        with self.lock:
+            for attachment_id in list(self.messages.get(message_id, [])):
+                self.remove(attachment_id)
+
+image_store = ImageStore()
+
+# the attachment id in a discord cdn url, https://cdn.discordapp.com/attachments/<channel id>/<attachment id>/<file name>
+def get_attachment_id(url: str):
+    try:
+        path = url.split('?', 1)[0].split('/')
+        if path[3] != 'attachments': return None
+        return int(path[5])
+    except:
+        return None
+
+# one background thread that does the writes of the bot. writes wait until flush_interval seconds have passed or
+# max_pending writes are waiting, and are then done together. writes to the same file only write the latest contents.
+# callers never wait for the writer, as they may be on the event loop. when the writer falls behind by max_queued
+# items, more items are dropped until it catches up
+class WriteBehind:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.write_lock = threading.Lock()
+        self.flush_interval = 1.0
+        self.max_pending = 256
+        self.max_queued = 4096
+        self.pending = 0
+        self.queued = 0
+        self.dropped = 0
+        self.running = False
+        self.thread: threading.Thread = None
+
+        # contents of files by path, and items for functions that write many of them at once
+        self.files: dict[str, str | bytes] = {}
+        self.batches: dict[typing.Callable[[list], None], list] = {}
+
+    def start(self):
+        with self.condition:
+            if self.running: return
+            self.running = True
+            self.thread = threading.Thread(target=self.run, name='write-behind', daemon=True)
+            self.thread.start()
+
+    # write everything that is waiting and stop the thread
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread: self.thread.join()
+        self.flush()
+
+    # replace a file with the contents, atomically
+    def write_file(self, path: str, contents: str | bytes):
+        with self.condition:
+            if path not in self.files: self.add_pending()
+            self.files[path] = contents
+
+    # check if a file has contents waiting to be written
+    def is_pending(self, path: str):
+        with self.condition:
+            return path in self.files
+
+    # give an item to a function that writes a batch of items together. returns False if the item was dropped
+    def append(self, write_batch: typing.Callable[[list], None], item):
+        with self.condition:
+            if self.queued >= self.max_queued:
+                self.dropped += 1
+                metrics.write_drops.inc(writer=write_batch.__name__)
+                self.condition.notify_all()
+                return False
+            self.add_pending()
+            self.queued += 1
+            self.batches.setdefault(write_batch, []).append(item)
+            return True
+
+    # count a new write, waking the writer once too many are waiting. the condition must be held
+    def add_pending(self):
+        if self.running == False: self.start()
+        self.pending += 1
+        if self.pending >= self.max_pending: self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                if self.running and self.pending < self.max_pending:
+                    self.condition.wait(self.flush_interval)
+                if self.running == False: return
+            self.flush()
+
+    # do all waiting writes now
+    def flush(self):
+        with self.write_lock:
+            with self.condition:
+                files, self.files = self.files, {}
+                batches, self.batches = self.batches, {}
+                dropped, self.dropped = self.dropped, 0
+                self.pending = 0
+                self.condition.notify_all()
+            if dropped > 0: print(f'Dropped {dropped} writes, the writer fell behind by {self.max_queued} items')
+
+            for write_batch, items in batches.items():
+                try:
+                    write_batch(items)
+                except Exception as e:
+                    print(f'Failed to write {len(items)} items\n{e}\n{traceback.print_exc()}')
+
+            # the items are only taken off the queue once written, so a slow disk fills it up
+            with self.condition:
+                self.queued -= sum(len(items) for items in batches.values())
+
+            for path, contents in files.items():
+                try:
+                    mode = 'wb' if type(contents) is bytes else 'w'
+                    with open(path + '.tmp', mode) as f:
+                        f.write(contents)
+                    os.replace(path + '.tmp', path)
+                except Exception as e:
+                    print(f'Failed to write {path}\n{e}')
+
+async def get_image_client():
+    global image_client
+    if image_client == None or image_client.closed:
+        image_client = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=8), timeout=aiohttp.ClientTimeout(total=60))
+    return image_client
+
+# stream an image download, giving up as soon as it goes over max_size. this takes the place of asking for the size first
+async def fetch_image(url: str, max_size: int = max_download_size):
+    # images the bot uploaded itself are still in memory
+    image = image_store.get(url)
+    if image and len(image.data) <= max_size: return image
+
+    client = await get_image_client()
+    async with client.get(url) as response:
+        response.raise_for_status()
+        if response.content_length and response.content_length > max_size:
+            raise DownloadTooLarge(f'{response.content_length} bytes')
+
+        buffer = bytearray()
+        image_size = None
+        async for chunk in response.content.iter_chunked(64 * 1024):
+            if len(buffer) + len(chunk) > max_size:
+                raise DownloadTooLarge(f'more than {max_size} bytes')
+            buffer += chunk
+            if image_size == None and len(buffer) <= 256 * 1024: image_size = get_image_size(buffer)
+
+    # copy to bytes once, so the encoders and PIL can read the download without copying it again
+    data = bytes(buffer)
+    if image_size == None: image_size = get_image_size(data)
+    if image_size == None: return ImageDownload(data)
+    return ImageDownload(data, image_size[0], image_size[1])
+
+# add a text chunk to png bytes without decoding the image, replacing any chunk with the same key. returns None if the bytes are not a png
+def add_png_text(data: bytes, key: str, text: str):
+    if data[:8] != b'\x89PNG\r\n\x1a\n' or data[12:16] != b'IHDR': return None
+
+    # same encoding as PIL, latin-1 text when it can be and utf-8 international text otherwise
+    try:
+        chunk_type = b'tEXt'
+        chunk_data = key.encode('latin-1') + b'\0' + text.encode('latin-1')
+    except UnicodeError:
+        chunk_type = b'iTXt'
+        chunk_data = key.encode('latin-1') + b'\0\0\0\0\0' + text.encode('utf-8')
+    chunk = struct.pack('>I', len(chunk_data)) + chunk_type + chunk_data + struct.pack('>I', zlib.crc32(chunk_type + chunk_data))
+
+    # the new chunk goes right after the header, text chunks already using the key are left out
+    parts = [data[:33], chunk]
+    start = 33
+    index = 33
+    while index + 12 <= len(data):
+        length = struct.unpack('>I', data[index:index + 4])[0]
+        end = index + 12 + length
+        if data[index + 4:index + 8] in (b'tEXt', b'iTXt', b'zTXt') and data[index + 8:end - 4].split(b'\0', 1)[0] == key.encode('latin-1'):
+            parts.append(data[start:index])
+            start = end
+        index = end
+    parts.append(data[start:])
+    return b''.join(parts)
+
+# read the width and height of a PNG, JPEG, GIF or WebP image from its header, returns None if they are not in the bytes given
+def get_image_size(header: bytes):
+    try:
+        if header[:8] == b'\x89PNG\r\n\x1a\n' and len(header) >= 24:
+            return struct.unpack('>II', header[16:24])
+
+        if header[:6] in (b'GIF87a', b'GIF89a') and len(header) >= 10:
+            return struct.unpack('<HH', header[6:10])
+
+        if header[:4] == b'RIFF' and header[8:12] == b'WEBP' and len(header) >= 30:
+            match header[12:16]:
+                case b'VP8 ':
+                    width, height = struct.unpack('<HH', header[26:30])
+                    return width & 0x3FFF, height & 0x3FFF
+                case b'VP8L':
+                    bits = int.from_bytes(header[21:25], 'little')
+                    return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+                case b'VP8X':
+                    return int.from_bytes(header[24:27], 'little') + 1, int.from_bytes(header[27:30], 'little') + 1
+
+        if header[:2] == b'\xff\xd8':
+            # walk the JPEG segments until the start of frame, which can come after a large EXIF segment
+            index = 2
+            while index + 9 <= len(header):
+                if header[index] != 0xFF: return None
+                marker = header[index + 1]
+                if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7 or marker == 0xFF:
+                    index += 1 if marker == 0xFF else 2
+                    continue
+                if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                    height, width = struct.unpack('>HH', header[index + 5:index + 9])
+                    return width, height
+                index += 2 + struct.unpack('>H', header[index + 2:index + 4])[0]
+    except:
+        pass
+    return None
@@ -181,6 +181,7 @@ class DeleteModal(Modal):
 
             loop.create_task(interaction.response.defer())
             loop.create_task(interaction.message.delete())
+            utility.image_store.remove_message(interaction.message.id)
             update_user_delete(interaction.user.id)
 
         except Exception as e:
@@ -1005,6 +1006,7 @@ async def user_delete(interaction: discord.Interaction):
             loop.create_task(interaction.response.send_modal(DeleteModal(message)))
         else:
             loop.create_task(interaction.message.delete())
+            utility.image_store.remove_message(interaction.message.id)
             update_user_delete(interaction.user.id)
 
     except Exception as e:
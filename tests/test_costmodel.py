@@ -0,0 +1,40 @@
+import os
+import random
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from core import utility
+from core import costmodel
+
+
+def get_draw_object(sampler: str, size: int, steps: int):
+    ctx = types.SimpleNamespace(author=types.SimpleNamespace(id=1), guild=None)
+    return utility.DrawObject(None, ctx, 'a cat', '', 'model', 'model', steps, size, size, 7.0, sampler, 1,
+        0.75, None, 1, None, None, False, None, None, None, 1, None)
+
+# seconds the hardware takes, with a per sampler speed and a resolution scaling the features don't know about
+def get_seconds(sampler: str, size: int, steps: int):
+    seconds_per_step = {'Euler a': 0.1, 'DPM++ 2M': 0.25}[sampler]
+    area = float(size * size) / float(512 * 512)
+    return 0.5 + seconds_per_step * steps * pow(area, 1.6)
+
+def test_predictions_converge_per_sampler_and_resolution(monkeypatch):
+    monkeypatch.setattr(costmodel, 'save_cost_models', lambda force = False: None)
+    cost_model = costmodel.CostModel('test')
+    samplers = ['Euler a', 'DPM++ 2M']
+    sizes = [512, 1024]
+
+    generator = random.Random(1)
+    for _ in range(400):
+        draw_object = get_draw_object(generator.choice(samplers), generator.choice(sizes), generator.choice([10, 20, 30, 40]))
+        kind, features = costmodel.get_features(draw_object)
+        seconds = get_seconds(draw_object.sampler, draw_object.width, draw_object.steps) * generator.uniform(0.98, 1.02)
+        cost_model.record_dream_time(kind, features, seconds, costmodel.get_fit_key(draw_object))
+
+    for sampler in samplers:
+        for size in sizes:
+            draw_object = get_draw_object(sampler, size, 25)
+            expected = get_seconds(sampler, size, 25)
+            assert abs(cost_model.get_dream_time(draw_object) - expected) < expected * 0.05, (sampler, size)
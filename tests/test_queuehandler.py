@@ -0,0 +1,76 @@
+import os
+import sys
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from core import settings
+from core import utility
+from core import costmodel
+from core import queuehandler
+
+
+# an instance that takes every dream and keeps what it is given
+class Instance:
+    def __init__(self, name: str):
+        self.web_ui = types.SimpleNamespace(url=name, online=True, prompts_script_args=[])
+        self.cost_model = costmodel.CostModel(name)
+        self.dreams: list[utility.DreamObject] = []
+
+    def is_valid(self, queue_object):
+        return True
+
+    def is_ready(self, buffer_limit: int = 2):
+        return len(self.dreams) < buffer_limit
+
+    def get_finish_time(self, queue_object):
+        return float(len(self.dreams))
+
+    def get_data_model(self):
+        return None
+
+    def get_switch_time(self):
+        return 10.0
+
+    def process_dream(self, queue_object):
+        self.dreams.append(queue_object)
+
+class MergeCog:
+    merge_dreams = True
+
+def get_ctx(user_id: int):
+    return types.SimpleNamespace(author=types.SimpleNamespace(id=user_id), guild=None)
+
+def get_draw_object(user_id: int, prompt: str):
+    draw_object = utility.DrawObject(MergeCog(), get_ctx(user_id), prompt, '', 'model', 'model', 20, 512, 512, 7.0, 'Euler a', 1,
+        0.75, None, 1, None, None, False, None, None, None, 1, None)
+    draw_object.payload = {'prompt': prompt, 'negative_prompt': '', 'seed': 1, 'steps': 20, 'width': 512, 'height': 512}
+    return draw_object
+
+def push(dream_queue: queuehandler.DreamQueue, queue_object: utility.DreamObject):
+    queue_object.queue_time = time.time()
+    dream_queue.track_dream(queue_object)
+    dream_queue.queue.push(queue_object, 4, queue_object.queue_cost, utility.get_guild(queue_object.ctx), queue_object.queue_user_id)
+
+def test_held_merge_does_not_block_other_dreams(monkeypatch):
+    monkeypatch.setattr(settings.global_var, 'merge_window', 60.0)
+    monkeypatch.setattr(settings.global_var, 'merge_size', 4)
+
+    dream_queue = queuehandler.DreamQueue()
+    instances = [Instance('a'), Instance('b')]
+    dream_queue.dream_instances = instances
+
+    # the first dream waits for more dreams to merge with, the one behind it cannot be merged
+    mergeable = get_draw_object(1, 'a cat')
+    unrelated = utility.DreamObject(None, get_ctx(2))
+    push(dream_queue, mergeable)
+    push(dream_queue, unrelated)
+
+    with dream_queue.condition:
+        assert dream_queue.dispatch_dream()
+
+    dispatched = [queue_object for instance in instances for queue_object in instance.dreams]
+    assert dispatched == [unrelated]
+    assert dream_queue.dispatch_timeout != None and dream_queue.dispatch_timeout > 0.0
+    assert len(dream_queue.queue) == 1